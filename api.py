@@ -1,35 +1,667 @@
+import asyncio
+import json
+import logging
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import as_completed
+from concurrent.futures import wait
 from datetime import date
 from datetime import datetime
+from datetime import timedelta
+from typing import AsyncIterator
+from typing import Dict
+from typing import Iterable
+from typing import Iterator
 from typing import List
+from typing import NamedTuple
+from typing import Optional
 
+import aiohttp
 import requests
 import urllib3
 
+from cache import MISSING
+from cache import DayCache
+from cache import TTLCache
+from cache import day_runs
+from lessons import Lesson
+from policy import CircuitBreaker
+from policy import CircuitOpenError
+from policy import RequestPolicy
+from singleflight import SingleFlight
+from singleflight import ThreadSingleFlight
+
+try:
+    import brotli  # noqa: F401 - нужен aiohttp и urllib3 для распаковки br
+
+    ACCEPT_ENCODING = "gzip, deflate, br"
+except ImportError:
+    ACCEPT_ENCODING = "gzip, deflate"
+
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
+logger = logging.getLogger(__name__)
+
+
+class BatchResult(NamedTuple):
+    """Результат по одной сущности из timetable_many"""
+
+    entity_id: str
+    lessons: Optional[List]
+    error: Optional[Exception]
+
+
+class Validator(NamedTuple):
+    """Валидаторы ответа РУЗ для условного запроса и размер тела ответа"""
+
+    etag: Optional[str]
+    last_modified: Optional[str]
+    size: int
+
+
+class _Response(NamedTuple):
+    data: object
+    validator: Optional[Validator]
+    not_modified: bool
+
+
+class RuzHTTPError(requests.exceptions.BaseHTTPError):
+    """РУЗ ответил кодом, отличным от 200"""
+
+    def __init__(self, message: str, status: int):
+        super().__init__(message)
+        self.status = status
+
+
+class Timetable(list):
+    """Занятия за период и свежесть данных, из которых они собраны
+
+    fetched_at - время загрузки самого старого из вошедших дней, stale -
+    данные старше cache_ttl["schedule"] (отданы из кэша, пока РУЗ обновляется
+    в фоне или недоступен).
+    """
+
+    def __init__(self, lessons=(), fetched_at: Optional[float] = None, stale=False):
+        super().__init__(lessons)
+        self.fetched_at = fetched_at if fetched_at is not None else time.time()
+        self.stale = stale
+
+    @property
+    def age(self) -> float:
+        """Возраст данных в секундах"""
+
+        return time.time() - self.fetched_at
+
+
+class _Plan:
+    """Разбор запрошенного периода по состоянию дневного кэша"""
+
+    __slots__ = ("days", "found", "fallback", "runs", "stale")
+
+    def __init__(self, days, found, fallback, runs, stale):
+        self.days = days
+        self.found = found
+        self.fallback = fallback
+        self.runs = runs
+        self.stale = stale
+
+
+class BaseFaAPI:
+    """Общая часть синхронного и асинхронного клиентов РУЗ"""
 
-class FaAPI:
     HOST = "https://ruz.fa.ru"
 
-    def __date_now(self) -> str:
+    # время жизни закэшированных ответов по классам эндпоинтов, в секундах;
+    # stale - до какого возраста дни расписания отдаются сразу с обновлением в фоне;
+    # max_stale - до какого возраста их отдают, если РУЗ не отвечает
+    CACHE_TTL = {
+        "search": 6 * 60 * 60,
+        "schedule": 5 * 60,
+        "stale": 6 * 60 * 60,
+        "max_stale": 3 * 24 * 60 * 60,
+    }
+
+    # недостающие дни с разрывом не больше стольких дней грузятся одним запросом
+    MERGE_GAP_DAYS = 2
+
+    # сколько сущностей timetable_many грузит одновременно
+    BATCH_CONCURRENCY = 8
+
+    def __init__(
+        self,
+        cache: Optional[TTLCache] = None,
+        cache_ttl: Optional[Dict] = None,
+        days: Optional[DayCache] = None,
+        breaker: Optional[CircuitBreaker] = None,
+        policy: Optional[RequestPolicy] = None,
+        mirror=None,
+    ):
+        self.cache = cache if cache is not None else TTLCache()
+        self.cache_ttl = dict(self.CACHE_TTL, **(cache_ttl or {}))
+        self.days = days if days is not None else DayCache()
+        self.breaker = breaker if breaker is not None else CircuitBreaker()
+        self.policy = policy if policy is not None else RequestPolicy()
+        # ScheduleMirror: преподаватели, аудитории и здания из расписаний всех
+        # групп семестра, без запроса к РУЗ; группы читаются через days
+        self.mirror = mirror
+        # (kind, id, начало, конец) -> Validator последнего полного ответа
+        self.validators = TTLCache(maxsize=16384)
+        self.traffic: Dict[str, Dict[str, int]] = {}
+        self._traffic_lock = threading.Lock()
+
+    def _date_now(self) -> str:
         return datetime.now().strftime("%Y.%m.%d")
 
-    def __request(self, sub_url: str):
-        """Запрос к РУЗ"""
+    def _date_range(self, date_begin=None, date_end=None):
+        """Приводит границы периода к формату РУЗ, по умолчанию - сегодня"""
+
+        if date_begin is None or date_end is None:
+            date_begin = self._date_now()
+            date_end = date_begin
+        if isinstance(date_begin, date):
+            date_begin = date_begin.strftime("%Y.%m.%d")
+        if isinstance(date_end, date):
+            date_end = date_end.strftime("%Y.%m.%d")
+        return date_begin, date_end
+
+    def _parse_day(self, value) -> date:
+        if isinstance(value, datetime):
+            return value.date()
+        if isinstance(value, date):
+            return value
+        return datetime.strptime(value, "%Y.%m.%d").date()
+
+    def _days(self, date_begin=None, date_end=None) -> List[date]:
+        """Список дней периода включительно"""
+
+        date_begin, date_end = self._date_range(date_begin, date_end)
+        first, last = self._parse_day(date_begin), self._parse_day(date_end)
+        return [first + timedelta(days=i) for i in range((last - first).days + 1)]
+
+    def _from_mirror(
+        self, kind: str, entity_id: str, date_begin, date_end, max_age: Optional[float]
+    ) -> Optional[Timetable]:
+        """Расписание из зеркала, если оно есть и полно за период; иначе None"""
+
+        if self.mirror is None or kind == "group":
+            return None
+        date_begin, date_end = self._date_range(date_begin, date_end)
+        options = {} if max_age is None else {"max_age": max_age}
+        try:
+            return self.mirror.timetable(
+                kind, entity_id, date_begin, date_end, **options
+            )
+        except Exception as e:
+            logger.warning(f"Не удалось прочитать зеркало расписания: {e}")
+            return None
+
+    def _plan_timetable(
+        self,
+        kind: str,
+        entity_id: str,
+        date_begin,
+        date_end,
+        max_age: Optional[float] = None,
+    ) -> _Plan:
+        """Делит период на дни из кэша, отрезки для догрузки и устаревшие отрезки
+
+        Устаревшие дни (старше TTL, но моложе cache_ttl["stale"]) уже есть
+        в found, их отрезки нужно обновить, не заставляя пользователя ждать.
+        Дни старше, но моложе cache_ttl["max_stale"], попадают в fallback:
+        их догружают, но отдают, если РУЗ не ответил. max_age ужесточает
+        cache_ttl["stale"] для тех, кому нужны именно свежие данные.
+        """
+
+        days = self._days(date_begin, date_end)
+        return self._plan(days, self.days.entries(kind, str(entity_id), days), max_age)
+
+    def _plan(self, days: List[date], entries: Dict, max_age: Optional[float]) -> _Plan:
+        """План по уже прочитанным из кэша дням (см. _plan_timetable)"""
+
+        now = time.time()
+        usable = self.cache_ttl["stale"]
+        if max_age is not None:
+            usable = min(usable, max_age)
+        found, fallback, stale = {}, {}, []
+        for day, (fetched_at, lessons) in entries.items():
+            age = now - fetched_at
+            if age < usable:
+                found[day] = (fetched_at, lessons)
+                if age >= self.cache_ttl["schedule"]:
+                    stale.append(day)
+            elif age < self.cache_ttl["max_stale"]:
+                fallback[day] = (fetched_at, lessons)
+        missing = [day for day in days if day not in found]
+        return _Plan(
+            days,
+            found,
+            fallback,
+            day_runs(missing, self.MERGE_GAP_DAYS),
+            day_runs(stale, self.MERGE_GAP_DAYS),
+        )
+
+    def _apply_run(self, plan: _Plan, run, result):
+        """Кладет загруженный отрезок в план, а при ошибке - последнюю хорошую копию
+
+        Если хотя бы одного дня отрезка нет и в запасе, ошибка пробрасывается.
+        """
+
+        if not isinstance(result, Exception):
+            plan.found.update(result)
+            return
+        first, last = run
+        needed = [day for day in plan.days if first <= day <= last]
+        needed = [day for day in needed if day not in plan.found]
+        if not all(day in plan.fallback for day in needed):
+            raise result
+        for day in needed:
+            plan.found[day] = plan.fallback[day]
+        logger.warning(f"РУЗ недоступен, отдаем расписание из кэша: {result}")
+
+    def _assemble(self, plan: _Plan) -> Timetable:
+        fetched_at = min((plan.found[day][0] for day in plan.days), default=None)
+        timetable = Timetable(
+            (lesson for day in plan.days for lesson in plan.found[day][1]), fetched_at
+        )
+        timetable.stale = timetable.age >= self.cache_ttl["schedule"]
+        return timetable
+
+    def is_cached(
+        self, kind: str, entity_id: str, date_begin: date = None, date_end: date = None
+    ) -> bool:
+        """Покрыт ли период целиком свежими днями из кэша в памяти
+
+        Диск не читается: проверку зовут прямо из event loop.
+        """
+
+        days = self._days(date_begin, date_end)
+        found = self.days.get_range(
+            kind,
+            str(entity_id),
+            days,
+            self.cache_ttl["schedule"],
+            count=False,
+            load=False,
+        )
+        return len(found) == len(days)
+
+    def _split_days(self, lessons: List, first: date, last: date) -> Dict[date, list]:
+        """Разбирает ответ РУЗ в Lesson и раскладывает по дням отрезка
+
+        Дни без занятий тоже попадают в результат пустыми списками.
+        """
 
-        r = requests.get(self.HOST + sub_url, verify=False)
-        if r.status_code == 200:
-            return r.json()
-        raise requests.exceptions.BaseHTTPError(
+        by_day = {
+            first + timedelta(days=i): [] for i in range((last - first).days + 1)
+        }
+        for raw in lessons:
+            lesson = Lesson.from_dict(raw)
+            if lesson.day is None:
+                continue
+            day = date.fromordinal(lesson.day)
+            if day in by_day:
+                by_day[day].append(lesson)
+        return by_day
+
+    def _conditional_headers(self, validator: Optional[Validator]) -> Dict[str, str]:
+        headers = {"Accept-Encoding": ACCEPT_ENCODING}
+        if validator is not None:
+            if validator.etag:
+                headers["If-None-Match"] = validator.etag
+            if validator.last_modified:
+                headers["If-Modified-Since"] = validator.last_modified
+        return headers
+
+    def _response(
+        self,
+        endpoint: str,
+        status: int,
+        headers,
+        body: bytes,
+        sent: Optional[Validator],
+    ) -> _Response:
+        """Разбирает ответ 200/304 и учитывает сэкономленный трафик"""
+
+        length = headers.get("Content-Length")
+        wire = int(length) if length and length.isdigit() else len(body)
+        if status == 304:
+            self._count_traffic(endpoint, wire, 0, sent.size, not_modified=True)
+            return _Response(None, sent, True)
+
+        self._count_traffic(endpoint, wire, len(body), max(0, len(body) - wire))
+        etag, modified = headers.get("ETag"), headers.get("Last-Modified")
+        validator = Validator(etag, modified, len(body)) if etag or modified else None
+        return _Response(json.loads(body), validator, False)
+
+    def _count_traffic(
+        self, endpoint: str, wire: int, body: int, saved: int, not_modified=False
+    ):
+        with self._traffic_lock:
+            counters = self.traffic.get(endpoint)
+            if counters is None:
+                counters = self.traffic[endpoint] = dict.fromkeys(
+                    (
+                        "requests",
+                        "not_modified",
+                        "wire_bytes",
+                        "body_bytes",
+                        "saved_bytes",
+                    ),
+                    0,
+                )
+            counters["requests"] += 1
+            counters["not_modified"] += int(not_modified)
+            counters["wire_bytes"] += wire
+            counters["body_bytes"] += body
+            counters["saved_bytes"] += saved
+
+    def _span(self, first: date, last: date) -> List[date]:
+        return [first + timedelta(days=i) for i in range((last - first).days + 1)]
+
+    def _revalidation(self, kind: str, entity_id: str, first: date, last: date):
+        """Закэшированные дни отрезка и валидатор, если отрезок в кэше целиком"""
+
+        days = self._span(first, last)
+        cached = self.days.entries(kind, str(entity_id), days, count=False)
+        return cached, self._validator(kind, entity_id, first, last, cached)
+
+    def _validator(
+        self, kind: str, entity_id: str, first: date, last: date, cached: Dict
+    ) -> Optional[Validator]:
+        """Валидатор отрезка для условного запроса
+
+        Условный запрос имеет смысл, только если при 304 есть что отдать.
+        """
+
+        if len(cached) < (last - first).days + 1:
+            return None
+        date_begin, date_end = self._date_range(first, last)
+        validator = self.validators.get(
+            self._timetable_key(kind, entity_id, date_begin, date_end)
+        )
+        return None if validator is MISSING else validator
+
+    def _store_days(
+        self, kind: str, entity_id: str, first: date, last: date, response, cached
+    ) -> Dict:
+        """Кладет загруженный (или подтвержденный 304) отрезок в дневной кэш"""
+
+        fetched_at = time.time()
+        if response.not_modified:
+            by_day = {day: lessons for day, (_, lessons) in cached.items()}
+            self.days.touch(kind, str(entity_id), by_day, fetched_at)
+        else:
+            by_day = self._split_days(response.data, first, last)
+            self.days.put_days(kind, str(entity_id), by_day, fetched_at)
+
+        key = self._timetable_key(kind, entity_id, *self._date_range(first, last))
+        if response.validator is not None:
+            self.validators.set(key, response.validator, self.cache_ttl["max_stale"])
+        else:
+            self.validators.pop(key)
+        return {day: (fetched_at, lessons) for day, lessons in by_day.items()}
+
+    def _search_key(self, kind: str, term: str) -> tuple:
+        return ("search", kind, term.strip().lower())
+
+    def _search_url(self, kind: str, term: str) -> str:
+        return "/api/search?term={}&type={}".format(term, kind)
+
+    def _timetable_key(
+        self, kind: str, entity_id: str, date_begin: str, date_end: str
+    ) -> tuple:
+        return ("schedule", kind, str(entity_id), date_begin, date_end)
+
+    def _timetable_url(
+        self, kind: str, entity_id: str, date_begin: str, date_end: str
+    ) -> str:
+        return "/api/schedule/{}/{}?start={}&finish={}&lng=1".format(
+            kind, entity_id, date_begin, date_end
+        )
+
+
+class FaAPI(BaseFaAPI):
+    def __init__(
+        self,
+        cache: Optional[TTLCache] = None,
+        cache_ttl: Optional[Dict] = None,
+        days: Optional[DayCache] = None,
+        breaker: Optional[CircuitBreaker] = None,
+        policy: Optional[RequestPolicy] = None,
+        mirror=None,
+    ):
+        super().__init__(cache, cache_ttl, days, breaker, policy, mirror)
+        self.flight = ThreadSingleFlight()
+        self._hedge_pool: Optional[ThreadPoolExecutor] = None
+        # потоки timetable_many создают пул одновременно
+        self._hedge_lock = threading.Lock()
+        # keep-alive соединения на все потоки timetable_many и хеджей
+        self._http = requests.Session()
+        self._http.mount(
+            "https://",
+            requests.adapters.HTTPAdapter(pool_maxsize=self.BATCH_CONCURRENCY * 3),
+        )
+
+    def close(self):
+        """Закрывает пул соединений"""
+
+        self._http.close()
+        with self._hedge_lock:
+            if self._hedge_pool is not None:
+                self._hedge_pool.shutdown(wait=False)
+                self._hedge_pool = None
+
+    def __attempt(self, sub_url: str, endpoint: str, validator=None) -> _Response:
+        """Одна попытка запроса к РУЗ"""
+
+        if not self.breaker.allow():
+            raise CircuitOpenError("РУЗ не отвечает, запросы приостановлены")
+        started = time.monotonic()
+        try:
+            r = self._http.get(
+                self.HOST + sub_url,
+                verify=False,
+                timeout=self.policy.timeout(endpoint),
+                headers=self._conditional_headers(validator),
+            )
+        except requests.exceptions.RequestException:
+            self.breaker.failure()
+            raise
+        if r.status_code == 200 or (r.status_code == 304 and validator is not None):
+            self.breaker.success()
+            self.policy.record(endpoint, time.monotonic() - started)
+            return self._response(
+                endpoint, r.status_code, r.headers, r.content, validator
+            )
+        if r.status_code >= 500:
+            self.breaker.failure()
+        else:
+            self.breaker.success()
+        raise RuzHTTPError(
             "[Ошибка] RUZ отдал код {}!\nURL: '{}'".format(
-                r.status_code, self.base_url + sub_url
+                r.status_code, self.HOST + sub_url
+            ),
+            r.status_code,
+        )
+
+    def _retryable(self, error: Exception) -> bool:
+        if isinstance(error, RuzHTTPError):
+            return error.status >= 500 or error.status == 429
+        return isinstance(
+            error, (requests.exceptions.ConnectionError, requests.exceptions.Timeout)
+        )
+
+    def __hedged(self, sub_url: str, endpoint: str, validator=None) -> _Response:
+        """Попытка, продублированная вторым запросом, если первый дольше p95"""
+
+        delay = self.policy.hedge_delay(endpoint)
+        if delay is None:
+            return self.__attempt(sub_url, endpoint, validator)
+
+        with self._hedge_lock:
+            if self._hedge_pool is None:
+                self._hedge_pool = ThreadPoolExecutor(
+                    self.BATCH_CONCURRENCY * 2, thread_name_prefix="ruz-hedge"
+                )
+            pool = self._hedge_pool
+        first = pool.submit(self.__attempt, sub_url, endpoint, validator)
+        futures = [first]
+        done, _ = wait(futures, timeout=delay)
+        if not done and self.policy.should_hedge():
+            futures.append(pool.submit(self.__attempt, sub_url, endpoint, validator))
+
+        pending = set(futures)
+        while True:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    if future is not first:
+                        self.policy.hedge_wins += 1
+                    return future.result()
+            if not pending:
+                raise done.pop().exception()
+
+    def __request(self, sub_url: str, endpoint: str, validator=None) -> _Response:
+        """Запрос к РУЗ с повторами по политике self.policy
+
+        С validator запрос условный: РУЗ может ответить 304 без тела.
+        """
+
+        self.policy.budget.deposit()
+        attempt = 0
+        while True:
+            try:
+                return self.__hedged(sub_url, endpoint, validator)
+            except Exception as e:
+                attempt += 1
+                if not self._retryable(e) or not self.policy.should_retry(attempt):
+                    raise
+            time.sleep(self.policy.backoff(attempt - 1))
+
+    def __cached(self, key: tuple, sub_url: str, cache: bool = True):
+        """Запрос к РУЗ через кэш ответов и склейку одинаковых запросов
+
+        cache=False - мимо кэша: не читать из него и не класть в него ответ.
+        """
+
+        r = self.cache.get(key) if cache else MISSING
+        if r is not MISSING:
+            return r
+
+        def fetch():
+            r = self.__request(sub_url, key[0]).data
+            if cache:
+                self.cache.set(key, r, self.cache_ttl[key[0]])
+            return r
+
+        return self.flight.do(key, fetch)
+
+    def _search(self, kind: str, term: str, cache: bool = True) -> List:
+        return self.__cached(
+            self._search_key(kind, term), self._search_url(kind, term), cache
+        )
+
+    def __fetch_days(self, kind: str, entity_id: str, first: date, last: date):
+        """Загружает отрезок дней из РУЗ и раскладывает его по дневному кэшу"""
+
+        date_begin, date_end = self._date_range(first, last)
+
+        def fetch():
+            cached, validator = self._revalidation(kind, entity_id, first, last)
+            r = self.__request(
+                self._timetable_url(kind, entity_id, date_begin, date_end),
+                "schedule",
+                validator,
             )
+            return self._store_days(kind, entity_id, first, last, r, cached)
+
+        return self.flight.do(
+            self._timetable_key(kind, entity_id, date_begin, date_end), fetch
         )
 
+    def _timetable(
+        self,
+        kind: str,
+        entity_id: str,
+        date_begin: date = None,
+        date_end: date = None,
+        max_age: Optional[float] = None,
+    ) -> Timetable:
+        mirrored = self._from_mirror(kind, entity_id, date_begin, date_end, max_age)
+        if mirrored is not None:
+            return mirrored
+        plan = self._plan_timetable(kind, entity_id, date_begin, date_end, max_age)
+        # фоновых задач у синхронного клиента нет: устаревшее обновляем сразу,
+        # а при ошибке остаемся на том, что уже есть в кэше
+        for first, last in plan.stale:
+            try:
+                plan.found.update(self.__fetch_days(kind, entity_id, first, last))
+            except Exception as e:
+                logger.warning(f"Не удалось обновить расписание: {e}")
+        for run in plan.runs:
+            try:
+                result = self.__fetch_days(kind, entity_id, *run)
+            except Exception as e:
+                result = e
+            self._apply_run(plan, run, result)
+        return self._assemble(plan)
+
+    def timetable(
+        self, kind: str, entity_id: str, date_begin: date = None, date_end: date = None
+    ) -> Timetable:
+        """Отдает расписание сущности РУЗ (group, person, auditorium, building)"""
+
+        r = self._timetable(kind, entity_id, date_begin, date_end)
+        return r
+
+    def timetable_many(
+        self,
+        kind: str,
+        ids: Iterable[str],
+        date_begin: date = None,
+        date_end: date = None,
+        concurrency: Optional[int] = None,
+        max_age: Optional[float] = None,
+    ) -> Iterator[BatchResult]:
+        """Расписания многих сущностей одного типа, по мере готовности
+
+        Ошибка по одной сущности не прерывает пакет, а приходит в BatchResult.
+        max_age - не отдавать из кэша дни старше стольких секунд.
+        """
+
+        def one(entity_id):
+            try:
+                lessons = self._timetable(
+                    kind, entity_id, date_begin, date_end, max_age
+                )
+                return BatchResult(entity_id, lessons, None)
+            except Exception as e:
+                return BatchResult(entity_id, None, e)
+
+        with ThreadPoolExecutor(concurrency or self.BATCH_CONCURRENCY) as pool:
+            futures = [pool.submit(one, entity_id) for entity_id in ids]
+            try:
+                for future in as_completed(futures):
+                    yield future.result()
+            finally:
+                for future in futures:
+                    future.cancel()
+
+    def search(self, kind: str, term: str, cache: bool = True) -> List:
+        """Поиск сущности РУЗ (group, person, auditorium, building) по названию
+
+        cache=False - мимо кэша поиска, для обходов всего РУЗ.
+        """
+
+        r = self._search(kind, term, cache)
+        return r
+
     def search_group(self, group_name: str) -> List:
         """Поиск группы по ее названию"""
 
-        r = self.__request("/api/search?term={}&type=group".format(group_name))
+        r = self._search("group", group_name)
         return r
 
     def timetable_group(
@@ -37,21 +669,13 @@ class FaAPI:
     ) -> List:
         """Отдает расписание группы по её id"""
 
-        if date_begin is None or date_end is None:
-            date_begin = self.__date_now()
-            date_end = date_begin
-
-        r = self.__request(
-            "/api/schedule/group/{}?start={}&finish={}&lng=1".format(
-                group_id, date_begin, date_end
-            )
-        )
+        r = self._timetable("group", group_id, date_begin, date_end)
         return r
 
     def search_teacher(self, teacher_name: str) -> List:
         """Поиск преподавателя по его ФИО"""
 
-        r = self.__request("/api/search?term={}&type=person".format(teacher_name))
+        r = self._search("person", teacher_name)
         return r
 
     def timetable_teacher(
@@ -59,45 +683,27 @@ class FaAPI:
     ) -> List:
         """Отдает расписание преподавателя по его id"""
 
-        if date_begin is None or date_end is None:
-            date_begin = self.__date_now()
-            date_end = date_begin
-
-        r = self.__request(
-            "/api/schedule/person/{}?start={}&finish={}&lng=1".format(
-                teacher_id, date_begin, date_end
-            )
-        )
+        r = self._timetable("person", teacher_id, date_begin, date_end)
         return r
 
     def search_auditorium(self, auditorium_name: str) -> List:
         """Поиск аудитории по её названию"""
 
-        r = self.__request(
-            "/api/search?term={}&type=auditorium".format(auditorium_name)
-        )
+        r = self._search("auditorium", auditorium_name)
         return r
 
     def timetable_auditorium(
         self, auditorium_id: str, date_begin: date = None, date_end: date = None
     ) -> List:
-        """Отдает расписание преподавателя по его id"""
-
-        if date_begin is None or date_end is None:
-            date_begin = self.__date_now()
-            date_end = date_begin
+        """Отдает расписание аудитории по её id"""
 
-        r = self.__request(
-            "/api/schedule/auditorium/{}?start={}&finish={}&lng=1".format(
-                auditorium_id, date_begin, date_end
-            )
-        )
+        r = self._timetable("auditorium", auditorium_id, date_begin, date_end)
         return r
 
     def search_building(self, building_name: str) -> List:
         """Поиск здания по его названию"""
 
-        r = self.__request("/api/search?term={}&type=building".format(building_name))
+        r = self._search("building", building_name)
         return r
 
     def timetable_building(
@@ -105,13 +711,358 @@ class FaAPI:
     ) -> List:
         """Отдает расписание здания по его id"""
 
-        if date_begin is None or date_end is None:
-            date_begin = self.__date_now()
-            date_end = date_begin
+        r = self._timetable("building", building_id, date_begin, date_end)
+        return r
+
+
+class AsyncFaAPI(BaseFaAPI):
+    """Асинхронный клиент РУЗ поверх общей keep-alive сессии aiohttp
+
+    Сессия открывается через start() (или лениво при первом запросе)
+    и должна закрываться через close() при остановке бота.
+    """
+
+    def __init__(
+        self,
+        limit: int = 100,
+        limit_per_host: int = 30,
+        timeout: float = 15.0,
+        connect_timeout: float = 5.0,
+        keepalive_timeout: float = 30.0,
+        cache: Optional[TTLCache] = None,
+        cache_ttl: Optional[Dict] = None,
+        days: Optional[DayCache] = None,
+        breaker: Optional[CircuitBreaker] = None,
+        policy: Optional[RequestPolicy] = None,
+        mirror=None,
+    ):
+        super().__init__(cache, cache_ttl, days, breaker, policy, mirror)
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.timeout = timeout
+        self.connect_timeout = connect_timeout
+        self.keepalive_timeout = keepalive_timeout
+        self._session: Optional[aiohttp.ClientSession] = None
+        self.flight = SingleFlight()
+        self._background = set()
+
+    async def start(self):
+        """Открывает пул соединений к РУЗ"""
+
+        if self._session is not None and not self._session.closed:
+            return
+
+        connector = aiohttp.TCPConnector(
+            limit=self.limit,
+            limit_per_host=self.limit_per_host,
+            keepalive_timeout=self.keepalive_timeout,
+            ssl=False,
+        )
+        self._session = aiohttp.ClientSession(
+            connector=connector,
+            timeout=aiohttp.ClientTimeout(
+                total=self.timeout, sock_connect=self.connect_timeout
+            ),
+        )
+
+    async def close(self):
+        """Закрывает пул соединений"""
+
+        for task in list(self._background):
+            task.cancel()
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    async def __attempt(self, sub_url: str, endpoint: str, validator=None) -> _Response:
+        """Одна попытка запроса к РУЗ"""
+
+        if self._session is None or self._session.closed:
+            await self.start()
+        if not self.breaker.allow():
+            raise CircuitOpenError("РУЗ не отвечает, запросы приостановлены")
+
+        connect, read = self.policy.timeout(endpoint)
+        timeout = aiohttp.ClientTimeout(
+            total=self.timeout, sock_connect=connect, sock_read=read
+        )
+        started = time.monotonic()
+        try:
+            async with self._session.get(
+                self.HOST + sub_url,
+                timeout=timeout,
+                headers=self._conditional_headers(validator),
+            ) as r:
+                if r.status == 200 or (r.status == 304 and validator is not None):
+                    body = await r.read()
+                    self.breaker.success()
+                    self.policy.record(endpoint, time.monotonic() - started)
+                    return self._response(
+                        endpoint, r.status, r.headers, body, validator
+                    )
+                error = aiohttp.ClientResponseError(
+                    r.request_info,
+                    r.history,
+                    status=r.status,
+                    message="[Ошибка] RUZ отдал код {}!\nURL: '{}'".format(
+                        r.status, self.HOST + sub_url
+                    ),
+                )
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            self.breaker.failure()
+            raise
+        if error.status >= 500:
+            self.breaker.failure()
+        else:
+            self.breaker.success()
+        raise error
+
+    def _retryable(self, error: Exception) -> bool:
+        if isinstance(error, aiohttp.ClientResponseError):
+            return error.status >= 500 or error.status == 429
+        return isinstance(error, (aiohttp.ClientError, asyncio.TimeoutError))
+
+    async def __hedged(self, sub_url: str, endpoint: str, validator=None) -> _Response:
+        """Попытка, продублированная вторым запросом, если первый дольше p95"""
+
+        delay = self.policy.hedge_delay(endpoint)
+        if delay is None:
+            return await self.__attempt(sub_url, endpoint, validator)
+
+        first = asyncio.ensure_future(self.__attempt(sub_url, endpoint, validator))
+        tasks = [first]
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=delay)
+            if not done and self.policy.should_hedge():
+                tasks.append(
+                    asyncio.ensure_future(self.__attempt(sub_url, endpoint, validator))
+                )
+
+            pending = set(tasks)
+            while True:
+                done, pending = await asyncio.wait(
+                    pending, return_when=asyncio.FIRST_COMPLETED
+                )
+                # exception() у всех завершившихся, чтобы ошибки не терялись молча
+                ok = [task for task in done if task.exception() is None]
+                if ok:
+                    if ok[0] is not first:
+                        self.policy.hedge_wins += 1
+                    return ok[0].result()
+                if not pending:
+                    raise done.pop().exception()
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def __request(self, sub_url: str, endpoint: str, validator=None) -> _Response:
+        """Запрос к РУЗ с повторами по политике self.policy
+
+        С validator запрос условный: РУЗ может ответить 304 без тела.
+        """
+
+        self.policy.budget.deposit()
+        attempt = 0
+        while True:
+            try:
+                return await self.__hedged(sub_url, endpoint, validator)
+            except Exception as e:
+                attempt += 1
+                if not self._retryable(e) or not self.policy.should_retry(attempt):
+                    raise
+            await asyncio.sleep(self.policy.backoff(attempt - 1))
+
+    async def __cached(self, key: tuple, sub_url: str, cache: bool = True):
+        """Запрос к РУЗ через кэш ответов и склейку одинаковых запросов
+
+        cache=False - мимо кэша: не читать из него и не класть в него ответ.
+        """
+
+        r = self.cache.get(key) if cache else MISSING
+        if r is not MISSING:
+            return r
+
+        async def fetch():
+            r = (await self.__request(sub_url, key[0])).data
+            if cache:
+                self.cache.set(key, r, self.cache_ttl[key[0]])
+            return r
+
+        return await self.flight.do(key, fetch)
 
-        r = self.__request(
-            "/api/schedule/building/{}?start={}&finish={}&lng=1".format(
-                building_id, date_begin, date_end
+    async def _search(self, kind: str, term: str, cache: bool = True) -> List:
+        return await self.__cached(
+            self._search_key(kind, term), self._search_url(kind, term), cache
+        )
+
+    async def __fetch_days(self, kind: str, entity_id: str, first: date, last: date):
+        """Загружает отрезок дней из РУЗ и раскладывает его по дневному кэшу"""
+
+        date_begin, date_end = self._date_range(first, last)
+
+        async def fetch():
+            cached = await self.days.entries_async(
+                kind, str(entity_id), self._span(first, last), count=False
             )
+            validator = self._validator(kind, entity_id, first, last, cached)
+            r = await self.__request(
+                self._timetable_url(kind, entity_id, date_begin, date_end),
+                "schedule",
+                validator,
+            )
+            return self._store_days(kind, entity_id, first, last, r, cached)
+
+        return await self.flight.do(
+            self._timetable_key(kind, entity_id, date_begin, date_end), fetch
         )
-        return r
+
+    def _revalidate(self, kind: str, entity_id: str, first: date, last: date):
+        """Обновляет устаревший отрезок в фоне; ошибки только логируются"""
+
+        if self.breaker.is_open:
+            return
+        task = asyncio.ensure_future(self.__fetch_days(kind, entity_id, first, last))
+        self._background.add(task)
+        task.add_done_callback(self._revalidated)
+
+    def _revalidated(self, task: asyncio.Future):
+        self._background.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logger.warning(f"Фоновое обновление расписания: {task.exception()}")
+
+    async def _timetable(
+        self,
+        kind: str,
+        entity_id: str,
+        date_begin: date = None,
+        date_end: date = None,
+        max_age: Optional[float] = None,
+    ) -> Timetable:
+        if self.mirror is not None and kind != "group":
+            # SQLite зеркала - не в цикле событий
+            mirrored = await asyncio.get_running_loop().run_in_executor(
+                None, self._from_mirror, kind, entity_id, date_begin, date_end, max_age
+            )
+            if mirrored is not None:
+                return mirrored
+        days = self._days(date_begin, date_end)
+        entries = await self.days.entries_async(kind, str(entity_id), days)
+        plan = self._plan(days, entries, max_age)
+        for first, last in plan.stale:
+            self._revalidate(kind, entity_id, first, last)
+        fetched = await asyncio.gather(
+            *[self.__fetch_days(kind, entity_id, *run) for run in plan.runs],
+            return_exceptions=True,
+        )
+        for run, result in zip(plan.runs, fetched):
+            if isinstance(result, BaseException) and not isinstance(result, Exception):
+                raise result
+            self._apply_run(plan, run, result)
+        return self._assemble(plan)
+
+    async def timetable(
+        self, kind: str, entity_id: str, date_begin: date = None, date_end: date = None
+    ) -> Timetable:
+        """Отдает расписание сущности РУЗ (group, person, auditorium, building)"""
+
+        return await self._timetable(kind, entity_id, date_begin, date_end)
+
+    async def timetable_many(
+        self,
+        kind: str,
+        ids: Iterable[str],
+        date_begin: date = None,
+        date_end: date = None,
+        concurrency: Optional[int] = None,
+        max_age: Optional[float] = None,
+    ) -> AsyncIterator[BatchResult]:
+        """Расписания многих сущностей одного типа, по мере готовности
+
+        Ошибка по одной сущности не прерывает пакет, а приходит в BatchResult.
+        max_age - не отдавать из кэша дни старше стольких секунд.
+        """
+
+        semaphore = asyncio.Semaphore(concurrency or self.BATCH_CONCURRENCY)
+
+        async def one(entity_id):
+            async with semaphore:
+                try:
+                    lessons = await self._timetable(
+                        kind, entity_id, date_begin, date_end, max_age
+                    )
+                    return BatchResult(entity_id, lessons, None)
+                except Exception as e:
+                    return BatchResult(entity_id, None, e)
+
+        tasks = [asyncio.ensure_future(one(entity_id)) for entity_id in ids]
+        try:
+            for next_done in asyncio.as_completed(tasks):
+                yield await next_done
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def search(self, kind: str, term: str, cache: bool = True) -> List:
+        """Поиск сущности РУЗ (group, person, auditorium, building) по названию
+
+        cache=False - мимо кэша поиска, для обходов всего РУЗ.
+        """
+
+        return await self._search(kind, term, cache)
+
+    async def search_group(self, group_name: str) -> List:
+        """Поиск группы по ее названию"""
+
+        return await self._search("group", group_name)
+
+    async def timetable_group(
+        self, group_id: str, date_begin: date = None, date_end: date = None
+    ) -> List:
+        """Отдает расписание группы по её id"""
+
+        return await self._timetable("group", group_id, date_begin, date_end)
+
+    async def search_teacher(self, teacher_name: str) -> List:
+        """Поиск преподавателя по его ФИО"""
+
+        return await self._search("person", teacher_name)
+
+    async def timetable_teacher(
+        self, teacher_id: str, date_begin: date = None, date_end: date = None
+    ) -> List:
+        """Отдает расписание преподавателя по его id"""
+
+        return await self._timetable("person", teacher_id, date_begin, date_end)
+
+    async def search_auditorium(self, auditorium_name: str) -> List:
+        """Поиск аудитории по её названию"""
+
+        return await self._search("auditorium", auditorium_name)
+
+    async def timetable_auditorium(
+        self, auditorium_id: str, date_begin: date = None, date_end: date = None
+    ) -> List:
+        """Отдает расписание аудитории по её id"""
+
+        return await self._timetable(
+            "auditorium", auditorium_id, date_begin, date_end
+        )
+
+    async def search_building(self, building_name: str) -> List:
+        """Поиск здания по его названию"""
+
+        return await self._search("building", building_name)
+
+    async def timetable_building(
+        self, building_id: str, date_begin: date = None, date_end: date = None
+    ) -> List:
+        """Отдает расписание здания по его id"""
+
+        return await self._timetable("building", building_id, date_begin, date_end)
@@ -1,13 +1,32 @@
 #finally FINAL vers
-from requests import request
+import asyncio
 import logging
-from datetime import datetime, timedelta
+import os
+import re
+import tempfile
+from datetime import date, datetime, timedelta
+from itertools import groupby
 from aiomax import Bot, CommandContext, Message, Callback
 from aiomax.buttons import CallbackButton, KeyboardBuilder
 from aiomax.fsm import FSMCursor
 from aiomax.filters import equals, state
 from aiomax.types import BotCommand
-from api import FaAPI
+from api import AsyncFaAPI
+from cache import DayCache
+from digest import DailyDigest
+from directory import EntityDirectory, is_junk
+from ics import calendar, filename, write_ics
+from lessonindex import LessonIndex
+from lessons import by_day, day_label, hhmm
+from mirror import MIRROR_PATH, ScheduleMirror, semester
+from notify import ChangeNotifier, SubscriptionStore
+from outbox import Outbox
+from prefetch import PopularityStore, Prefetcher
+from rooms import PAIRS, RoomIndex
+from render import PAGE_LIMIT, Pages, RenderCache, Rendered, escape, render_group, render_teacher
+from sessions import ExpiringFSMStorage
+from store import TimetableStore
+from windows import DAY_END, DAY_START, busy_masks, find_common_free, free_slots
 
 logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
@@ -15,6 +34,21 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# место под пометку о свежести данных на первой странице
+SCHEDULE_PAGE_LIMIT = PAGE_LIMIT - 100
+
+# окна в расписании группы - перерывы длиннее 45 минут
+WINDOW_MIN_MINUTES = 46
+# общее свободное время: не короче пары, не больше 10 групп и преподавателей
+COMMON_MIN_MINUTES = 90
+COMMON_MAX_ENTITIES = 10
+
+# выгрузок .ics одновременно на процесс: каждая тянет десятки недель из РУЗ
+EXPORT_CONCURRENCY = 2
+
+# "14:00-15:30", "завтра 9:00 - 10:30"
+ROOM_TIME_RE = re.compile(r'^(завтра\s+)?(\d{1,2})[:.](\d{2})\s*[-–—]\s*(\d{1,2})[:.](\d{2})$', re.I)
+
 
 class States:
     """Состояния для ConversationHandler"""
@@ -22,13 +56,44 @@ class States:
     ENTERING_GROUP = "entering_group"
     ENTERING_TEACHER = "entering_teacher"
     ENTERING_GROUP_FOR_WINDOWS = "entering_group_for_windows"
+    ENTERING_COMMON = "entering_common"
+    ENTERING_BUILDING = "entering_building"
+    ENTERING_ROOM_TIME = "entering_room_time"
     CHOOSING_DATE_RANGE = "choosing_date_range"
 
 
 class ScheduleBot:
-    def __init__(self, token):
+    def __init__(self, token, storage=None, background=True, send_rate=20.0):
+        """Бот расписания
+
+        storage - хранилище FSM; SQLiteFSMStorage, если процессов бота несколько.
+        background - запускать ли фоновые задачи, которые ходят в РУЗ и пишут
+        пользователям (прогрев кэша, уведомления, рассылку, обновление
+        справочника и индекса занятий); в многопроцессном режиме их ведет
+        отдельный процесс, а обработчики только читают общий кэш на диске.
+        send_rate - доля процесса в лимите отправки сообщений.
+        """
         self.token = token
-        self.api = FaAPI()
+        self.background = background
+        # зеркало семестра (mirror.py sync) заменяет кэш расписаний на диске
+        self.mirror = ScheduleMirror(MIRROR_PATH) if os.path.exists(MIRROR_PATH) else None
+        self.store = self.mirror or TimetableStore()
+        self.directory = EntityDirectory()
+        self.lessons = LessonIndex(self._group_ids)
+        self.api = AsyncFaAPI(
+            days=DayCache(store=self.store, index=self.lessons, write_behind=True),
+            mirror=self.mirror,
+        )
+        self.popularity = PopularityStore()
+        self.prefetcher = Prefetcher(self.api, store=self.popularity)
+        self.renders = RenderCache()
+        self.rooms = RoomIndex(
+            self.api, lessons=self.lessons, directory=self.directory, mirror=self.mirror
+        )
+        self.subscriptions = SubscriptionStore()
+        self.outbox = Outbox(self._deliver_message, rate=send_rate)
+        self.notifier = ChangeNotifier(self.api, self.subscriptions, self._send_notification)
+        self.digest = DailyDigest(self.api, self.subscriptions, self.outbox, self._render_digest)
         self.bot = Bot(
             access_token=token,
             command_prefixes="/",
@@ -37,6 +102,9 @@ class ScheduleBot:
             default_format="html",
             max_messages_cached=1000
         )
+        self.sessions = storage if storage is not None else ExpiringFSMStorage()
+        self._exports = asyncio.Semaphore(EXPORT_CONCURRENCY)
+        self.bot.storage = self.sessions
         self._setup_handlers()
 
     def _setup_handlers(self):
@@ -58,6 +126,42 @@ class ScheduleBot:
         async def cancel_cmd(ctx: CommandContext, cursor: FSMCursor):
             await self.cancel(ctx, cursor)
 
+        @self.bot.on_command("subscribe", aliases=["подписаться"])
+        async def subscribe_cmd(ctx: CommandContext, cursor: FSMCursor):
+            await self.subscribe(ctx, cursor, ctx.message.recipient.chat_id)
+
+        @self.bot.on_command("unsubscribe", aliases=["отписаться"])
+        async def unsubscribe_cmd(ctx: CommandContext, cursor: FSMCursor):
+            await self.unsubscribe_menu(ctx, ctx.message.recipient.chat_id)
+
+        @self.bot.on_command("common", aliases=["общее"])
+        async def common_cmd(ctx: CommandContext, cursor: FSMCursor):
+            await self.common_start(ctx, cursor)
+
+        @self.bot.on_command("rooms", aliases=["аудитории"])
+        async def rooms_cmd(ctx: CommandContext, cursor: FSMCursor):
+            await self.rooms_start(ctx, cursor)
+
+        @self.bot.on_command("export", aliases=["календарь"])
+        async def export_cmd(ctx: CommandContext, cursor: FSMCursor):
+            await self.export_menu(ctx, cursor)
+
+        @self.bot.on_command("digest", aliases=["рассылка"])
+        async def digest_cmd(ctx: CommandContext, cursor: FSMCursor):
+            await self.digest_menu(ctx, cursor, ctx.message.recipient.chat_id)
+
+        @self.bot.on_button_callback(equals("digest_on"))
+        async def digest_on_cb(callback: Callback, cursor: FSMCursor):
+            await self.digest_on(callback, cursor)
+
+        @self.bot.on_button_callback(equals("digest_off"))
+        async def digest_off_cb(callback: Callback, cursor: FSMCursor):
+            await self.digest_off(callback)
+
+        @self.bot.on_button_callback(equals("subscribe"))
+        async def subscribe_cb(callback: Callback, cursor: FSMCursor):
+            await self.subscribe(callback, cursor, callback.message.recipient.chat_id)
+
         @self.bot.on_button_callback(equals("main_menu"))
         async def main_menu_cb(callback: Callback, cursor: FSMCursor):
             await self.schedule_menu_callback(callback, cursor)
@@ -74,6 +178,30 @@ class ScheduleBot:
         async def windows_cb(callback: Callback, cursor: FSMCursor):
             await self.find_windows(callback, cursor)
 
+        @self.bot.on_button_callback(equals("common"))
+        async def common_cb(callback: Callback, cursor: FSMCursor):
+            await self.common_start(callback, cursor)
+
+        @self.bot.on_button_callback(equals("rooms"))
+        async def rooms_cb(callback: Callback, cursor: FSMCursor):
+            await self.rooms_start(callback, cursor)
+
+        @self.bot.on_button_callback(equals("calendar"))
+        async def calendar_cb(callback: Callback, cursor: FSMCursor):
+            await self.export_menu(callback, cursor)
+
+        @self.bot.on_button_callback(equals("common_week"))
+        async def common_week_cb(callback: Callback, cursor: FSMCursor):
+            await self.show_common_free(callback, cursor)
+
+        @self.bot.on_button_callback(equals("common_next_week"))
+        async def common_next_week_cb(callback: Callback, cursor: FSMCursor):
+            await self.show_common_free(callback, cursor)
+
+        @self.bot.on_button_callback(equals("common_month"))
+        async def common_month_cb(callback: Callback, cursor: FSMCursor):
+            await self.show_common_free(callback, cursor)
+
         @self.bot.on_button_callback(equals("date_today"))
         async def date_today_cb(callback: Callback, cursor: FSMCursor):
             await self.show_schedule_with_date(callback, cursor)
@@ -86,6 +214,10 @@ class ScheduleBot:
         async def date_week_cb(callback: Callback, cursor: FSMCursor):
             await self.show_schedule_with_date(callback, cursor)
 
+        @self.bot.on_button_callback(equals("page_next"))
+        async def page_next_cb(callback: Callback, cursor: FSMCursor):
+            await self.next_page(callback, cursor)
+
         @self.bot.on_button_callback(equals("date_reselect"))
         async def date_reselect_cb(callback: Callback, cursor: FSMCursor):
             await self.date_reselect(callback, cursor)
@@ -102,6 +234,12 @@ class ScheduleBot:
         async def handle_select_cb(callback: Callback, cursor: FSMCursor):
             if callback.payload.startswith("select_"):
                 await self.handle_selection(callback, cursor)
+            elif callback.payload.startswith("unsub_"):
+                await self.unsubscribe(callback)
+            elif callback.payload.startswith("rooms_"):
+                await self.show_free_rooms(callback, cursor)
+            elif callback.payload.startswith("export_"):
+                await self.export_ics(callback, cursor)
 
         @self.bot.on_message(state(States.ENTERING_GROUP))
         async def process_group_msg(message: Message, cursor: FSMCursor):
@@ -115,17 +253,46 @@ class ScheduleBot:
         async def process_windows_msg(message: Message, cursor: FSMCursor):
             await self.process_windows_input(message, cursor)
 
+        @self.bot.on_message(state(States.ENTERING_COMMON))
+        async def process_common_msg(message: Message, cursor: FSMCursor):
+            await self.process_common_input(message, cursor)
+
+        @self.bot.on_message(state(States.ENTERING_BUILDING))
+        async def process_building_msg(message: Message, cursor: FSMCursor):
+            await self.process_building_input(message, cursor)
+
+        @self.bot.on_message(state(States.ENTERING_ROOM_TIME))
+        async def process_room_time_msg(message: Message, cursor: FSMCursor):
+            await self.process_room_time_input(message, cursor)
+
         @self.bot.on_ready()
         async def on_ready():
             await self.on_startup()
 
     async def on_startup(self):
         """Выполняется при запуске бота"""
+        self.outbox.start()
+        self.sessions.start()
+        await self.api.start()
+        if not self.background:
+            await self.directory.load()
+            # индексы нужны и обработчикам: они читают кэш, который пишет фоновый процесс
+            self.prefetcher.start(warm=False)
+            self.rooms.start()
+            self.lessons.start(self.api, fetch=False)
+            return
+
         try:
         
             commands = [
                 BotCommand('start', 'Начать работу с ботом'),
                 BotCommand('schedule', 'Открыть меню расписания'),
+                BotCommand('subscribe', 'Подписаться на изменения расписания'),
+                BotCommand('unsubscribe', 'Отписаться от изменений расписания'),
+                BotCommand('digest', 'Расписание на завтра каждый вечер'),
+                BotCommand('common', 'Общее свободное время нескольких групп'),
+                BotCommand('rooms', 'Свободные аудитории в здании'),
+                BotCommand('export', 'Открытое расписание в календарь (.ics)'),
                 BotCommand('help', 'Показать справку'),
                 BotCommand('cancel', 'Отменить текущую операцию')
             ]
@@ -134,6 +301,165 @@ class ScheduleBot:
         except Exception as e:
             logger.error(f'Ошибка при инициализации команд: {e}')
 
+        await self.directory.start(self.api)
+        self.prefetcher.start()
+        self.notifier.start()
+        self.digest.start()
+        self.rooms.start()
+        self.lessons.start(self.api)
+
+    async def on_shutdown(self):
+        """Выполняется при остановке бота"""
+        await self.lessons.stop()
+        await self.rooms.stop()
+        await self.digest.stop()
+        await self.notifier.stop()
+        await self.prefetcher.stop()
+        await self.outbox.stop()
+        await self.sessions.stop()
+        await self.directory.stop()
+        await self.api.close()
+        logger.info(f'Рендер расписаний: {self.renders.stats()}')
+        logger.info(f'Аудитории: {self.rooms.stats()}')
+        logger.info(f'Индекс занятий: {self.lessons.stats()}')
+        logger.info(f'Сессии: {self.sessions.stats()}, {self.sessions.memory()}')
+        self.sessions.close()
+        self.subscriptions.close()
+        self.popularity.close()
+        self.api.days.close()
+        self.store.close()
+
+    def _group_ids(self):
+        """Все группы справочника: без их дней индекс занятий неполон"""
+        return [entry['id'] for entry in self.directory.entries('group')]
+
+    def _track_request(self, kind, eid, db, de):
+        """Учет запроса расписания для прогрева кэша популярных групп"""
+        self.prefetcher.record(kind, eid, self.api.is_cached(kind, eid, db, de))
+
+    async def _deliver_message(self, chat_id, text, **kwargs):
+        """Фактическая отправка сообщения; вызывается только из outbox"""
+        return await self.bot.send_message(text, chat_id=chat_id, **kwargs)
+
+    async def _send(self, context, text, keyboard=None, reply=False, attachments=None):
+        """Ответ пользователю через outbox в приоритетной полосе
+
+        context - Message, Callback или CommandContext, как у их send/reply.
+        """
+        message = context if isinstance(context, Message) else context.message
+        kwargs = {}
+        if keyboard is not None:
+            kwargs['keyboard'] = keyboard
+        if attachments is not None:
+            kwargs['attachments'] = attachments
+        if reply:
+            kwargs['reply_to'] = message.id
+        return await self.outbox.send(message.recipient.chat_id, text, **kwargs)
+
+    async def _send_notification(self, chat_id, text):
+        """Уведомление об изменениях в чат подписчика"""
+        self.outbox.enqueue(chat_id, text, lane='notify')
+
+    def _render_digest(self, kind, name, lessons):
+        """Текст вечерней рассылки, общий для всех чатов с этой сущностью"""
+        if kind == 'person':
+            text = render_teacher(name, lessons).text
+        else:
+            text = render_group(name, lessons).text
+        return '🌙 <b>Расписание на завтра</b>\n\n' + text
+
+    async def digest_menu(self, ctx: CommandContext, cursor: FSMCursor, chat_id):
+        """Команда /digest - включение и отключение вечерней рассылки"""
+        current = self.subscriptions.digest_of(chat_id)
+        selected = self._selected_entity(cursor)
+
+        kb = KeyboardBuilder()
+        if current is not None:
+            text = f'🌙 Каждый вечер в {self.digest.at} я присылаю расписание на завтра: <b>{current[2]}</b>'
+        else:
+            text = f'🌙 Могу каждый вечер в {self.digest.at} присылать расписание на завтра.'
+        if selected is not None and (current is None or current[:2] != selected[:2]):
+            kb.row(CallbackButton(f'🌙 Присылать для {selected[2]}', payload='digest_on'))
+        elif current is None:
+            text += '\nСначала откройте расписание группы или преподавателя (/schedule).'
+        if current is not None:
+            kb.row(CallbackButton('🔕 Отключить рассылку', payload='digest_off'))
+        await self._send(ctx, text, keyboard=kb)
+
+    async def digest_on(self, callback: Callback, cursor: FSMCursor):
+        """Включение вечерней рассылки для открытого расписания"""
+        selected = self._selected_entity(cursor)
+        if selected is None:
+            await callback.answer(notification='Сначала откройте расписание')
+            return
+        kind, eid, name = selected
+        self.subscriptions.set_digest(callback.message.recipient.chat_id, kind, eid, name)
+        await callback.answer(notification='Рассылка включена')
+        await self._send(callback, f'🌙 Каждый вечер в {self.digest.at} пришлю расписание на завтра: <b>{name}</b>')
+
+    async def digest_off(self, callback: Callback):
+        """Отключение вечерней рассылки"""
+        self.subscriptions.remove_digest(callback.message.recipient.chat_id)
+        await callback.answer(notification='Рассылка отключена')
+        await self._send(callback, '🔕 Вечерняя рассылка отключена')
+
+    def _selected_entity(self, cursor: FSMCursor):
+        """Открытая пользователем группа или преподаватель: (kind, id, название)"""
+        data = cursor.get_data() or {}
+        kind = {'group': 'group', 'teacher': 'person'}.get(data.get('type'))
+        if kind is None or not data.get('selected_id'):
+            return None
+        eid = str(data['selected_id'])
+        return kind, eid, data.get('selected_name') or eid
+
+    async def subscribe(self, context, cursor: FSMCursor, chat_id):
+        """Подписка чата на изменения открытого расписания"""
+        selected = self._selected_entity(cursor)
+        if selected is None:
+            await self._send(
+                context,
+                'Сначала откройте расписание группы или преподавателя (/schedule), '
+                'затем подпишитесь на его изменения'
+            )
+            return
+
+        kind, eid, name = selected
+        if self.subscriptions.add(chat_id, kind, eid, name):
+            text = (
+                f'🔔 Вы подписались на изменения расписания: <b>{name}</b>\n'
+                f'Я напишу, если занятие перенесут или отменят.\n'
+                f'Отписаться: /unsubscribe'
+            )
+        else:
+            text = f'Вы уже подписаны на изменения расписания: <b>{name}</b>'
+        await self._send(context, text)
+
+    async def unsubscribe_menu(self, ctx: CommandContext, chat_id):
+        """Команда /unsubscribe - список подписок чата"""
+        subs = self.subscriptions.of_chat(chat_id)
+        if not subs:
+            await self._send(ctx, 'У вас нет подписок на изменения расписания')
+            return
+
+        kb = KeyboardBuilder()
+        for kind, eid, label in subs:
+            kb.row(CallbackButton(f'🔕 {label}', payload=f'unsub_{kind}_{eid}'))
+        kb.row(CallbackButton('🔕 Отписаться от всех', payload='unsub_all'))
+        await self._send(ctx, 'Выберите, от чего отписаться:', keyboard=kb)
+
+    async def unsubscribe(self, callback: Callback):
+        """Отписка по кнопке из /unsubscribe"""
+        chat_id = callback.message.recipient.chat_id
+        parts = callback.payload.split('_', 2)
+        if parts[1] == 'all':
+            self.subscriptions.remove(chat_id)
+            text = '🔕 Вы отписались от всех изменений расписания'
+        else:
+            self.subscriptions.remove(chat_id, parts[1], parts[2])
+            text = '🔕 Подписка отменена'
+        await callback.answer(notification=text)
+        await self._send(callback, text)
+
     async def start(self, ctx: CommandContext, cursor: FSMCursor):
         """Команда /start"""
         cursor.clear()  
@@ -147,7 +473,7 @@ class ScheduleBot:
             f'Нажми кнопку ниже или используй /schedule'
         )
 
-        await ctx.send(text, keyboard=kb)
+        await self._send(ctx, text, keyboard=kb)
 
     async def help_command(self, ctx: CommandContext):
         """Команда /help"""
@@ -155,14 +481,24 @@ class ScheduleBot:
             '<b>Доступные команды:</b>\n\n'
             '/start - Начать работу с ботом\n'
             '/schedule - Открыть меню расписания\n'
+            '/subscribe - Подписаться на изменения открытого расписания\n'
+            '/unsubscribe - Отписаться от изменений\n'
+            '/digest - Расписание на завтра каждый вечер в 20:00\n'
+            '/common - Когда свободны сразу несколько групп и преподавателей\n'
+            '/rooms - Свободные аудитории в здании\n'
+            '/export - Открытое расписание в календарь (.ics) на семестр\n'
             '/help - Показать справку\n'
             '/cancel - Отменить операцию\n\n'
             '<b>Возможности:</b>\n'
             '• Расписание группы\n'
             '• Расписание преподавателя\n'
-            '• Поиск свободных окон'
+            '• Поиск свободных окон\n'
+            '• Общее свободное время нескольких групп\n'
+            '• Свободные аудитории на пару или промежуток\n'
+            '• Экспорт расписания в календарь\n'
+            '• Уведомления о переносах и отменах занятий'
         )
-        await ctx.send(text)
+        await self._send(ctx, text)
 
     async def schedule_menu(self, ctx: CommandContext, cursor: FSMCursor):
         """Команда /schedule - показать главное меню"""
@@ -172,15 +508,17 @@ class ScheduleBot:
         kb.row(CallbackButton('📅 Расписание группы', payload='group'))
         kb.row(CallbackButton('👨‍🏫 Расписание преподавателя', payload='teacher'))
         kb.row(CallbackButton('🔍 Поиск окон в расписании', payload='find_windows'))
+        kb.row(CallbackButton('👥 Общее свободное время', payload='common'))
+        kb.row(CallbackButton('🏫 Свободные аудитории', payload='rooms'))
 
-        await ctx.send('Выберите, что хотите посмотреть:', keyboard=kb)
+        await self._send(ctx, 'Выберите, что хотите посмотреть:', keyboard=kb)
 
     async def cancel(self, ctx: CommandContext, cursor: FSMCursor):
         """Команда /cancel"""
         cursor.clear()
         kb = KeyboardBuilder()
         kb.row(CallbackButton('🔙 Назад в меню', payload='main_menu'))
-        await ctx.send('Операция отменена', keyboard=kb)
+        await self._send(ctx, 'Операция отменена', keyboard=kb)
 
     async def schedule_menu_callback(self, callback: Callback, cursor: FSMCursor):
         """Возврат в главное меню через кнопку"""
@@ -191,6 +529,8 @@ class ScheduleBot:
         kb.row(CallbackButton('📅 Расписание группы', payload='group'))
         kb.row(CallbackButton('👨‍🏫 Расписание преподавателя', payload='teacher'))
         kb.row(CallbackButton('🔍 Поиск окон в расписании', payload='find_windows'))
+        kb.row(CallbackButton('👥 Общее свободное время', payload='common'))
+        kb.row(CallbackButton('🏫 Свободные аудитории', payload='rooms'))
 
         await callback.answer(text='Выберите, что хотите посмотреть:', keyboard=kb)
 
@@ -224,49 +564,87 @@ class ScheduleBot:
         """Повторный выбор группы"""
         cursor.change_data({'type': 'group'})
         cursor.change_state(States.ENTERING_GROUP)
-        await callback.send('Введите название группы (например, ПИ22-1):')
+        await self._send(callback, 'Введите название группы (например, ПИ22-1):')
 
     async def choose_another_teacher(self, callback: Callback, cursor: FSMCursor):
         """Повторный выбор преподавателя"""
         cursor.change_data({'type': 'teacher'})
         cursor.change_state(States.ENTERING_TEACHER)
-        await callback.send('Введите ФИО преподавателя:')
+        await self._send(callback, 'Введите ФИО преподавателя:')
 
     async def handle_selection(self, callback: Callback, cursor: FSMCursor):
         """Обработка выбора из списка результатов"""
         parts = callback.payload.split('_')
-        entity_type = parts[1]  # group, teacher, windows
+        entity_type = parts[1]  # group, teacher, windows, building, common
         eid = '_'.join(parts[2:])
 
         data = cursor.get_data() or {}
-        results = data.get('search_results', [])
-        selected = next((r for r in results if str(r['id']) == eid), None)
+        if entity_type == 'common':
+            kind, _, eid = eid.partition('_')
+        else:
+            kind = {'teacher': 'person', 'building': 'building'}.get(entity_type, 'group')
+        selected = self._resolve_choice(kind, eid, data)
 
         if not selected:
             await callback.answer(notification='Ошибка: элемент не найден')
             return
 
+        data.pop('choices', None)
         if entity_type == 'windows':
+            cursor.change_data(data)
             await self.find_and_show_windows(callback, cursor, selected['id'], selected['label'])
+        elif entity_type == 'building':
+            data['building'] = [str(selected['id']), selected['label']]
+            cursor.change_data(data)
+            await self.ask_room_time(callback, cursor)
+        elif entity_type == 'common':
+            pending = next((e for e in data.get('common') or [] if e[1] is None), None)
+            if pending is None or pending[0] != kind:
+                await callback.answer(notification='Введите группы заново')
+                return
+            pending[1], pending[2] = str(selected['id']), selected['label']
+            cursor.change_data(data)
+            await self._ask_common_next(callback, cursor)
         else:
             data['selected_id'] = selected['id']
             data['selected_name'] = selected['label']
             cursor.change_data(data)
             await self.ask_date_range(callback, cursor)
 
+    def _remember_choices(self, cursor: FSMCursor, kind, shown):
+        """Запоминает предложенные варианты для handle_selection
+
+        Если справочник собран, вариант потом находится в нем по id из
+        кнопки, и в сессии ничего не хранится. Иначе (результаты пришли
+        из РУЗ) сохраняются только показанные id и названия.
+        """
+        data = cursor.get_data() or {}
+        if self.directory.ready(kind):
+            data.pop('choices', None)
+        else:
+            data['choices'] = {str(r['id']): r['label'] for r in shown}
+        cursor.change_data(data)
+
+    def _resolve_choice(self, kind, eid, data):
+        """Сущность по id из кнопки: из справочника или из запомненных вариантов"""
+        entry = self.directory.get(kind, eid)
+        if entry is not None:
+            return entry
+        label = (data.get('choices') or {}).get(eid)
+        if label is None:
+            return None
+        return {'id': eid, 'label': label}
+
     def _filter_group_results(self, results, search_query):
         """Фильтрация результатов поиска группы"""
         filtered = []
         search_lower = search_query.lower().strip()
 
         for result in results:
-            label = result.get('label', '')
-            label_lower = label.lower()
+            label_lower = result.get('label', '').lower()
 
             # тотальная чистка пустышек от руз
-            if ';' in label:
-                continue
-            if 'модуль' in label_lower or 'module' in label_lower:
+            if is_junk('group', result):
                 continue
 
             # точное совпадение группы - возвращать сразу
@@ -277,24 +655,36 @@ class ScheduleBot:
 
         return filtered
 
+    async def _find_entities(self, kind, name):
+        """Поиск по локальному справочнику, а пока он не собран - через РУЗ
+
+        Возвращает (результаты, это_подсказки): если по подстроке ничего нет,
+        справочник предлагает похожие названия с учетом опечаток и раскладки.
+        """
+        if not self.directory.ready(kind):
+            results = await self.api.search(kind, name)
+            if kind == 'group':
+                results = self._filter_group_results(results, name)
+            return results, False
+
+        results = self.directory.lookup(kind, name, limit=10)
+        if results:
+            return results, False
+
+        matches = self.directory.suggest(kind, name, limit=10)
+        exact = [entry for entry, distance in matches if distance == 0]
+        if len(exact) == 1:
+            # "пи 22-1", "GB22-1" и т.п. однозначно совпали после нормализации
+            return exact, False
+        return [entry for entry, _ in matches], True
+
     async def process_group_input(self, message: Message, cursor: FSMCursor):
         """Обработка ввода названия группы"""
         name = message.body.text.strip()
-        await message.reply('Ищу группу...')
+        await self._send(message, 'Ищу группу...', reply=True)
 
         try:
-            results = self.api.search_group(name)
-
-            if not results:
-                kb = KeyboardBuilder()
-                kb.row(CallbackButton('📚 Ввести группу еще раз', payload='choose_another_group'))
-                kb.row(CallbackButton('🔙 Назад в меню', payload='main_menu'))
-
-                cursor.change_state(States.CHOOSING_DATE_RANGE)
-                await message.reply('Группа не найдена. Проверьте название.', keyboard=kb)
-                return
-
-            filtered_results = self._filter_group_results(results, name)
+            filtered_results, suggested = await self._find_entities('group', name)
 
             if not filtered_results:
                 kb = KeyboardBuilder()
@@ -302,10 +692,10 @@ class ScheduleBot:
                 kb.row(CallbackButton('🔙 Назад в меню', payload='main_menu'))
 
                 cursor.change_state(States.CHOOSING_DATE_RANGE)
-                await message.reply('Группа не найдена.', keyboard=kb)
+                await self._send(message, 'Группа не найдена. Проверьте название.', keyboard=kb, reply=True)
                 return
 
-            if len(filtered_results) == 1:
+            if len(filtered_results) == 1 and not suggested:
                 # одна группа найдена - сохроняем и идем к выбору даты
                 data = cursor.get_data() or {}
                 data['selected_id'] = filtered_results[0]['id']
@@ -315,16 +705,18 @@ class ScheduleBot:
             else:
                 # несколько групп - покажи список
                 kb = KeyboardBuilder()
-                for r in filtered_results[:10]:
+                shown = filtered_results[:10]
+                for r in shown:
                     kb.row(CallbackButton(r['label'], payload=f"select_group_{r['id']}"))
                 kb.row(CallbackButton('🔙 Назад в меню', payload='main_menu'))
 
-                data = cursor.get_data() or {}
-                data['search_results'] = filtered_results
-                cursor.change_data(data)
+                self._remember_choices(cursor, 'group', shown)
                 cursor.change_state(States.CHOOSING_DATE_RANGE)
 
-                await message.reply('Найдено несколько групп. Выберите:', keyboard=kb)
+                if suggested:
+                    await self._send(message, 'Группа не найдена. Возможно, вы имели в виду:', keyboard=kb, reply=True)
+                else:
+                    await self._send(message, 'Найдено несколько групп. Выберите:', keyboard=kb, reply=True)
 
         except Exception as e:
             logger.error(f'Ошибка при поиске группы: {e}')
@@ -333,15 +725,15 @@ class ScheduleBot:
             kb.row(CallbackButton('🔙 Назад в меню', payload='main_menu'))
 
             cursor.change_state(States.CHOOSING_DATE_RANGE)
-            await message.reply('Ошибка при поиске', keyboard=kb)
+            await self._send(message, 'Ошибка при поиске', keyboard=kb, reply=True)
 
     async def process_teacher_input(self, message: Message, cursor: FSMCursor):
         """Обработка ввода ФИО преподавателя"""
         name = message.body.text.strip()
-        await message.reply('Ищу преподавателя...')
+        await self._send(message, 'Ищу преподавателя...', reply=True)
 
         try:
-            results = self.api.search_teacher(name)
+            results, suggested = await self._find_entities('person', name)
 
             if not results:
                 kb = KeyboardBuilder()
@@ -349,10 +741,10 @@ class ScheduleBot:
                 kb.row(CallbackButton('🔙 Назад в меню', payload='main_menu'))
 
                 cursor.change_state(States.CHOOSING_DATE_RANGE)
-                await message.reply('Преподаватель не найден.', keyboard=kb)
+                await self._send(message, 'Преподаватель не найден.', keyboard=kb, reply=True)
                 return
 
-            if len(results) == 1:
+            if len(results) == 1 and not suggested:
                 # один препод найден
                 data = cursor.get_data() or {}
                 data['selected_id'] = results[0]['id']
@@ -362,16 +754,18 @@ class ScheduleBot:
             else:
                 # несколько преподов 
                 kb = KeyboardBuilder()
-                for r in results[:10]:
+                shown = results[:10]
+                for r in shown:
                     kb.row(CallbackButton(r['label'], payload=f"select_teacher_{r['id']}"))
                 kb.row(CallbackButton('🔙 Назад в меню', payload='main_menu'))
 
-                data = cursor.get_data() or {}
-                data['search_results'] = results
-                cursor.change_data(data)
+                self._remember_choices(cursor, 'person', shown)
                 cursor.change_state(States.CHOOSING_DATE_RANGE)
 
-                await message.reply('Найдено несколько преподавателей. Выберите:', keyboard=kb)
+                if suggested:
+                    await self._send(message, 'Преподаватель не найден. Возможно, вы имели в виду:', keyboard=kb, reply=True)
+                else:
+                    await self._send(message, 'Найдено несколько преподавателей. Выберите:', keyboard=kb, reply=True)
 
         except Exception as e:
             logger.error(f'Ошибка при поиске преподавателя: {e}')
@@ -380,55 +774,48 @@ class ScheduleBot:
             kb.row(CallbackButton('🔙 Назад в меню', payload='main_menu'))
 
             cursor.change_state(States.CHOOSING_DATE_RANGE)
-            await message.reply('Ошибка при поиске', keyboard=kb)
+            await self._send(message, 'Ошибка при поиске', keyboard=kb, reply=True)
 
     async def process_windows_input(self, message: Message, cursor: FSMCursor):
         """Обработка ввода группы для поиска окон"""
         name = message.body.text.strip()
-        await message.reply('Ищу группу...')
+        await self._send(message, 'Ищу группу...', reply=True)
 
         try:
-            results = self.api.search_group(name)
-
-            if not results:
-                kb = KeyboardBuilder()
-                kb.row(CallbackButton('🔙 Назад в меню', payload='main_menu'))
-                cursor.change_state(States.CHOOSING_DATE_RANGE)
-                await message.reply('Группа не найдена.', keyboard=kb)
-                return
-
-            filtered_results = self._filter_group_results(results, name)
+            filtered_results, suggested = await self._find_entities('group', name)
 
             if not filtered_results:
                 kb = KeyboardBuilder()
                 kb.row(CallbackButton('🔙 Назад в меню', payload='main_menu'))
                 cursor.change_state(States.CHOOSING_DATE_RANGE)
-                await message.reply('Группа не найдена.', keyboard=kb)
+                await self._send(message, 'Группа не найдена.', keyboard=kb, reply=True)
                 return
 
-            if len(filtered_results) == 1:
+            if len(filtered_results) == 1 and not suggested:
                 group_id = filtered_results[0]['id']
                 group_name = filtered_results[0]['label']
                 await self.find_and_show_windows_from_message(message, cursor, group_id, group_name)
             else:
                 kb = KeyboardBuilder()
-                for r in filtered_results[:10]:
+                shown = filtered_results[:10]
+                for r in shown:
                     kb.row(CallbackButton(r['label'], payload=f"select_windows_{r['id']}"))
                 kb.row(CallbackButton('🔙 Назад в меню', payload='main_menu'))
 
-                data = cursor.get_data() or {}
-                data['search_results'] = filtered_results
-                cursor.change_data(data)
+                self._remember_choices(cursor, 'group', shown)
                 cursor.change_state(States.CHOOSING_DATE_RANGE)
 
-                await message.reply('Найдено несколько групп. Выберите:', keyboard=kb)
+                if suggested:
+                    await self._send(message, 'Группа не найдена. Возможно, вы имели в виду:', keyboard=kb, reply=True)
+                else:
+                    await self._send(message, 'Найдено несколько групп. Выберите:', keyboard=kb, reply=True)
 
         except Exception as e:
             logger.error(f'Ошибка при поиске группы для окон: {e}')
             kb = KeyboardBuilder()
             kb.row(CallbackButton('🔙 Назад в меню', payload='main_menu'))
             cursor.change_state(States.CHOOSING_DATE_RANGE)
-            await message.reply('Ошибка при поиске', keyboard=kb)
+            await self._send(message, 'Ошибка при поиске', keyboard=kb, reply=True)
 
     async def ask_date_range(self, context, cursor: FSMCursor):
         """Показать выбор периода (context может быть Message или Callback)"""
@@ -441,9 +828,9 @@ class ScheduleBot:
         cursor.change_state(States.CHOOSING_DATE_RANGE)
 
         if isinstance(context, Callback):
-            await context.send('Выберите период:', keyboard=kb)
+            await self._send(context, 'Выберите период:', keyboard=kb)
         else:  
-            await context.reply('Выберите период:', keyboard=kb)
+            await self._send(context, 'Выберите период:', keyboard=kb, reply=True)
 
     async def show_schedule_with_date(self, callback: Callback, cursor: FSMCursor):
         """Показать расписание за выбранный период"""
@@ -465,52 +852,88 @@ class ScheduleBot:
             return
 
         data = cursor.get_data() or {}
+        data['page'] = [db, de, 0]
+        cursor.change_data(data)
+        await self._send_schedule_page(callback, data)
+
+    async def next_page(self, callback: Callback, cursor: FSMCursor):
+        """Следующая страница длинного расписания"""
+        data = cursor.get_data() or {}
+        if not data.get('page'):
+            await callback.answer(notification='Выберите период заново')
+            return
+        data['page'][2] += 1
+        cursor.change_data(data)
+        await callback.answer(notification=f"Страница {data['page'][2] + 1}")
+        await self._send_schedule_page(callback, data)
+
+    def _schedule_keyboard(self, etype, number, total):
+        """Клавиатура под страницей расписания"""
+        kb = KeyboardBuilder()
+        if number + 1 < total:
+            kb.row(CallbackButton(f'➡️ Далее ({number + 1}/{total})', payload='page_next'))
+        kb.row(CallbackButton('📅 Выбрать другой период', payload='date_reselect'))
+        kb.row(CallbackButton('🔔 Подписаться на изменения', payload='subscribe'))
+        kb.row(CallbackButton('📤 Экспорт в календарь', payload='calendar'))
+        if etype == 'group':
+            kb.row(CallbackButton('📚 Выбрать другую группу', payload='choose_another_group'))
+        else:
+            kb.row(CallbackButton('👨‍🏫 Выбрать другого преподавателя', payload='choose_another_teacher'))
+        kb.row(CallbackButton('🔙 Назад в меню', payload='main_menu'))
+        return kb
+
+    async def _send_schedule_page(self, callback: Callback, data):
+        """Отправляет одну страницу расписания из data['page'] = [начало, конец, номер]
+
+        Расписание берется из кэша, текст - из кэша рендера, а собирается
+        только запрошенная страница.
+        """
         etype = data.get('type')
         eid = data.get('selected_id')
         ename = data.get('selected_name')
+        db, de, number = data['page']
 
         try:
             if etype == 'group':
-                schedule_data = self.api.timetable_group(eid, db, de)
-                text = self._format_group(ename, schedule_data)
-                kb = KeyboardBuilder()
-                kb.row(CallbackButton('📅 Выбрать другой период', payload='date_reselect'))
-                kb.row(CallbackButton('📚 Выбрать другую группу', payload='choose_another_group'))
-                kb.row(CallbackButton('🔙 Назад в меню', payload='main_menu'))
+                kind = 'group'
+                if number == 0:
+                    self._track_request(kind, eid, db, de)
+                schedule_data = await self.api.timetable_group(eid, db, de)
 
             elif etype == 'teacher':
-                schedule_data = self.api.timetable_teacher(eid, db, de)
-                text = self._format_teacher(ename, schedule_data)
-                kb = KeyboardBuilder()
-                kb.row(CallbackButton('📅 Выбрать другой период', payload='date_reselect'))
-                kb.row(CallbackButton('👨‍🏫 Выбрать другого преподавателя', payload='choose_another_teacher'))
-                kb.row(CallbackButton('🔙 Назад в меню', payload='main_menu'))
+                kind = 'person'
+                if number == 0:
+                    self._track_request(kind, eid, db, de)
+                # из расписаний групп в памяти, если там есть все; иначе - из
+                # зеркала или РУЗ
+                schedule_data = self.lessons.timetable(kind, eid, db, de)
+                if schedule_data is None:
+                    schedule_data = await self.api.timetable_teacher(eid, db, de)
 
             else:
                 kb = KeyboardBuilder()
                 kb.row(CallbackButton('🔙 Назад в меню', payload='main_menu'))
-                await callback.send('Ошибка: неизвестный тип', keyboard=kb)
+                await self._send(callback, 'Ошибка: неизвестный тип', keyboard=kb)
                 return
 
-            if len(text) > 4000:
-                parts = [text[i:i+4000] for i in range(0, len(text), 4000)]
-                for i, p in enumerate(parts):
-                    if i == len(parts) - 1:
-                        await callback.send(p, keyboard=kb)
-                    else:
-                        await callback.send(p)
-            else:
-                await callback.send(text, keyboard=kb)
+            rendered = self.renders.render(kind, eid, ename, schedule_data, db, de)
+            pages = Pages(rendered, SCHEDULE_PAGE_LIMIT)
+            number = min(number, len(pages) - 1)
+            text = pages[number]
+            if number == 0:
+                text = self._freshness_note(schedule_data) + text
+            kb = self._schedule_keyboard(etype, number, len(pages))
+            await self._send(callback, text, keyboard=kb)
 
         except Exception as e:
             logger.error(f'Ошибка при получении расписания: {e}')
             kb = KeyboardBuilder()
             kb.row(CallbackButton('🔙 Назад в меню', payload='main_menu'))
-            await callback.send('Ошибка при получении расписания', keyboard=kb)
+            await self._send(callback, 'Ошибка при получении расписания', keyboard=kb)
 
     async def find_and_show_windows_from_message(self, message: Message, cursor: FSMCursor, group_id, group_name):
         """Поиск и показ окон (вызов из Message)"""
-        await message.reply(f'🔍 Ищу свободные окна для группы {group_name} на предстоящей неделе...')
+        await self._send(message, f'🔍 Ищу свободные окна для группы {group_name} на предстоящей неделе...', reply=True)
 
         try:
             today = datetime.now()
@@ -519,37 +942,38 @@ class ScheduleBot:
             date_begin = start_of_next_week.strftime('%Y.%m.%d')
             date_end = end_of_next_week.strftime('%Y.%m.%d')
 
-            data = self.api.timetable_group(group_id, date_begin, date_end)
+            self._track_request('group', group_id, date_begin, date_end)
+            data = await self.api.timetable_group(group_id, date_begin, date_end)
 
             kb = KeyboardBuilder()
             kb.row(CallbackButton('🔙 Назад в меню', payload='main_menu'))
 
             if not data:
                 cursor.change_state(States.CHOOSING_DATE_RANGE)
-                await message.reply('На предстоящей неделе занятий не найдено.', keyboard=kb)
+                await self._send(message, 'На предстоящей неделе занятий не найдено.', keyboard=kb, reply=True)
                 return
 
             windows = self._find_windows_in_schedule(data)
 
             if not windows:
                 cursor.change_state(States.CHOOSING_DATE_RANGE)
-                await message.reply('✅ Свободных окон не найдено.', keyboard=kb)
+                await self._send(message, '✅ Свободных окон не найдено.', keyboard=kb, reply=True)
                 return
 
-            result_text = self._format_windows(group_name, windows)
+            result_text = self._freshness_note(data) + self._format_windows(group_name, windows)
             cursor.change_state(States.CHOOSING_DATE_RANGE)
-            await message.reply(result_text, keyboard=kb)
+            await self._send(message, result_text, keyboard=kb, reply=True)
 
         except Exception as e:
             logger.error(f'Ошибка при поиске окон: {e}')
             kb = KeyboardBuilder()
             kb.row(CallbackButton('🔙 Назад в меню', payload='main_menu'))
             cursor.change_state(States.CHOOSING_DATE_RANGE)
-            await message.reply('Ошибка при поиске окон', keyboard=kb)
+            await self._send(message, 'Ошибка при поиске окон', keyboard=kb, reply=True)
 
     async def find_and_show_windows(self, callback: Callback, cursor: FSMCursor, group_id, group_name):
         """Поиск и показ окон (вызов из Callback)"""
-        await callback.send(f'🔍 Ищу свободные окна для группы {group_name} на предстоящей неделе...')
+        await self._send(callback, f'🔍 Ищу свободные окна для группы {group_name} на предстоящей неделе...')
 
         try:
             today = datetime.now()
@@ -558,76 +982,408 @@ class ScheduleBot:
             date_begin = start_of_next_week.strftime('%Y.%m.%d')
             date_end = end_of_next_week.strftime('%Y.%m.%d')
 
-            data = self.api.timetable_group(group_id, date_begin, date_end)
+            self._track_request('group', group_id, date_begin, date_end)
+            data = await self.api.timetable_group(group_id, date_begin, date_end)
 
             kb = KeyboardBuilder()
             kb.row(CallbackButton('🔙 Назад в меню', payload='main_menu'))
 
             if not data:
                 cursor.change_state(States.CHOOSING_DATE_RANGE)
-                await callback.send('На предстоящей неделе занятий не найдено.', keyboard=kb)
+                await self._send(callback, 'На предстоящей неделе занятий не найдено.', keyboard=kb)
                 return
 
             windows = self._find_windows_in_schedule(data)
 
             if not windows:
                 cursor.change_state(States.CHOOSING_DATE_RANGE)
-                await callback.send('✅ Свободных окон не найдено.', keyboard=kb)
+                await self._send(callback, '✅ Свободных окон не найдено.', keyboard=kb)
                 return
 
-            result_text = self._format_windows(group_name, windows)
+            result_text = self._freshness_note(data) + self._format_windows(group_name, windows)
             cursor.change_state(States.CHOOSING_DATE_RANGE)
-            await callback.send(result_text, keyboard=kb)
+            await self._send(callback, result_text, keyboard=kb)
 
         except Exception as e:
             logger.error(f'Ошибка при поиске окон: {e}')
             kb = KeyboardBuilder()
             kb.row(CallbackButton('🔙 Назад в меню', payload='main_menu'))
             cursor.change_state(States.CHOOSING_DATE_RANGE)
-            await callback.send('Ошибка при поиске окон', keyboard=kb)
+            await self._send(callback, 'Ошибка при поиске окон', keyboard=kb)
 
-    def _find_windows_in_schedule(self, data):
-        """Найти окна в расписании"""
-        by_date = {}
-        for lesson in data:
-            date_key = lesson.get('date', '?')
-            if date_key not in by_date:
-                by_date[date_key] = []
-            by_date[date_key].append(lesson)
+    async def common_start(self, context, cursor: FSMCursor):
+        """Начало поиска общего свободного времени (команда или кнопка)"""
+        cursor.change_data({'type': 'common'})
+        cursor.change_state(States.ENTERING_COMMON)
+        text = (
+            'Введите через запятую группы и преподавателей '
+            f'(до {COMMON_MAX_ENTITIES}), например: ПИ22-1, ПИ22-2, Иванов И.И.'
+        )
+        if isinstance(context, Callback):
+            await context.answer(text=text)
+        else:
+            await self._send(context, text, reply=True)
+
+    async def _resolve_entity(self, name):
+        """Группа или преподаватель по названию: (kind, найденные) или None"""
+        for kind in ('group', 'person'):
+            results, suggested = await self._find_entities(kind, name)
+            if results and not suggested:
+                return kind, results
+        return None
+
+    async def process_common_input(self, message: Message, cursor: FSMCursor):
+        """Обработка списка групп и преподавателей для общего свободного времени"""
+        names = [n.strip() for n in re.split(r'[,;\n]', message.body.text) if n.strip()]
+        kb = KeyboardBuilder()
+        kb.row(CallbackButton('🔙 Назад в меню', payload='main_menu'))
+        if not 2 <= len(names) <= COMMON_MAX_ENTITIES:
+            await self._send(message, f'Нужно от 2 до {COMMON_MAX_ENTITIES} названий через запятую.', keyboard=kb, reply=True)
+            return
 
-        windows = []
+        try:
+            resolved = await asyncio.gather(*[self._resolve_entity(n) for n in names])
+        except Exception as e:
+            logger.error(f'Ошибка при поиске для общего времени: {e}')
+            await self._send(message, 'Ошибка при поиске', keyboard=kb, reply=True)
+            return
+
+        missing = [n for n, found in zip(names, resolved) if found is None]
+        if missing:
+            await self._send(message, 'Не найдены: ' + ', '.join(escape(n) for n in missing), keyboard=kb, reply=True)
+            return
+
+        # неоднозначное название остается без id, пока пользователь не выберет вариант
+        entities = [
+            [kind, str(results[0]['id']), results[0]['label']] if len(results) == 1 else [kind, None, name]
+            for name, (kind, results) in zip(names, resolved)
+        ]
+        cursor.change_data({'type': 'common', 'common': entities})
+        await self._ask_common_next(message, cursor)
+
+    async def _ask_common_next(self, context, cursor: FSMCursor):
+        """Уточнить следующее неоднозначное название или показать выбор периода"""
+        reply = not isinstance(context, Callback)
+        entities = (cursor.get_data() or {}).get('common') or []
+        cursor.change_state(States.CHOOSING_DATE_RANGE)
+        pending = next((e for e in entities if e[1] is None), None)
+        if pending is not None:
+            kind, _, name = pending
+            results, _ = await self._find_entities(kind, name)
+            shown = results[:10]
+            kb = KeyboardBuilder()
+            for r in shown:
+                kb.row(CallbackButton(r['label'], payload=f"select_common_{kind}_{r['id']}"))
+            kb.row(CallbackButton('🔙 Назад в меню', payload='main_menu'))
+            self._remember_choices(cursor, kind, shown)
+            await self._send(context, f'По запросу «{escape(name)}» найдено несколько вариантов. Выберите:', keyboard=kb, reply=reply)
+            return
+
+        kb = KeyboardBuilder()
+        kb.row(CallbackButton('📋 Текущая неделя', payload='common_week'))
+        kb.row(CallbackButton('📅 Следующая неделя', payload='common_next_week'))
+        kb.row(CallbackButton('🗓 Месяц', payload='common_month'))
+        kb.row(CallbackButton('🔙 Назад в меню', payload='main_menu'))
+        labels = ', '.join(escape(label) for _, _, label in entities)
+        await self._send(context, f'Ищу общее время для: {labels}\n\nВыберите период:', keyboard=kb, reply=reply)
 
-        for date_str, lessons in sorted(by_date.items()):
-            sorted_lessons = sorted(lessons, key=lambda x: x.get('beginLesson', ''))
+    async def show_common_free(self, callback: Callback, cursor: FSMCursor):
+        """Общее свободное время выбранных групп и преподавателей"""
+        data = cursor.get_data() or {}
+        entities = data.get('common')
+        # кнопка периода из старого сообщения, пока не все названия уточнены
+        if not entities or any(eid is None for _, eid, _ in entities):
+            await callback.answer(notification='Введите группы заново')
+            return
+        await callback.answer(notification='Ищу общее свободное время...')
+
+        now = datetime.now()
+        today = now.date()
+        if callback.payload == 'common_week':
+            db, de = today, today + timedelta(days=6 - today.weekday())
+        elif callback.payload == 'common_next_week':
+            db = today + timedelta(days=7 - today.weekday())
+            de = db + timedelta(days=6)
+        else:
+            db, de = today, today + timedelta(days=30)
 
-            for i in range(len(sorted_lessons) - 1):
-                current_lesson = sorted_lessons[i]
-                next_lesson = sorted_lessons[i + 1]
+        kb = KeyboardBuilder()
+        kb.row(CallbackButton('👥 Другие группы', payload='common'))
+        kb.row(CallbackButton('🔙 Назад в меню', payload='main_menu'))
+
+        try:
+            slots, failed = await find_common_free(
+                self.api, [(kind, eid) for kind, eid, _ in entities], db, de,
+                min_minutes=COMMON_MIN_MINUTES,
+            )
+        except Exception as e:
+            logger.error(f'Ошибка при поиске общего времени: {e}')
+            await self._send(callback, 'Ошибка при получении расписания', keyboard=kb)
+            return
+
+        # сегодняшние промежутки, которые уже прошли, не нужны
+        elapsed = now.hour * 60 + now.minute
+        slots = [
+            s for s in slots
+            if s.day != today.toordinal() or s.end - max(s.start, elapsed) >= COMMON_MIN_MINUTES
+        ]
+
+        header = (
+            '<b>👥 Общее свободное время</b>\n'
+            + ', '.join(escape(label) for _, _, label in entities) + '\n'
+            + f'<i>Не короче {self._format_duration(COMMON_MIN_MINUTES)}, '
+            + f'с {hhmm(DAY_START)} до {hhmm(DAY_END)}</i>\n\n'
+        )
+        if failed:
+            skipped = ', '.join(escape(label) for kind, eid, label in entities if (kind, eid) in failed)
+            header += f'⚠️ Не удалось загрузить расписание: {skipped}. Время найдено без учета их занятий.\n\n'
 
+        if not slots:
+            await self._send(callback, header + 'Общего свободного времени не найдено.', keyboard=kb)
+            return
+
+        blocks = []
+        for day, items in groupby(slots, key=lambda s: s.day):
+            parts = [f'<b>📆 {day_label(day)}</b>\n']
+            parts.extend(f'⏰ {s.label} ({self._format_duration(s.minutes)})\n' for s in items)
+            parts[-1] += '\n'
+            blocks.append(tuple(parts))
+
+        pages = Pages(Rendered(header, tuple(blocks)))
+        for number, page in enumerate(pages):
+            if number == len(pages) - 1:
+                await self._send(callback, page, keyboard=kb)
+            else:
+                await self._send(callback, page)
+
+    async def rooms_start(self, context, cursor: FSMCursor):
+        """Начало поиска свободных аудиторий (команда или кнопка)"""
+        cursor.change_data({'type': 'rooms'})
+        cursor.change_state(States.ENTERING_BUILDING)
+        text = 'Введите адрес или название здания (например, Ленинградский пр-т, 49):'
+        if isinstance(context, Callback):
+            await context.answer(text=text)
+        else:
+            await self._send(context, text, reply=True)
+
+    async def process_building_input(self, message: Message, cursor: FSMCursor):
+        """Обработка ввода здания для поиска свободных аудиторий"""
+        name = message.body.text.strip()
+        kb = KeyboardBuilder()
+        kb.row(CallbackButton('🏫 Ввести здание еще раз', payload='rooms'))
+        kb.row(CallbackButton('🔙 Назад в меню', payload='main_menu'))
+
+        try:
+            results, suggested = await self._find_entities('building', name)
+        except Exception as e:
+            logger.error(f'Ошибка при поиске здания: {e}')
+            cursor.change_state(States.CHOOSING_DATE_RANGE)
+            await self._send(message, 'Ошибка при поиске', keyboard=kb, reply=True)
+            return
+
+        if not results:
+            cursor.change_state(States.CHOOSING_DATE_RANGE)
+            await self._send(message, 'Здание не найдено. Проверьте адрес.', keyboard=kb, reply=True)
+            return
+
+        if len(results) == 1 and not suggested:
+            data = cursor.get_data() or {}
+            data['building'] = [str(results[0]['id']), results[0]['label']]
+            cursor.change_data(data)
+            await self.ask_room_time(message, cursor)
+            return
+
+        kb = KeyboardBuilder()
+        shown = results[:10]
+        for r in shown:
+            kb.row(CallbackButton(r['label'], payload=f"select_building_{r['id']}"))
+        kb.row(CallbackButton('🔙 Назад в меню', payload='main_menu'))
+
+        self._remember_choices(cursor, 'building', shown)
+        cursor.change_state(States.CHOOSING_DATE_RANGE)
+        if suggested:
+            await self._send(message, 'Здание не найдено. Возможно, вы имели в виду:', keyboard=kb, reply=True)
+        else:
+            await self._send(message, 'Найдено несколько зданий. Выберите:', keyboard=kb, reply=True)
+
+    async def ask_room_time(self, context, cursor: FSMCursor):
+        """Выбор пары или ввод промежутка (context может быть Message или Callback)"""
+        data = cursor.get_data() or {}
+        kb = KeyboardBuilder()
+        kb.row(CallbackButton('⏱ Сейчас', payload='rooms_now'))
+        buttons = [
+            CallbackButton(f'{n} пара, {hhmm(begin)}', payload=f'rooms_pair_{n}')
+            for n, (begin, _) in enumerate(PAIRS, 1)
+        ]
+        for i in range(0, len(buttons), 2):
+            kb.row(*buttons[i:i + 2])
+        kb.row(CallbackButton('🔙 Назад в меню', payload='main_menu'))
+
+        cursor.change_state(States.ENTERING_ROOM_TIME)
+        text = (
+            f'🏫 {escape(data["building"][1])}\n\n'
+            'Выберите пару на сегодня или введите промежуток, '
+            'например 14:00-15:30 или завтра 10:10-13:20'
+        )
+        if isinstance(context, Callback):
+            await self._send(context, text, keyboard=kb)
+        else:
+            await self._send(context, text, keyboard=kb, reply=True)
+
+    async def show_free_rooms(self, callback: Callback, cursor: FSMCursor):
+        """Свободные аудитории на выбранную пару или прямо сейчас"""
+        data = cursor.get_data() or {}
+        if not data.get('building'):
+            await callback.answer(notification='Введите здание заново')
+            return
+
+        now = datetime.now()
+        if callback.payload == 'rooms_now':
+            start = now.hour * 60 + now.minute
+            end = start + 1
+        else:
+            try:
+                start, end = PAIRS[int(callback.payload.rsplit('_', 1)[1]) - 1]
+            except (ValueError, IndexError):
+                return
+        await callback.answer(notification='Ищу свободные аудитории...')
+        await self._send_free_rooms(callback, data, now.date(), start, end)
+
+    async def process_room_time_input(self, message: Message, cursor: FSMCursor):
+        """Обработка промежутка, введенного текстом"""
+        data = cursor.get_data() or {}
+        match = ROOM_TIME_RE.match(message.body.text.strip())
+        start = end = None
+        if match:
+            h1, m1, h2, m2 = (int(g) for g in match.groups()[1:])
+            if h1 < 24 and h2 < 24 and m1 < 60 and m2 < 60:
+                start, end = h1 * 60 + m1, h2 * 60 + m2
+        if not data.get('building') or start is None or start >= end:
+            await self._send(message, 'Не понял промежуток. Пример: 14:00-15:30 или завтра 10:10-13:20', reply=True)
+            return
+
+        day = date.today() + timedelta(days=1 if match.group(1) else 0)
+        await self._send_free_rooms(message, data, day, start, end)
+
+    async def _send_free_rooms(self, context, data, day, start, end):
+        """Ответ со списком аудиторий здания, свободных весь промежуток"""
+        building_id, building_name = data['building']
+        kb = KeyboardBuilder()
+        kb.row(CallbackButton('🏫 Другое здание', payload='rooms'))
+        kb.row(CallbackButton('🔙 Назад в меню', payload='main_menu'))
+
+        try:
+            free = await self.rooms.free_rooms(building_id, day, start, end)
+        except Exception as e:
+            logger.error(f'Ошибка при поиске свободных аудиторий: {e}')
+            await self._send(context, 'Ошибка при получении расписания здания', keyboard=kb)
+            return
+
+        when = f'сейчас, {hhmm(start)}' if end - start == 1 else f'{hhmm(start)} - {hhmm(end)}'
+        header = (
+            '<b>🏫 Свободные аудитории</b>\n'
+            f'{escape(building_name)}\n'
+            f'{day_label(day.toordinal())}, {when}\n\n'
+        )
+        if not free:
+            await self._send(context, header + 'Свободных аудиторий не найдено.', keyboard=kb)
+            return
+
+        lines = tuple(f'🚪 {escape(label)}\n' for _, label in free)
+        pages = Pages(Rendered(header, (('',) + lines,)))
+        for number, page in enumerate(pages):
+            if number == len(pages) - 1:
+                await self._send(context, page, keyboard=kb)
+            else:
+                await self._send(context, page)
+
+    async def export_menu(self, context, cursor: FSMCursor):
+        """Выбор периода для выгрузки открытого расписания в .ics"""
+        selected = self._selected_entity(cursor)
+        kb = KeyboardBuilder()
+        if selected is None:
+            kb.row(CallbackButton('📅 Открыть расписание', payload='main_menu'))
+            await self._send(context, 'Сначала откройте расписание группы или преподавателя.', keyboard=kb)
+            return
+
+        kb.row(CallbackButton('📅 До конца семестра', payload='export_rest'))
+        kb.row(CallbackButton('🗓 Весь семестр', payload='export_semester'))
+        kb.row(CallbackButton('📋 4 недели', payload='export_month'))
+        kb.row(CallbackButton('🔙 Назад в меню', payload='main_menu'))
+        text = (
+            f'📤 Расписание {escape(selected[2])} в календарь (.ics)\n\n'
+            'Файл импортируется в Google, Apple или Яндекс Календарь; '
+            'повторный импорт обновит уже добавленные занятия.'
+        )
+        await self._send(context, text, keyboard=kb)
+
+    async def export_ics(self, callback: Callback, cursor: FSMCursor):
+        """Выгрузка открытого расписания в .ics и отправка файлом"""
+        selected = self._selected_entity(cursor)
+        if selected is None:
+            await callback.answer(notification='Сначала откройте расписание')
+            return
+        kind, eid, name = selected
+
+        today = date.today()
+        semester_first, semester_last = semester(today)
+        if callback.payload == 'export_rest':
+            first, last = today, max(today, semester_last)
+        elif callback.payload == 'export_semester':
+            first, last = semester_first, semester_last
+        elif callback.payload == 'export_month':
+            first, last = today, today + timedelta(days=27)
+        else:
+            return
+        await callback.answer(notification='Готовлю файл...')
+
+        kb = KeyboardBuilder()
+        kb.row(CallbackButton('🔙 Назад в меню', payload='main_menu'))
+        # недели пишутся в файл по мере загрузки, весь семестр в памяти не собирается
+        async with self._exports:
+            with tempfile.TemporaryDirectory() as tmp:
+                path = os.path.join(tmp, filename(name, first, last))
                 try:
-                    end_time_str = current_lesson.get('endLesson', '')
-                    begin_time_str = next_lesson.get('beginLesson', '')
-
-                    if not end_time_str or not begin_time_str:
-                        continue
-
-                    end_time = datetime.strptime(end_time_str, '%H:%M')
-                    begin_time = datetime.strptime(begin_time_str, '%H:%M')
-
-                    gap_minutes = int((begin_time - end_time).total_seconds() / 60)
-
-                    if gap_minutes > 45:
-                        windows.append({
-                            'date': date_str,
-                            'start': end_time_str,
-                            'end': begin_time_str,
-                            'duration': gap_minutes,
-                            'before_lesson': current_lesson.get('discipline', 'Занятие'),
-                            'after_lesson': next_lesson.get('discipline', 'Занятие')
-                        })
+                    await write_ics(path, calendar(self.api, kind, eid, name, first, last))
+                    with open(path, 'rb') as f:
+                        attachment = await self.bot.upload_file(f, os.path.basename(path))
                 except Exception as e:
-                    logger.error(f'Error calculating window: {e}')
-                    continue
+                    logger.error(f'Ошибка выгрузки в календарь: {e}')
+                    await self._send(callback, 'Не удалось выгрузить расписание', keyboard=kb)
+                    return
+
+        text = f'📤 {escape(name)}: {first:%d.%m.%Y} - {last:%d.%m.%Y}'
+        await self._send(callback, text, keyboard=kb, attachments=[attachment])
+
+    def _find_windows_in_schedule(self, data):
+        """Найти окна в расписании"""
+        busy = busy_masks(data)
+        if not busy:
+            return []
+        slots = free_slots(
+            busy,
+            date.fromordinal(min(busy)),
+            date.fromordinal(max(busy)),
+            min_minutes=WINDOW_MIN_MINUTES,
+            weekdays=None,
+            between_lessons=True,
+        )
+
+        days = dict(by_day(data))
+        windows = []
+        for slot in slots:
+            lessons = days[slot.day]
+            before = next(l for l in reversed(lessons) if l.end == slot.start)
+            after = next(l for l in lessons if l.begin == slot.end)
+            windows.append({
+                'day': slot.day,
+                'date': before.date,
+                'start': before.end_lesson,
+                'end': after.begin_lesson,
+                'duration': slot.minutes,
+                'before_lesson': before.discipline or 'Занятие',
+                'after_lesson': after.discipline or 'Занятие'
+            })
 
         return windows
 
@@ -636,113 +1392,52 @@ class ScheduleBot:
         r = f'<b>🔍 Свободные окна для группы {group_name}</b>\n\n'
         r += f'Найдено окон: {len(windows)}\n\n'
 
-        wd = ['Понедельник', 'Вторник', 'Среда', 'Четверг', 'Пятница', 'Суббота', 'Воскресенье']
-
         for window in windows:
-            try:
-                date_obj = datetime.strptime(window['date'], '%Y.%m.%d')
-                formatted_date = f"{wd[date_obj.weekday()]}, {date_obj.strftime('%d.%m.%Y')}"
-            except:
-                formatted_date = window['date']
-
-            hours = window['duration'] // 60
-            minutes = window['duration'] % 60
-            duration_str = ''
-            if hours > 0:
-                duration_str += f"{hours} ч "
-            duration_str += f"{minutes} мин"
+            formatted_date = day_label(window['day']) if window['day'] > 0 else window['date']
 
             r += f'<b>📆 {formatted_date}</b>\n'
             r += f'⏰ Время: {window["start"]} - {window["end"]}\n'
-            r += f'⏱ Длительность: {duration_str}\n'
+            r += f'⏱ Длительность: {self._format_duration(window["duration"])}\n'
             r += f'📚 После: {window["before_lesson"]}\n'
             r += f'📚 До: {window["after_lesson"]}\n'
             r += '\n' + '─' * 36 + '\n\n'
 
         return r
 
-    def _format_group(self, name, data):
-        """Форматирование расписания группы"""
-        r = f'<b>📅 Расписание группы {name}</b>\n\n'
-        if not data:
-            return r + 'Занятий не найдено'
-
-        by_date = {}
-        for l in data:
-            d = l.get('date', '?')
-            if d not in by_date:
-                by_date[d] = []
-            by_date[d].append(l)
-
-        wd = ['Понедельник', 'Вторник', 'Среда', 'Четверг', 'Пятница', 'Суббота', 'Воскресенье']
-        for ds, ls in sorted(by_date.items()):
-            try:
-                do = datetime.strptime(ds, '%Y.%m.%d')
-                fd = f"{wd[do.weekday()]}, {do.strftime('%d.%m.%Y')}"
-            except:
-                fd = ds
-            r += f'<b>📆 {fd}</b>\n'
-            for l in sorted(ls, key=lambda x: x.get('beginLesson', '')):
-                r += f"\n⏰ {l.get('beginLesson', '')} - {l.get('endLesson', '')}\n"
-                r += f"📚 <b>{l.get('discipline', 'Без названия')}</b>"
-                if l.get('kindOfWork'):
-                    r += f" ({l['kindOfWork']})"
-                r += f"\n👨‍🏫 {l.get('lecturer', 'Преподаватель не указан')}\n"
-                r += f"🏢 {l.get('auditorium', 'Аудитория не указана')}\n"
-            r += '\n' + '─' * 36 + '\n\n'
-        return r
-
-    def _format_teacher(self, name, data):
-        """Форматирование расписания преподавателя"""
-        r = f'<b>👨‍🏫 Расписание преподавателя {name}</b>\n'
-
-        if data and len(data) > 0:
-            first_lesson = data[0]
-            email = first_lesson.get('email') or first_lesson.get('lecturerEmail')
-            if email:
-                r += f'📧 Email: {email}\n'
-
-        r += '\n'
-
-        if not data:
-            return r + 'Занятий не найдено'
-
-        by_date = {}
-        for l in data:
-            d = l.get('date', '?')
-            if d not in by_date:
-                by_date[d] = []
-            by_date[d].append(l)
-
-        wd = ['Понедельник', 'Вторник', 'Среда', 'Четверг', 'Пятница', 'Суббота', 'Воскресенье']
-        for ds, ls in sorted(by_date.items()):
-            try:
-                do = datetime.strptime(ds, '%Y.%m.%d')
-                fd = f"{wd[do.weekday()]}, {do.strftime('%d.%m.%Y')}"
-            except:
-                fd = ds
-            r += f'<b>📆 {fd}</b>\n'
-            for l in sorted(ls, key=lambda x: x.get('beginLesson', '')):
-                r += f"\n⏰ {l.get('beginLesson', '')} - {l.get('endLesson', '')}\n"
-                r += f"📚 <b>{l.get('discipline', 'Без названия')}</b>"
-                if l.get('kindOfWork'):
-                    r += f" ({l['kindOfWork']})"
-
-                group_info = l.get('stream') or l.get('group')
-                if group_info:
-                    r += f"\n👥 Группа: {group_info}\n"
-                else:
-                    r += '\n'
+    def _format_duration(self, minutes):
+        """90 -> '1 ч 30 мин'"""
+        hours = minutes // 60
+        duration_str = ''
+        if hours > 0:
+            duration_str += f"{hours} ч "
+        duration_str += f"{minutes % 60} мин"
+        return duration_str
+
+    def _freshness_note(self, data):
+        """Пометка для расписания, отданного из кэша, пока РУЗ обновляется или недоступен"""
+        if not getattr(data, 'stale', False):
+            return ''
+        age = int(data.age // 60)
+        if age < 60:
+            ago = f'{age} мин'
+        elif age < 24 * 60:
+            ago = f'{age // 60} ч'
+        else:
+            ago = f'{age // (24 * 60)} дн'
+        return f'<i>🕓 Обновлено {ago} назад</i>\n\n'
 
-                r += f"🏢 {l.get('auditorium', 'Аудитория не указана')}\n"
-            r += '\n' + '─' * 36 + '\n\n'
-        return r
+    async def _polling(self):
+        """Long polling с корректным закрытием сессии РУЗ"""
+        try:
+            await self.bot.start_polling()
+        finally:
+            await self.on_shutdown()
 
     def run(self):
         """Запуск бота"""
         logger.info('Запуск бота...')
         try:
-            self.bot.run()
+            asyncio.run(self._polling())
         except KeyboardInterrupt:
             logger.info('Бот остановлен')
         except Exception as e:
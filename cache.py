@@ -0,0 +1,321 @@
+import asyncio
+import logging
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date
+from typing import Any
+from typing import Dict
+from typing import Hashable
+from typing import List
+from typing import Optional
+from typing import Tuple
+
+logger = logging.getLogger(__name__)
+
+MISSING = object()
+
+
+class TTLCache:
+    """LRU-кэш ограниченного размера с TTL на каждую запись
+
+    Потокобезопасен: синхронный FaAPI может вызываться из пула потоков.
+    """
+
+    def __init__(self, maxsize: int = 4096):
+        self.maxsize = maxsize
+        self._data: "OrderedDict[Hashable, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return self.get(key, count=False) is not MISSING
+
+    def get(self, key: Hashable, default: Any = MISSING, count: bool = True) -> Any:
+        """Отдает значение по ключу или default, если его нет или оно протухло"""
+
+        with self._lock:
+            item = self._data.get(key)
+            if item is not None:
+                expires, value = item
+                if expires > time.monotonic():
+                    self._data.move_to_end(key)
+                    if count:
+                        self.hits += 1
+                    return value
+                del self._data[key]
+                self.expirations += 1
+            if count:
+                self.misses += 1
+            return default
+
+    def set(self, key: Hashable, value: Any, ttl: float):
+        """Кладет значение на ttl секунд, вытесняя самые старые записи"""
+
+        with self._lock:
+            self._data[key] = (time.monotonic() + ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def pop(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            item = self._data.pop(key, None)
+        return default if item is None else item[1]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self) -> Dict[str, int]:
+        """Счетчики попаданий, промахов и вытеснений"""
+
+        return {
+            "size": len(self._data),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+        }
+
+
+class DayCache:
+    """Кэш расписаний по дням: (тип, id, день) -> список занятий этого дня
+
+    Пустой день тоже хранится: это значит "занятий нет", а не "не знаем".
+    Свежесть проверяется при чтении по времени загрузки записи. Если задан
+    store (TimetableStore), дни пишутся на диск и при промахе в памяти
+    лениво поднимаются оттуда вместе с исходным временем загрузки. Если
+    задан index (LessonIndex), он получает каждый попавший в кэш день.
+
+    С write_behind=True запись на диск уходит в отдельный поток (по
+    порядку, одна за другой), а put_days и touch меняют только память:
+    так их можно звать из event loop. Читать диск из корутин - через
+    entries_async; close() дожидается несохраненных записей.
+    """
+
+    def __init__(
+        self,
+        maxsize: int = 65536,
+        store=None,
+        index=None,
+        write_behind: bool = False,
+    ):
+        self.maxsize = maxsize
+        self.store = store
+        self.index = index
+        self._data: "OrderedDict[tuple, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._writer: Optional[ThreadPoolExecutor] = None
+        if write_behind and store is not None:
+            self._writer = ThreadPoolExecutor(1, thread_name_prefix="daycache-store")
+        self.hits = 0
+        self.misses = 0
+        self.loaded = 0
+        self.evictions = 0
+        self.write_errors = 0
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def _from_memory(
+        self, kind: str, entity_id: str, days: List[date]
+    ) -> Dict[date, Tuple[float, list]]:
+        found = {}
+        with self._lock:
+            for day in days:
+                key = (kind, entity_id, day)
+                item = self._data.get(key)
+                if item is not None:
+                    self._data.move_to_end(key)
+                    found[day] = item
+        return found
+
+    def _from_disk(
+        self, kind: str, entity_id: str, from_disk: Dict[date, Tuple[float, list]]
+    ):
+        """Кладет поднятые с диска дни в память и в индекс"""
+
+        with self._lock:
+            for day, item in from_disk.items():
+                self._data[(kind, entity_id, day)] = item
+            self._evict()
+        self.loaded += len(from_disk)
+        if self.index is not None:
+            self.index.update(kind, entity_id, from_disk)
+
+    def _count(self, found: Dict, days: List[date], count: bool):
+        if count:
+            self.hits += len(found)
+            self.misses += len(days) - len(found)
+
+    def entries(
+        self,
+        kind: str,
+        entity_id: str,
+        days: List[date],
+        count: bool = True,
+        load: bool = True,
+    ) -> Dict[date, Tuple[float, list]]:
+        """Известные дни любой давности: день -> (время загрузки, занятия)
+
+        load=False - только память, без чтения с диска.
+        """
+
+        found = self._from_memory(kind, entity_id, days)
+        missing = [day for day in days if day not in found]
+        if missing and load and self.store is not None:
+            from_disk = self.store.load_days(kind, entity_id, missing)
+            if from_disk:
+                self._from_disk(kind, entity_id, from_disk)
+                found.update(from_disk)
+        self._count(found, days, count)
+        return found
+
+    async def entries_async(
+        self, kind: str, entity_id: str, days: List[date], count: bool = True
+    ) -> Dict[date, Tuple[float, list]]:
+        """То же, что entries, но чтение с диска - в пуле потоков"""
+
+        found = self._from_memory(kind, entity_id, days)
+        missing = [day for day in days if day not in found]
+        if missing and self.store is not None:
+            from_disk = await asyncio.get_running_loop().run_in_executor(
+                None, self.store.load_days, kind, entity_id, missing
+            )
+            if from_disk:
+                self._from_disk(kind, entity_id, from_disk)
+                found.update(from_disk)
+        self._count(found, days, count)
+        return found
+
+    def get_range(
+        self,
+        kind: str,
+        entity_id: str,
+        days: List[date],
+        ttl: float,
+        count: bool = True,
+        load: bool = True,
+    ) -> Dict[date, list]:
+        """Отдает свежие закэшированные дни из days"""
+
+        now = time.time()
+        return {
+            day: lessons
+            for day, (fetched_at, lessons) in self.entries(
+                kind, entity_id, days, count, load
+            ).items()
+            if fetched_at + ttl > now
+        }
+
+    def put_days(
+        self,
+        kind: str,
+        entity_id: str,
+        by_day: Dict[date, list],
+        fetched_at: Optional[float] = None,
+    ):
+        """Кладет занятия по дням, вытесняя самые давно использованные дни"""
+
+        fetched_at = time.time() if fetched_at is None else fetched_at
+        with self._lock:
+            for day, lessons in by_day.items():
+                key = (kind, entity_id, day)
+                self._data[key] = (fetched_at, lessons)
+                self._data.move_to_end(key)
+            self._evict()
+        if self.store is not None:
+            self._write(self.store.save_days, kind, entity_id, by_day, fetched_at)
+        if self.index is not None:
+            self.index.update(kind, entity_id, self._timed(by_day, fetched_at))
+
+    def touch(
+        self,
+        kind: str,
+        entity_id: str,
+        by_day: Dict[date, list],
+        fetched_at: Optional[float] = None,
+    ):
+        """Отмечает дни как только что подтвержденные РУЗ (ответ 304)
+
+        В отличие от put_days не перезаписывает занятия на диске.
+        """
+
+        fetched_at = time.time() if fetched_at is None else fetched_at
+        with self._lock:
+            for day, lessons in by_day.items():
+                key = (kind, entity_id, day)
+                self._data[key] = (fetched_at, lessons)
+                self._data.move_to_end(key)
+            self._evict()
+        if self.store is not None:
+            self._write(self.store.touch_days, kind, entity_id, by_day, fetched_at)
+        if self.index is not None:
+            self.index.update(kind, entity_id, self._timed(by_day, fetched_at))
+
+    def _write(self, method, *args):
+        if self._writer is None:
+            method(*args)
+            return
+        self._writer.submit(method, *args).add_done_callback(self._written)
+
+    def _written(self, future: Future):
+        if future.exception() is not None:
+            self.write_errors += 1
+            logger.error(f'Ошибка записи кэша расписаний на диск: {future.exception()}')
+
+    def close(self):
+        """Дожидается записей на диск, поставленных в очередь"""
+
+        if self._writer is not None:
+            self._writer.shutdown(wait=True)
+            self._writer = None
+
+    @staticmethod
+    def _timed(by_day: Dict[date, list], fetched_at: float) -> Dict[date, tuple]:
+        return {day: (fetched_at, lessons) for day, lessons in by_day.items()}
+
+    def _evict(self):
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "size": len(self._data),
+            "hits": self.hits,
+            "misses": self.misses,
+            "loaded": self.loaded,
+            "evictions": self.evictions,
+            "write_errors": self.write_errors,
+        }
+
+
+def day_runs(days: List[date], max_gap: int = 0) -> List[Tuple[date, date]]:
+    """Склеивает отсортированные дни в непрерывные отрезки
+
+    Отрезки, между которыми не больше max_gap дней, объединяются в один:
+    лишний день в ответе дешевле отдельного запроса к РУЗ.
+    """
+
+    runs = []
+    for day in days:
+        if runs and (day - runs[-1][1]).days <= max_gap + 1:
+            runs[-1][1] = day
+        else:
+            runs.append([day, day])
+    return [(first, last) for first, last in runs]
@@ -0,0 +1,96 @@
+import logging
+from datetime import date
+from datetime import datetime
+from datetime import timedelta
+from typing import Callable
+from typing import Dict
+from typing import List
+from typing import Optional
+
+from lessons import Lesson
+from periodic import PeriodicTask
+
+logger = logging.getLogger(__name__)
+
+
+class DailyDigest:
+    """Вечерняя рассылка "расписание на завтра"
+
+    Расписание каждой сущности загружается и рендерится один раз, и этот
+    же текст ставится в очередь outbox (полоса digest) всем чатам,
+    подписанным на нее. Скорость отправки ограничивает сам outbox.
+    """
+
+    def __init__(
+        self,
+        api,
+        subscriptions,
+        outbox,
+        render: Callable[[str, str, List[Lesson]], str],
+        at: str = "20:00",
+        concurrency: int = 8,
+    ):
+        self.api = api
+        self.subscriptions = subscriptions
+        self.outbox = outbox
+        self.render = render
+        self.at = at
+        self.concurrency = concurrency
+        self.rendered = 0
+        self.enqueued = 0
+        self.failed = 0
+        self._periodic = PeriodicTask(
+            self._step, self._until_next_run, 'Ошибка рассылки на завтра', log=logger
+        )
+
+    async def send_all(self, day: Optional[date] = None) -> int:
+        """Ставит в очередь рассылку на day (по умолчанию - завтра); сколько чатов"""
+
+        day = day or date.today() + timedelta(days=1)
+        enqueued = 0
+        for kind, labels in self.subscriptions.digest_entities().items():
+            async for result in self.api.timetable_many(
+                kind, list(labels), day, day, concurrency=self.concurrency
+            ):
+                if result.error is not None:
+                    self.failed += 1
+                    logger.warning(
+                        f'Рассылка: не удалось загрузить {kind} {result.entity_id}: '
+                        f'{result.error}'
+                    )
+                    continue
+                text = self.render(kind, labels[result.entity_id], result.lessons)
+                self.rendered += 1
+                for chat_id in self.subscriptions.digest_chats(kind, result.entity_id):
+                    self.outbox.enqueue(chat_id, text, lane="digest")
+                    enqueued += 1
+        self.enqueued += enqueued
+        return enqueued
+
+    def _next_run(self, now: datetime) -> datetime:
+        hours, minutes = map(int, self.at.split(':'))
+        run = now.replace(hour=hours, minute=minutes, second=0, microsecond=0)
+        if run <= now:
+            run += timedelta(days=1)
+        return run
+
+    def _until_next_run(self) -> float:
+        now = datetime.now()
+        return (self._next_run(now) - now).total_seconds()
+
+    async def _step(self):
+        enqueued = await self.send_all()
+        logger.info(f'Рассылка на завтра: в очереди {enqueued}, {self.stats()}')
+
+    def start(self):
+        self._periodic.start()
+
+    async def stop(self):
+        await self._periodic.stop()
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "rendered": self.rendered,
+            "enqueued": self.enqueued,
+            "failed": self.failed,
+        }
@@ -0,0 +1,423 @@
+import asyncio
+import json
+import logging
+import os
+import time
+from bisect import bisect_left
+from collections import Counter
+from typing import Dict
+from typing import Iterable
+from typing import List
+from typing import Optional
+from typing import Tuple
+
+import aiofiles
+
+from limits import TokenBucket
+from periodic import PeriodicTask
+
+logger = logging.getLogger(__name__)
+
+KINDS = ("group", "person", "auditorium", "building")
+
+# затравки для обхода /api/search: РУЗ ищет по подстроке
+SEED_TERMS = tuple("абвгдеёжзийклмнопрстуфхцчшщъыьэюя") + tuple(
+    "abcdefghijklmnopqrstuvwxyz"
+) + tuple("0123456789")
+
+# на широкий запрос РУЗ отдает не больше стольких сущностей
+SEARCH_LIMIT = 50
+# обрезанные ответы уточняются до подстрок такой длины
+MAX_TERM_LENGTH = 3
+
+
+def refine(term: str, results: List) -> List[str]:
+    """Затравки на символ длиннее, если ответ на term мог быть обрезан
+
+    Сущность, не попавшая в обрезанный ответ на "а", найдется по одной из
+    подстрок "аа", "аб", ...: после вхождения term в ее названии есть еще
+    какой-то символ. Перебираются только символы, которые идут после term
+    в названиях из ответа, а не все затравки.
+    """
+
+    if len(results) < SEARCH_LIMIT:
+        return []
+    if len(term) >= MAX_TERM_LENGTH:
+        logger.warning(
+            f'Поиск "{term}": ответ обрезан и на {MAX_TERM_LENGTH} символах, '
+            f'часть сущностей может не попасть в справочник'
+        )
+        return []
+    needle = term.casefold()
+    following = set()
+    for entry in results:
+        label = (entry.get("label") or "").casefold()
+        start = label.find(needle)
+        while start != -1:
+            end = start + len(needle)
+            if end < len(label) and not label[end].isspace():
+                following.add(label[end])
+            start = label.find(needle, start + 1)
+    return [term + ch for ch in sorted(following)]
+
+
+def fold(text: str) -> str:
+    """Приводит строку к виду для сравнения: регистр, ё, лишние пробелы"""
+
+    return " ".join(text.casefold().replace("ё", "е").split())
+
+
+# латинские буквы, которые выглядят как кириллические
+HOMOGLYPHS = str.maketrans("abcehkmoptxy", "авсенкмортху")
+
+# транслит: "PI22-1" вместо "ПИ22-1"
+TRANSLIT = str.maketrans("abvgdezijklmnoprstufhcy", "абвгдезийклмнопрстуфхцы")
+
+# та же клавиша в латинской раскладке -> в русской
+LAYOUT = str.maketrans(
+    "qwertyuiop[]asdfghjkl;'zxcvbnm,.`",
+    "йцукенгшщзхъфывапролджэячсмитьбюё",
+)
+
+
+def squash(text: str) -> str:
+    """Ключ для нечеткого сравнения: без регистра, пробелов, дефисов и гомоглифов"""
+
+    return "".join(ch for ch in fold(text).translate(HOMOGLYPHS) if ch.isalnum())
+
+
+def query_variants(text: str) -> List[str]:
+    """Варианты прочтения запроса: как есть, в другой раскладке и транслитом"""
+
+    folded = fold(text)
+    variants = [squash(folded)]
+    if any("a" <= ch <= "z" for ch in folded):
+        for table in (LAYOUT, TRANSLIT):
+            variant = squash(folded.translate(table))
+            if variant not in variants:
+                variants.append(variant)
+    return [v for v in variants if v]
+
+
+def trigrams(key: str) -> set:
+    padded = "^" + key + "$"
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def edit_distance(a: str, b: str, partial: bool = False) -> int:
+    """Расстояние Левенштейна от a до b (бит-параллельный алгоритм Майерса)
+
+    При partial=True считается расстояние до наиболее похожей подстроки b,
+    чтобы "ивонов" находил "Иванов Иван Иванович".
+    """
+
+    m = len(a)
+    if m == 0:
+        return 0 if partial else len(b)
+
+    peq: Dict[str, int] = {}
+    for i, ch in enumerate(a):
+        peq[ch] = peq.get(ch, 0) | (1 << i)
+    mask = (1 << m) - 1
+    high = 1 << (m - 1)
+    # в режиме подстроки начало b бесплатно: верхняя строка матрицы нулевая
+    carry = 0 if partial else 1
+
+    pv, mv, score = mask, 0, m
+    best = score
+    for ch in b:
+        eq = peq.get(ch, 0)
+        xv = eq | mv
+        xh = (((eq & pv) + pv) ^ pv) | eq
+        ph = mv | ~(xh | pv)
+        mh = pv & xh
+        if ph & high:
+            score += 1
+        elif mh & high:
+            score -= 1
+        ph = (ph << 1) | carry
+        mh = mh << 1
+        pv = (mh | ~(xv | ph)) & mask
+        mv = ph & xv & mask
+        if score < best:
+            best = score
+    return best if partial else score
+
+
+def max_typos(key: str) -> int:
+    """Сколько опечаток прощаем запросу такой длины"""
+
+    if len(key) <= 4:
+        return 1
+    if len(key) <= 8:
+        return 2
+    return 3
+
+
+def is_junk(kind: str, entry: Dict) -> bool:
+    """Пустышки РУЗ: сборные потоки через ';' и модули вместо групп"""
+
+    if kind != "group":
+        return False
+    label = entry.get("label", "")
+    label_lower = label.lower()
+    return ";" in label or "модуль" in label_lower or "module" in label_lower
+
+
+class _KindIndex:
+    """Отсортированный массив суффиксов названий одного типа сущностей
+
+    Поиск подстроки сводится к поиску префикса среди суффиксов двумя bisect.
+    """
+
+    __slots__ = ("entries", "labels", "keys", "ids", "offsets", "squashed", "grams")
+
+    # сколько кандидатов по триграммам проверять точным расстоянием
+    CANDIDATES = 48
+
+    def __init__(self, entries: Iterable[Dict]):
+        self.entries: Dict[str, Dict] = {}
+        self.labels: Dict[str, str] = {}
+        self.squashed: Dict[str, str] = {}
+        self.grams: Dict[str, List[str]] = {}
+        suffixes = []
+        for entry in entries:
+            eid = str(entry["id"])
+            self.entries[eid] = entry
+            label = self.labels[eid] = fold(entry.get("label", ""))
+            for i, ch in enumerate(label):
+                if ch != " ":
+                    suffixes.append((label[i:], i, eid))
+            key = self.squashed[eid] = squash(label)
+            for gram in trigrams(key):
+                self.grams.setdefault(gram, []).append(eid)
+        suffixes.sort()
+        self.keys = [s for s, _, _ in suffixes]
+        self.offsets = [i for _, i, _ in suffixes]
+        self.ids = [eid for _, _, eid in suffixes]
+
+    def suggest(self, query: str, limit: int = 5) -> List[Tuple[Dict, int]]:
+        """Нечеткий поиск: кандидаты по общим триграммам, ранжирование по опечаткам"""
+
+        best: Dict[str, Tuple[int, int]] = {}
+        for variant in query_variants(query):
+            grams = [g for g in trigrams(variant) if g in self.grams]
+            # слишком частые триграммы почти ничего не различают, но дорого считать
+            common = len(self.entries) // 5
+            rare = [g for g in grams if len(self.grams[g]) <= common] or grams
+            overlap = Counter()
+            for gram in rare:
+                overlap.update(self.grams[gram])
+
+            allowed = max_typos(variant)
+            for eid, _ in overlap.most_common(self.CANDIDATES):
+                key = self.squashed[eid]
+                partial = edit_distance(variant, key, partial=True)
+                if partial > allowed:
+                    continue
+                rank = (partial, edit_distance(variant, key))
+                if eid not in best or rank < best[eid]:
+                    best[eid] = rank
+
+        ranked = sorted(best, key=lambda eid: (best[eid], self.labels[eid]))[:limit]
+        return [(self.entries[eid], best[eid][1]) for eid in ranked]
+
+    def lookup(self, query: str, limit: Optional[int] = None) -> List[Dict]:
+        q = fold(query)
+        if not q:
+            return []
+
+        lo = bisect_left(self.keys, q)
+        hi = bisect_left(self.keys, q + "\uffff", lo)
+        best: Dict[str, int] = {}
+        for i in range(lo, hi):
+            eid = self.ids[i]
+            if eid not in best or self.offsets[i] < best[eid]:
+                best[eid] = self.offsets[i]
+
+        exact = [eid for eid in best if self.labels[eid] == q]
+        if exact:
+            return [self.entries[eid] for eid in exact]
+
+        # сначала совпадения с начала названия, потом более короткие названия
+        ranked = sorted(
+            best,
+            key=lambda eid: (best[eid] != 0, len(self.labels[eid]), self.labels[eid]),
+        )
+        if limit is not None:
+            ranked = ranked[:limit]
+        return [self.entries[eid] for eid in ranked]
+
+
+class EntityDirectory:
+    """Локальный справочник групп, преподавателей, аудиторий и зданий РУЗ
+
+    Собирается периодическим обходом /api/search, хранится на диске в JSON
+    и отвечает на поиск по префиксу и подстроке без запросов к РУЗ.
+    """
+
+    def __init__(
+        self,
+        path: str = "directory.json",
+        concurrency: int = 4,
+        rate: float = 5.0,
+        max_age: float = 12 * 60 * 60,
+    ):
+        self.path = path
+        self.concurrency = concurrency
+        self.rate = rate
+        self.max_age = max_age
+        self.built_at = 0.0
+        self._index: Dict[str, _KindIndex] = {}
+        self._api = None
+        self._periodic = PeriodicTask(
+            lambda: self.refresh(self._api),
+            lambda: self.max_age - (time.time() - self.built_at),
+            'Ошибка обновления справочника',
+            retry=lambda: min(self.max_age, 15 * 60),
+            log=logger,
+        )
+
+    def ready(self, kind: str) -> bool:
+        index = self._index.get(kind)
+        return index is not None and len(index.entries) > 0
+
+    def lookup(
+        self, kind: str, query: str, limit: Optional[int] = None
+    ) -> List[Dict]:
+        """Поиск по подстроке; точные совпадения названия вытесняют остальные"""
+
+        index = self._index.get(kind)
+        if index is None:
+            return []
+        return index.lookup(query, limit)
+
+    def suggest(
+        self, kind: str, query: str, limit: int = 5
+    ) -> List[Tuple[Dict, int]]:
+        """Похожие сущности с опечатками, раскладкой и гомоглифами
+
+        Возвращает [(сущность, расстояние), ...].
+        """
+
+        index = self._index.get(kind)
+        if index is None:
+            return []
+        return index.suggest(query, limit)
+
+    def get(self, kind: str, entity_id) -> Optional[Dict]:
+        index = self._index.get(kind)
+        if index is None:
+            return None
+        return index.entries.get(str(entity_id))
+
+    def entries(self, kind: str) -> List[Dict]:
+        index = self._index.get(kind)
+        return list(index.entries.values()) if index is not None else []
+
+    def build(
+        self, entries: Dict[str, Iterable[Dict]], built_at: Optional[float] = None
+    ):
+        """Пересобирает индекс; чистка пустышек делается здесь, один раз"""
+
+        index = {}
+        for kind, items in entries.items():
+            index[kind] = _KindIndex(
+                {
+                    "id": e["id"],
+                    "label": e.get("label", ""),
+                    "description": e.get("description", ""),
+                }
+                for e in items
+                if not is_junk(kind, e)
+            )
+        self._index = index
+        self.built_at = built_at if built_at is not None else time.time()
+
+    async def crawl(self, api, kinds: Iterable[str] = KINDS) -> Dict[str, List[Dict]]:
+        """Обходит поиск РУЗ по затравкам и собирает все сущности по id
+
+        Затравки, на которые РУЗ ответил обрезанным списком, уточняются
+        следующим кругом (refine), пока ответы не станут полными.
+        """
+
+        semaphore = asyncio.Semaphore(self.concurrency)
+        limiter = TokenBucket(self.rate)
+        found: Dict[str, Dict[str, Dict]] = {kind: {} for kind in kinds}
+
+        async def fetch(kind, term) -> List[str]:
+            async with semaphore:
+                await limiter.acquire()
+                try:
+                    # мимо кэша поиска, чтобы обход не вытеснял запросы людей
+                    results = await api.search(kind, term, cache=False) or []
+                except Exception as e:
+                    logger.warning(f'Обход справочника: {kind} "{term}": {e}')
+                    return []
+            for entry in results:
+                found[kind][str(entry["id"])] = entry
+            return refine(term, results)
+
+        pending = [(kind, term) for kind in kinds for term in SEED_TERMS]
+        while pending:
+            deeper = await asyncio.gather(
+                *[fetch(kind, term) for kind, term in pending]
+            )
+            pending = [
+                (kind, term)
+                for (kind, _), terms in zip(pending, deeper)
+                for term in terms
+            ]
+            if pending:
+                logger.info(f'Обход справочника: уточняющих запросов {len(pending)}')
+        return {kind: list(items.values()) for kind, items in found.items()}
+
+    async def refresh(self, api):
+        """Пересобирает справочник из РУЗ и сохраняет его на диск"""
+
+        entries = await self.crawl(api)
+        if not any(entries.values()):
+            raise RuntimeError("РУЗ не вернул ни одной сущности")
+        # сортировка суффиксов занимает заметное время, не держим ею event loop
+        await asyncio.get_running_loop().run_in_executor(None, self.build, entries)
+        await self.save()
+        logger.info(
+            'Справочник обновлен: '
+            + ', '.join(f'{kind}={len(self.entries(kind))}' for kind in self._index)
+        )
+
+    async def save(self):
+        data = {
+            "built_at": self.built_at,
+            "entries": {kind: self.entries(kind) for kind in self._index},
+        }
+        tmp = self.path + ".tmp"
+        async with aiofiles.open(tmp, "w", encoding="utf-8") as f:
+            await f.write(json.dumps(data, ensure_ascii=False))
+        os.replace(tmp, self.path)
+
+    async def load(self) -> bool:
+        """Загружает справочник с диска; False, если файла нет или он битый"""
+
+        try:
+            async with aiofiles.open(self.path, encoding="utf-8") as f:
+                data = json.loads(await f.read())
+            await asyncio.get_running_loop().run_in_executor(
+                None, self.build, data["entries"], data.get("built_at", 0.0)
+            )
+            return True
+        except FileNotFoundError:
+            return False
+        except (ValueError, KeyError) as e:
+            logger.error(f'Не удалось прочитать справочник {self.path}: {e}')
+            return False
+
+    async def start(self, api):
+        """Загружает справочник с диска и запускает его периодическое обновление"""
+
+        await self.load()
+        self._api = api
+        self._periodic.start()
+
+    async def stop(self):
+        await self._periodic.stop()
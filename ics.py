@@ -0,0 +1,233 @@
+import asyncio
+import os
+from collections import deque
+from datetime import date
+from datetime import datetime
+from datetime import timedelta
+from datetime import timezone
+from typing import AsyncIterator
+from typing import Deque
+from typing import List
+from typing import Tuple
+
+import aiofiles
+
+from lessons import Lesson
+from lessons import fingerprint
+
+TZID = "Europe/Moscow"
+PRODID = "-//ruzfamax//Расписание ФУ//RU"
+DOMAIN = "ruz.fa.ru"
+
+# Москва круглый год UTC+3, переходов нет
+VTIMEZONE = (
+    "BEGIN:VTIMEZONE",
+    f"TZID:{TZID}",
+    "BEGIN:STANDARD",
+    "DTSTART:19700101T000000",
+    "TZOFFSETFROM:+0300",
+    "TZOFFSETTO:+0300",
+    "TZNAME:MSK",
+    "END:STANDARD",
+    "END:VTIMEZONE",
+)
+
+
+def weeks(first: date, last: date) -> List[Tuple[date, date]]:
+    """Период отрезками по календарным неделям (понедельник - воскресенье)"""
+
+    found = []
+    while first <= last:
+        end = min(last, first + timedelta(days=6 - first.weekday()))
+        found.append((first, end))
+        first = end + timedelta(days=1)
+    return found
+
+
+def escape_text(value: str) -> str:
+    return (
+        value.replace("\\", "\\\\")
+        .replace(";", "\\;")
+        .replace(",", "\\,")
+        .replace("\r\n", "\\n")
+        .replace("\n", "\\n")
+    )
+
+
+def fold(line: str) -> str:
+    """Строка свойства с переносами по 75 октетов (RFC 5545, 3.1)"""
+
+    encoded = line.encode()
+    if len(encoded) <= 75:
+        return line + "\r\n"
+    parts = []
+    start, limit = 0, 75
+    while start < len(encoded):
+        end = min(len(encoded), start + limit)
+        # не режем многобайтный символ UTF-8 посередине
+        while end < len(encoded) and encoded[end] & 0xC0 == 0x80:
+            end -= 1
+        parts.append(encoded[start:end].decode())
+        start, limit = end, 74
+    return "\r\n ".join(parts) + "\r\n"
+
+
+def uid(kind: str, entity_id: str, lesson: Lesson) -> str:
+    """Постоянный UID: при повторном импорте календарь обновит событие на месте"""
+
+    if lesson.lesson_oid is not None:
+        key = str(lesson.lesson_oid)
+    else:
+        key = fingerprint(
+            (
+                lesson.date,
+                lesson.begin_lesson,
+                lesson.discipline,
+                lesson.group,
+                lesson.sub_group,
+            )
+        )[:20]
+    return f"{kind}-{entity_id}-{key}@{DOMAIN}"
+
+
+def _local(day: int, minutes: int) -> str:
+    d = date.fromordinal(day)
+    return f"{d:%Y%m%d}T{minutes // 60:02d}{minutes % 60:02d}00"
+
+
+def vevent(kind: str, entity_id: str, lesson: Lesson, stamp: str) -> str:
+    """VEVENT одного занятия; пустая строка, если у занятия нет даты или времени"""
+
+    if lesson.day is None or lesson.begin is None or lesson.end is None:
+        return ""
+    summary = lesson.discipline or "Без названия"
+    if lesson.kind_of_work:
+        summary += f" ({lesson.kind_of_work})"
+    details = [
+        value
+        for value in (
+            lesson.lecturer,
+            lesson.stream or lesson.group,
+            lesson.sub_group,
+        )
+        if value
+    ]
+    lines = [
+        "BEGIN:VEVENT",
+        f"UID:{uid(kind, entity_id, lesson)}",
+        f"DTSTAMP:{stamp}",
+        f"DTSTART;TZID={TZID}:{_local(lesson.day, lesson.begin)}",
+        f"DTEND;TZID={TZID}:{_local(lesson.day, lesson.end)}",
+        f"SUMMARY:{escape_text(summary)}",
+    ]
+    if lesson.auditorium:
+        lines.append(f"LOCATION:{escape_text(lesson.auditorium)}")
+    if details:
+        lines.append(f"DESCRIPTION:{escape_text(chr(10).join(details))}")
+    lines.append("END:VEVENT")
+    return "".join(fold(line) for line in lines)
+
+
+async def timetable_weeks(
+    api,
+    kind: str,
+    entity_id: str,
+    first: date,
+    last: date,
+    concurrency: int = 4,
+) -> AsyncIterator[List[Lesson]]:
+    """Расписание по неделям в порядке дат
+
+    Вперед грузится не больше concurrency недель, так что в памяти не бывает
+    больше нескольких недель сразу. Ошибка недели прерывает выгрузку.
+    """
+
+    pending: Deque[asyncio.Future] = deque()
+    plan = iter(weeks(first, last))
+
+    def launch():
+        week = next(plan, None)
+        if week is not None:
+            pending.append(
+                asyncio.ensure_future(api.timetable(kind, entity_id, *week))
+            )
+
+    try:
+        for _ in range(concurrency):
+            launch()
+        while pending:
+            lessons = await pending.popleft()
+            launch()
+            yield lessons
+    finally:
+        for task in pending:
+            task.cancel()
+
+
+async def calendar(
+    api,
+    kind: str,
+    entity_id: str,
+    name: str,
+    first: date,
+    last: date,
+    concurrency: int = 4,
+) -> AsyncIterator[str]:
+    """Календарь .ics кусками: заголовок, затем события неделя за неделей"""
+
+    stamp = datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%SZ")
+    yield "".join(
+        fold(line)
+        for line in (
+            "BEGIN:VCALENDAR",
+            "VERSION:2.0",
+            f"PRODID:{PRODID}",
+            "CALSCALE:GREGORIAN",
+            "METHOD:PUBLISH",
+            f"X-WR-CALNAME:{escape_text(name)}",
+            f"X-WR-TIMEZONE:{TZID}",
+        )
+        + VTIMEZONE
+    )
+    async for lessons in timetable_weeks(
+        api, kind, entity_id, first, last, concurrency
+    ):
+        # поточное занятие может прийти дважды: один UID - одно событие
+        seen = set()
+        events = []
+        for lesson in lessons:
+            key = uid(kind, entity_id, lesson)
+            if key in seen:
+                continue
+            seen.add(key)
+            events.append(vevent(kind, entity_id, lesson, stamp))
+        yield "".join(events)
+    yield "END:VCALENDAR\r\n"
+
+
+async def write_ics(path: str, chunks: AsyncIterator[str]) -> int:
+    """Пишет календарь в файл по мере готовности кусков; возвращает размер
+
+    Файл появляется под своим именем только целиком: пишем во временный.
+    """
+
+    tmp = path + ".tmp"
+    size = 0
+    try:
+        async with aiofiles.open(tmp, "w", encoding="utf-8", newline="") as f:
+            async for chunk in chunks:
+                if chunk:
+                    await f.write(chunk)
+                    size += len(chunk.encode())
+        os.replace(tmp, path)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+    return size
+
+
+def filename(name: str, first: date, last: date) -> str:
+    """Имя файла для пользователя: без символов, запрещенных в именах"""
+
+    safe = "".join(c if c.isalnum() or c in "-_." else "_" for c in name).strip("_")
+    return f"{safe or 'schedule'}_{first:%Y%m%d}-{last:%Y%m%d}.ics"
@@ -0,0 +1,407 @@
+import asyncio
+import logging
+import threading
+import time
+from datetime import date
+from datetime import datetime
+from datetime import timedelta
+from typing import Callable
+from typing import Dict
+from typing import Iterable
+from typing import List
+from typing import Optional
+from typing import Tuple
+
+from api import BaseFaAPI
+from api import Timetable
+from lessons import FIELDS
+from lessons import Lesson
+from lessons import day_ordinal
+from periodic import PeriodicTask
+
+logger = logging.getLogger(__name__)
+
+# тип сущности РУЗ -> поле занятия с ее id
+KEYS = {
+    "person": "lecturer_oid",
+    "auditorium": "auditorium_oid",
+    "building": "building_oid",
+}
+
+
+def to_ordinal(value) -> Optional[int]:
+    """date, datetime или 'ГГГГ.ММ.ДД' -> date.toordinal()"""
+
+    if isinstance(value, datetime):
+        return value.date().toordinal()
+    if isinstance(value, date):
+        return value.toordinal()
+    return day_ordinal(value)
+
+
+def merge_day(by_group: Dict[str, List[Lesson]]) -> List[Lesson]:
+    """Занятия одного дня из расписаний нескольких групп без повторов
+
+    Поточное занятие приходит в расписании каждой группы потока. Если у
+    него нет названия потока, группы склеиваются в одно поле group.
+    """
+
+    if len(by_group) == 1:
+        lessons = list(next(iter(by_group.values())))
+    else:
+        same: Dict[tuple, List[Lesson]] = {}
+        for items in by_group.values():
+            for l in items:
+                key = (l.begin, l.end, l.discipline, l.lecturer_oid, l.auditorium_oid)
+                same.setdefault(key, []).append(l)
+        lessons = []
+        for copies in same.values():
+            lesson = copies[0]
+            groups = sorted({l.group for l in copies if l.group})
+            if len(groups) > 1 and not lesson.stream:
+                fields = {slot: getattr(lesson, slot) for slot in FIELDS.values()}
+                fields["group"] = ", ".join(groups)
+                lesson = Lesson(**fields)
+            lessons.append(lesson)
+    lessons.sort(key=lambda l: l.begin if l.begin is not None else -1)
+    return lessons
+
+
+class LessonIndex:
+    """Обратный индекс по расписаниям групп: преподаватель, аудитория, здание
+
+    В каждом занятии группы уже есть преподаватель, аудитория и здание, так
+    что, когда в кэше лежат дни всех групп, расписание преподавателя или
+    аудитории собирается без отдельного запроса к РУЗ. Индекс пополняется
+    из DayCache по мере того, как туда попадают дни групп (загрузка, ответ
+    304, подъем с диска), и перестраивается только для изменившейся пары
+    (группа, день).
+
+    Ответ отдается, только если каждый день периода есть для групп
+    справочника (без доли miss_ratio) и не старше max_age; иначе timetable()
+    возвращает None и вызывающий идет в РУЗ. Группа, которая не загрузилась
+    quarantine_after раз подряд, на quarantine секунд исключается из
+    справочника индекса, чтобы не ломать покрытие навсегда.
+
+    Фоновая задача догружает только те дни, о которых спрашивали за
+    последние max_age секунд, и не больше budget групп за проход, начиная
+    с самых старых: из РУЗ или, если запущена с fetch=False, только с диска
+    DayCache, куда их пишет другой процесс.
+    """
+
+    def __init__(
+        self,
+        groups: Callable[[], Iterable],
+        max_age: float = 6 * 60 * 60,
+        stale_after: float = BaseFaAPI.CACHE_TTL["schedule"],
+        interval: float = 15 * 60,
+        concurrency: int = 4,
+        budget: int = 200,
+        miss_ratio: float = 0.005,
+        quarantine_after: int = 3,
+        quarantine: float = 24 * 60 * 60,
+    ):
+        self.groups = groups
+        self.max_age = max_age
+        self.stale_after = stale_after
+        self.interval = interval
+        self.concurrency = concurrency
+        self.budget = budget
+        self.miss_ratio = miss_ratio
+        self.quarantine_after = quarantine_after
+        self.quarantine = quarantine
+        # день -> группа -> (время загрузки, занятия)
+        self._days: Dict[int, Dict[str, Tuple[float, List[Lesson]]]] = {}
+        # тип -> id -> день -> группа -> занятия
+        self._postings: Dict[str, Dict[str, Dict[int, Dict[str, List[Lesson]]]]] = {
+            kind: {} for kind in KEYS
+        }
+        # день -> время загрузки самого старого дня группы, когда день покрыт;
+        # обновления дни только освежают, так что это значение верно, пока не
+        # сменится список групп или оно само не постареет
+        self._covered: Dict[int, float] = {}
+        self._universe_seen: frozenset = frozenset()
+        # день -> когда о нем последний раз спрашивали
+        self._wanted: Dict[int, float] = {}
+        # группа -> неудачных загрузок подряд; группа -> до какого времени исключена
+        self._failures: Dict[str, int] = {}
+        self._quarantined: Dict[str, float] = {}
+        self._lock = threading.Lock()
+        self.relinked = 0
+        self.served = 0
+        self.fallbacks = 0
+        self.warmed = 0
+        self.failed = 0
+        self._api: Optional[BaseFaAPI] = None
+        self._fetch = True
+        self._periodic = PeriodicTask(
+            self._step,
+            lambda: self.interval,
+            'Ошибка прогрева индекса занятий',
+            immediate=True,
+            log=logger,
+        )
+
+    def update(
+        self, kind: str, entity_id: str, days: Dict[date, Tuple[float, list]]
+    ):
+        """Учитывает дни, попавшие в DayCache; дни не групп пропускаются"""
+
+        if kind != "group":
+            return
+        entity_id = str(entity_id)
+        with self._lock:
+            for day, (fetched_at, lessons) in days.items():
+                groups = self._days.setdefault(day.toordinal(), {})
+                old = groups.get(entity_id)
+                groups[entity_id] = (fetched_at, lessons)
+                # ответ 304 приносит тот же список: переиндексировать нечего
+                if old is not None and old[1] is lessons:
+                    continue
+                if old is not None:
+                    self._unlink(entity_id, day.toordinal(), old[1])
+                self._link(entity_id, day.toordinal(), lessons)
+                self.relinked += 1
+
+    def _link(self, group: str, day: int, lessons: List[Lesson]):
+        for kind, field in KEYS.items():
+            postings = self._postings[kind]
+            for lesson in lessons:
+                key = getattr(lesson, field)
+                if key is None:
+                    continue
+                by_group = postings.setdefault(str(key), {}).setdefault(day, {})
+                by_group.setdefault(group, []).append(lesson)
+
+    def _unlink(self, group: str, day: int, lessons: List[Lesson]):
+        for kind, field in KEYS.items():
+            postings = self._postings[kind]
+            keys = {getattr(l, field) for l in lessons}
+            keys.discard(None)
+            for key in map(str, keys):
+                days = postings.get(key)
+                if days is None or day not in days:
+                    continue
+                days[day].pop(group, None)
+                if not days[day]:
+                    del days[day]
+                if not days:
+                    del postings[key]
+
+    def prune(self, oldest: Optional[date] = None):
+        """Выбрасывает дни раньше oldest (по умолчанию - раньше сегодняшнего)"""
+
+        oldest = (oldest or date.today()).toordinal()
+        with self._lock:
+            for day in [d for d in self._days if d < oldest]:
+                self._covered.pop(day, None)
+                for group, (_, lessons) in self._days.pop(day).items():
+                    self._unlink(group, day, lessons)
+
+    def _coverage(self, first: int, last: int, universe: frozenset) -> Optional[float]:
+        """Время загрузки самого старого дня, если период покрыт целиком"""
+
+        if not universe:
+            return None
+        if universe != self._universe_seen:
+            self._universe_seen = universe
+            self._covered.clear()
+        now = time.time()
+        oldest = now
+        for day in range(first, last + 1):
+            fetched_at = self._covered.get(day)
+            if fetched_at is None or now - fetched_at >= self.max_age:
+                fetched_at = self._day_coverage(day, universe, now)
+                if fetched_at is None:
+                    return None
+                self._covered[day] = fetched_at
+            oldest = min(oldest, fetched_at)
+        return oldest
+
+    def _day_coverage(
+        self, day: int, universe: frozenset, now: float
+    ) -> Optional[float]:
+        groups = self._days.get(day)
+        if groups is None:
+            return None
+        # несколько групп без свежего дня допустимы, лишь бы не больше доли
+        allowed = int(len(universe) * self.miss_ratio)
+        oldest = now
+        for group in universe:
+            item = groups.get(group)
+            if item is None or now - item[0] >= self.max_age:
+                allowed -= 1
+                if allowed < 0:
+                    return None
+                continue
+            oldest = min(oldest, item[0])
+        return oldest
+
+    def _universe(self) -> frozenset:
+        now = time.time()
+        for group, until in list(self._quarantined.items()):
+            if until <= now:
+                del self._quarantined[group]
+                self._failures.pop(group, None)
+        return frozenset(
+            str(group) for group in self.groups()
+        ).difference(self._quarantined)
+
+    def _want(self, first: int, last: int):
+        """Запоминает спрошенные дни: их и будет догружать фоновая задача"""
+
+        now = time.time()
+        today = date.today().toordinal()
+        # дальние периоды (выгрузка семестра) не прогреваем
+        for day in range(max(first, today), min(last, today + 30) + 1):
+            self._wanted[day] = now
+
+    def covers(self, date_begin, date_end) -> bool:
+        """Есть ли в индексе свежие дни всех групп за весь период"""
+
+        first, last = to_ordinal(date_begin), to_ordinal(date_end)
+        universe = self._universe()
+        self._want(first, last)
+        with self._lock:
+            return self._coverage(first, last, universe) is not None
+
+    def timetable(
+        self, kind: str, entity_id: str, date_begin, date_end
+    ) -> Optional[Timetable]:
+        """Расписание преподавателя, аудитории или здания из индекса
+
+        None - период покрыт не полностью, расписание нужно брать из РУЗ.
+        """
+
+        first, last = to_ordinal(date_begin), to_ordinal(date_end)
+        universe = self._universe()
+        self._want(first, last)
+        with self._lock:
+            fetched_at = self._coverage(first, last, universe)
+            if fetched_at is None:
+                self.fallbacks += 1
+                return None
+            days = self._postings[kind].get(str(entity_id), {})
+            lessons = []
+            for day in range(first, last + 1):
+                by_group = days.get(day)
+                if by_group:
+                    lessons.extend(merge_day(by_group))
+        self.served += 1
+        return Timetable(
+            lessons, fetched_at, stale=time.time() - fetched_at >= self.stale_after
+        )
+
+    def _missing(self, first: int, last: int) -> List[str]:
+        """Группы с отсутствующим или старым днем в периоде, самые старые первыми"""
+
+        now = time.time()
+        missing = []
+        universe = self._universe()
+        with self._lock:
+            for group in universe:
+                oldest = now
+                for day in range(first, last + 1):
+                    item = self._days.get(day, {}).get(group)
+                    oldest = min(oldest, item[0] if item is not None else 0.0)
+                if now - oldest >= self.max_age:
+                    missing.append((oldest, group))
+        return [group for _, group in sorted(missing)]
+
+    def _failed(self, group: str, error: BaseException):
+        self.failed += 1
+        failures = self._failures.get(group, 0) + 1
+        self._failures[group] = failures
+        if failures >= self.quarantine_after:
+            self._quarantined[group] = time.time() + self.quarantine
+            logger.warning(
+                f'Индекс занятий: группа {group} не загружается {failures} раз '
+                f'подряд ({error}), исключена из покрытия'
+            )
+        else:
+            logger.warning(
+                f'Индекс занятий: не удалось загрузить группу {group}: {error}'
+            )
+
+    async def warm(self, api, first: date, last: date) -> int:
+        """Догружает период для самых старых из budget групп, которых не хватает"""
+
+        missing = self._missing(first.toordinal(), last.toordinal())[: self.budget]
+        fetched = 0
+        if missing:
+            async for result in api.timetable_many(
+                "group", missing, first, last,
+                concurrency=self.concurrency, max_age=self.max_age,
+            ):
+                group = str(result.entity_id)
+                if result.error is not None:
+                    self._failed(group, result.error)
+                    continue
+                self._failures.pop(group, None)
+                fetched += 1
+        self.warmed += fetched
+        return fetched
+
+    def _read(self, store, groups: List[str], days: List[date]) -> int:
+        read = 0
+        for group in groups:
+            found = store.load_days("group", group, days)
+            if found:
+                self.update("group", group, found)
+                read += 1
+        return read
+
+    async def load(self, store, first: date, last: date) -> int:
+        """Подтягивает недостающие дни групп из store, не обращаясь к РУЗ"""
+
+        missing = self._missing(first.toordinal(), last.toordinal())
+        if not missing:
+            return 0
+        days = [first + timedelta(days=i) for i in range((last - first).days + 1)]
+        return await asyncio.get_running_loop().run_in_executor(
+            None, self._read, store, missing, days
+        )
+
+    async def _step(self):
+        self.prune()
+        now = time.time()
+        for day, asked in list(self._wanted.items()):
+            if now - asked >= self.max_age:
+                del self._wanted[day]
+        today = date.today().toordinal()
+        wanted = [day for day in self._wanted if day >= today]
+        if not wanted:
+            # о расписаниях преподавателей и аудиторий давно не спрашивали
+            return
+        first, last = date.fromordinal(min(wanted)), date.fromordinal(max(wanted))
+        if self._fetch:
+            fetched = await self.warm(self._api, first, last)
+        else:
+            fetched = await self.load(self._api.days.store, first, last)
+        if fetched:
+            logger.info(f'Индекс занятий: догружено {fetched}, {self.stats()}')
+
+    def start(self, api, fetch: bool = True):
+        self._api = api
+        self._fetch = fetch
+        self._periodic.start()
+
+    async def stop(self):
+        await self._periodic.stop()
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "days": len(self._days),
+                "group_days": sum(len(groups) for groups in self._days.values()),
+                "lecturers": len(self._postings["person"]),
+                "auditoriums": len(self._postings["auditorium"]),
+                "buildings": len(self._postings["building"]),
+                "relinked": self.relinked,
+                "served": self.served,
+                "fallbacks": self.fallbacks,
+                "warmed": self.warmed,
+                "failed": self.failed,
+                "quarantined": len(self._quarantined),
+                "wanted_days": len(self._wanted),
+            }
@@ -0,0 +1,161 @@
+import hashlib
+import json
+import sys
+from datetime import date
+from functools import lru_cache
+from typing import Any
+from typing import Dict
+from typing import Iterable
+from typing import List
+from typing import Optional
+from typing import Tuple
+
+WEEKDAYS = [
+    'Понедельник', 'Вторник', 'Среда', 'Четверг', 'Пятница', 'Суббота', 'Воскресенье'
+]
+
+# поле РУЗ -> слот Lesson; остальные поля ответа РУЗ не храним
+FIELDS = {
+    "date": "date",
+    "beginLesson": "begin_lesson",
+    "endLesson": "end_lesson",
+    "discipline": "discipline",
+    "kindOfWork": "kind_of_work",
+    "lecturer": "lecturer",
+    "lecturer_title": "lecturer_title",
+    "lecturerOid": "lecturer_oid",
+    "lecturerEmail": "lecturer_email",
+    "auditorium": "auditorium",
+    "auditoriumOid": "auditorium_oid",
+    "building": "building",
+    "buildingOid": "building_oid",
+    "group": "group",
+    "groupOid": "group_oid",
+    "stream": "stream",
+    "subGroup": "sub_group",
+    "lessonOid": "lesson_oid",
+}
+
+
+@lru_cache(maxsize=4096)
+def day_ordinal(value: str) -> Optional[int]:
+    """'2024.09.02' -> date.toordinal(), без strptime"""
+
+    try:
+        return date(int(value[0:4]), int(value[5:7]), int(value[8:10])).toordinal()
+    except (TypeError, ValueError):
+        return None
+
+
+@lru_cache(maxsize=4096)
+def day_label(ordinal: int) -> str:
+    """Заголовок дня: 'Понедельник, 02.09.2024'"""
+
+    d = date.fromordinal(ordinal)
+    return f"{WEEKDAYS[d.weekday()]}, {d.strftime('%d.%m.%Y')}"
+
+
+def minutes(value: Optional[str]) -> Optional[int]:
+    """'08:30' -> 510"""
+
+    try:
+        return int(value[0:2]) * 60 + int(value[3:5])
+    except (TypeError, ValueError):
+        return None
+
+
+def hhmm(value: int) -> str:
+    return f"{value // 60:02d}:{value % 60:02d}"
+
+
+def fingerprint(values: Iterable) -> str:
+    """Отпечаток последовательности значений, одинаковый во всех процессах
+
+    В отличие от hash() не зависит от PYTHONHASHSEED, так что годится и для
+    ключей, общих для процессов вебхука, и для записи на диск.
+    """
+
+    payload = json.dumps(list(values), ensure_ascii=False, default=str)
+    return hashlib.blake2b(payload.encode(), digest_size=16).hexdigest()
+
+
+def _intern(value: Any) -> Any:
+    return sys.intern(value) if isinstance(value, str) else value
+
+
+class Lesson:
+    """Занятие из расписания РУЗ
+
+    Хранит только нужные боту поля, повторяющиеся строки (дисциплины,
+    преподаватели, аудитории) интернированы, дата и время разобраны заранее:
+    day - date.toordinal(), begin/end - минуты от начала суток. Для старого
+    кода поддерживается доступ как к словарю РУЗ: lesson.get('discipline').
+    """
+
+    __slots__ = ("day", "begin", "end") + tuple(FIELDS.values())
+
+    def __init__(self, **fields):
+        for slot in FIELDS.values():
+            setattr(self, slot, _intern(fields.get(slot)))
+        self.day = day_ordinal(self.date)
+        self.begin = minutes(self.begin_lesson)
+        self.end = minutes(self.end_lesson)
+
+    @classmethod
+    def from_dict(cls, raw: Dict) -> "Lesson":
+        """Из словаря РУЗ"""
+
+        fields = {slot: raw.get(key) for key, slot in FIELDS.items()}
+        if fields["lecturer_email"] is None:
+            fields["lecturer_email"] = raw.get("email")
+        return cls(**fields)
+
+    def to_dict(self) -> Dict:
+        """Обратно в словарь с ключами РУЗ"""
+
+        return {
+            key: getattr(self, slot)
+            for key, slot in FIELDS.items()
+            if getattr(self, slot) is not None
+        }
+
+    def get(self, key: str, default: Any = None) -> Any:
+        slot = FIELDS.get(key)
+        if key == "email":
+            slot = "lecturer_email"
+        value = getattr(self, slot) if slot is not None else None
+        return default if value is None else value
+
+    def __getitem__(self, key: str) -> Any:
+        value = self.get(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __eq__(self, other) -> bool:
+        if not isinstance(other, Lesson):
+            return NotImplemented
+        return all(
+            getattr(self, slot) == getattr(other, slot) for slot in self.__slots__
+        )
+
+    def __hash__(self) -> int:
+        return hash((self.day, self.begin, self.discipline, self.lesson_oid))
+
+    def __repr__(self) -> str:
+        return "Lesson({} {}-{} {!r})".format(
+            self.date, self.begin_lesson, self.end_lesson, self.discipline
+        )
+
+
+def by_day(lessons: Iterable[Lesson]) -> List[Tuple[int, List[Lesson]]]:
+    """Группирует занятия по дням, дни и занятия внутри дня - по времени"""
+
+    days: Dict[int, List[Lesson]] = {}
+    for lesson in lessons:
+        day = lesson.day if lesson.day is not None else -1
+        days.setdefault(day, []).append(lesson)
+    return [
+        (day, sorted(items, key=lambda l: l.begin if l.begin is not None else -1))
+        for day, items in sorted(days.items())
+    ]
@@ -0,0 +1,609 @@
+"""Локальное зеркало расписания всего университета
+
+    python mirror.py sync --db mirror.db
+    python mirror.py sync --from 2026.09.01 --to 2027.01.31 --chunk-days 28
+    python mirror.py stats --db mirror.db
+    python mirror.py compact --db mirror.db
+
+sync обходит поиск РУЗ, собирает все группы и выкачивает их расписание за
+семестр отрезками по chunk-days дней через FaAPI. Повторный запуск
+инкрементальный: прошедшие отрезки, скачанные уже после своего окончания,
+не запрашиваются вовсе, остальные запрашиваются условно (ETag/Last-Modified
+из прошлого запуска), а на диске переписываются только изменившиеся дни.
+
+ScheduleMirror умеет то же, что TimetableStore, поэтому подключается к
+FaAPI и AsyncFaAPI как хранилище дневного кэша: DayCache(store=mirror).
+Расписания преподавателей, аудиторий и зданий клиенты читают из зеркала до
+РУЗ, если передать его явно: FaAPI(mirror=mirror). Бот делает и то и другое
+сам, если рядом лежит mirror.db.
+
+Зеркало хранит только текущий семестр: прошлые дни удаляет compact. Дни
+преподавателей, аудиторий и зданий, закэшированные ботом, удаляются по
+правилам TimetableStore.
+"""
+
+import argparse
+import json
+import logging
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date
+from datetime import datetime
+from datetime import timedelta
+from typing import Dict
+from typing import Iterable
+from typing import List
+from typing import Optional
+from typing import Tuple
+
+from api import FaAPI
+from api import Timetable
+from api import Validator
+from cache import MISSING
+from cache import DayCache
+from directory import SEED_TERMS
+from directory import is_junk
+from directory import refine
+from lessonindex import KEYS
+from lessonindex import merge_day
+from lessonindex import to_ordinal
+from lessons import Lesson
+from lessons import fingerprint
+
+logger = logging.getLogger(__name__)
+
+MIRROR_PATH = "mirror.db"
+# sync запускается раз в сутки; день еще не прошедшего отрезка считается
+# свежим, пока с его загрузки не прошло столько плюс время самого sync
+SYNC_INTERVAL = 24 * 60 * 60
+MAX_AGE = SYNC_INTERVAL + 6 * 60 * 60
+
+
+def semester(today: Optional[date] = None) -> Tuple[date, date]:
+    """Текущий семестр вместе с сессией: сентябрь-январь или февраль-июль"""
+
+    today = today or date.today()
+    if today.month >= 8:
+        return date(today.year, 9, 1), date(today.year + 1, 1, 31)
+    if today.month == 1:
+        return date(today.year - 1, 9, 1), date(today.year, 1, 31)
+    return date(today.year, 2, 1), date(today.year, 7, 15)
+
+
+def chunks(first: date, last: date, days: int) -> List[Tuple[date, date]]:
+    """Период отрезками по days дней"""
+
+    found = []
+    while first <= last:
+        end = min(last, first + timedelta(days=days - 1))
+        found.append((first, end))
+        first = end + timedelta(days=1)
+    return found
+
+
+class ScheduleMirror:
+    """Расписание по дням в SQLite с индексами по преподавателю и аудитории
+
+    Строка days - известный день сущности (в том числе пустой) с временем
+    загрузки и отпечатком занятий, строка lessons - одно занятие с id
+    преподавателя, аудитории и здания в отдельных индексированных колонках.
+    chunks хранит валидаторы ответов РУЗ по отрезкам для следующего sync
+    и признак final: отрезок скачан после своего окончания и уже не
+    изменится. groups - группы, которые последний sync выкачал без ошибок.
+    """
+
+    def __init__(
+        self,
+        path: str = MIRROR_PATH,
+        keep_days: int = 14,
+        max_age: float = 7 * 24 * 60 * 60,
+        compact_every: float = 24 * 60 * 60,
+    ):
+        self.path = path
+        self.keep_days = keep_days
+        self.max_age = max_age
+        self.compact_every = compact_every
+        self.changed_days = 0
+        self.unchanged_days = 0
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.executescript(
+            "CREATE TABLE IF NOT EXISTS days ("
+            " kind TEXT NOT NULL,"
+            " entity_id TEXT NOT NULL,"
+            " day INTEGER NOT NULL,"
+            " fetched_at REAL NOT NULL,"
+            " digest TEXT NOT NULL,"
+            " PRIMARY KEY (kind, entity_id, day));"
+            "CREATE INDEX IF NOT EXISTS days_by_day ON days (kind, day);"
+            "CREATE TABLE IF NOT EXISTS lessons ("
+            " kind TEXT NOT NULL,"
+            " entity_id TEXT NOT NULL,"
+            " day INTEGER NOT NULL,"
+            " begin INTEGER,"
+            " lecturer_oid TEXT,"
+            " auditorium_oid TEXT,"
+            " building_oid TEXT,"
+            " payload TEXT NOT NULL);"
+            "CREATE INDEX IF NOT EXISTS lessons_by_entity"
+            " ON lessons (kind, entity_id, day);"
+            "CREATE INDEX IF NOT EXISTS lessons_by_lecturer"
+            " ON lessons (lecturer_oid, day);"
+            "CREATE INDEX IF NOT EXISTS lessons_by_auditorium"
+            " ON lessons (auditorium_oid, day);"
+            "CREATE INDEX IF NOT EXISTS lessons_by_building"
+            " ON lessons (building_oid, day);"
+            "CREATE TABLE IF NOT EXISTS chunks ("
+            " kind TEXT NOT NULL,"
+            " entity_id TEXT NOT NULL,"
+            " first INTEGER NOT NULL,"
+            " last INTEGER NOT NULL,"
+            " etag TEXT,"
+            " last_modified TEXT,"
+            " size INTEGER NOT NULL DEFAULT 0,"
+            " synced_at REAL NOT NULL,"
+            " final INTEGER NOT NULL DEFAULT 0,"
+            " PRIMARY KEY (kind, entity_id, first, last));"
+            "CREATE TABLE IF NOT EXISTS groups ("
+            " entity_id TEXT PRIMARY KEY,"
+            " synced_at REAL NOT NULL);"
+        )
+        self._db.commit()
+        self._compacted_at = 0.0
+
+    # интерфейс TimetableStore для DayCache
+
+    def load_days(
+        self, kind: str, entity_id: str, days: Iterable[date]
+    ) -> Dict[date, Tuple[float, List[Lesson]]]:
+        """Дни, которые есть в зеркале: день -> (время загрузки, занятия)"""
+
+        ordinals = [day.toordinal() for day in days]
+        if not ordinals:
+            return {}
+        span = (kind, str(entity_id), min(ordinals), max(ordinals))
+        with self._lock:
+            known = self._db.execute(
+                "SELECT day, fetched_at FROM days"
+                " WHERE kind = ? AND entity_id = ? AND day BETWEEN ? AND ?",
+                span,
+            ).fetchall()
+            rows = self._db.execute(
+                "SELECT day, payload FROM lessons"
+                " WHERE kind = ? AND entity_id = ? AND day BETWEEN ? AND ?"
+                " ORDER BY day, rowid",
+                span,
+            ).fetchall()
+
+        wanted = set(ordinals)
+        found = {
+            day: (fetched_at, []) for day, fetched_at in known if day in wanted
+        }
+        for day, payload in rows:
+            if day in found:
+                found[day][1].append(Lesson.from_dict(json.loads(payload)))
+        return {date.fromordinal(day): item for day, item in found.items()}
+
+    def save_days(
+        self,
+        kind: str,
+        entity_id: str,
+        by_day: Dict[date, List[Lesson]],
+        fetched_at: float,
+    ):
+        """Пишет дни; занятия переписываются только у изменившихся дней"""
+
+        entity_id = str(entity_id)
+        payloads = {
+            day.toordinal(): [
+                json.dumps(l.to_dict(), ensure_ascii=False, sort_keys=True)
+                for l in lessons
+            ]
+            for day, lessons in by_day.items()
+        }
+        lessons_by_day = {day.toordinal(): lessons for day, lessons in by_day.items()}
+        if not payloads:
+            return
+        with self._lock:
+            stored = dict(
+                self._db.execute(
+                    "SELECT day, digest FROM days"
+                    " WHERE kind = ? AND entity_id = ? AND day BETWEEN ? AND ?",
+                    (kind, entity_id, min(payloads), max(payloads)),
+                ).fetchall()
+            )
+            changed = 0
+            for day, items in payloads.items():
+                digest = fingerprint(items)
+                if stored.get(day) == digest:
+                    self._db.execute(
+                        "UPDATE days SET fetched_at = ?"
+                        " WHERE kind = ? AND entity_id = ? AND day = ?",
+                        (fetched_at, kind, entity_id, day),
+                    )
+                    continue
+                changed += 1
+                self._db.execute(
+                    "DELETE FROM lessons WHERE kind = ? AND entity_id = ? AND day = ?",
+                    (kind, entity_id, day),
+                )
+                self._db.executemany(
+                    "INSERT INTO lessons VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                    [
+                        (
+                            kind,
+                            entity_id,
+                            day,
+                            lesson.begin,
+                            *(
+                                None if getattr(lesson, f) is None
+                                else str(getattr(lesson, f))
+                                for f in KEYS.values()
+                            ),
+                            payload,
+                        )
+                        for lesson, payload in zip(lessons_by_day[day], items)
+                    ],
+                )
+                self._db.execute(
+                    "INSERT OR REPLACE INTO days VALUES (?, ?, ?, ?, ?)",
+                    (kind, entity_id, day, fetched_at, digest),
+                )
+            self._db.commit()
+        self.changed_days += changed
+        self.unchanged_days += len(payloads) - changed
+
+        if time.time() - self._compacted_at > self.compact_every:
+            self.compact()
+
+    def touch_days(
+        self, kind: str, entity_id: str, days: Iterable[date], fetched_at: float
+    ):
+        """Обновляет время загрузки дней, не трогая занятия"""
+
+        rows = [(fetched_at, kind, str(entity_id), day.toordinal()) for day in days]
+        with self._lock:
+            self._db.executemany(
+                "UPDATE days SET fetched_at = ?"
+                " WHERE kind = ? AND entity_id = ? AND day = ?",
+                rows,
+            )
+            self._db.commit()
+        self.unchanged_days += len(rows)
+
+    def compact(self) -> int:
+        """Удаляет дни до текущего семестра и давно не нужные дни не групп
+
+        Дни групп хранятся весь семестр: sync не перекачивает прошедшие
+        отрезки. Остальные сущности - как в TimetableStore: дни старше
+        keep_days и не обновлявшиеся max_age секунд удаляются.
+        """
+
+        start, _ = semester()
+        oldest_day = (date.today() - timedelta(days=self.keep_days)).toordinal()
+        with self._lock:
+            deleted = self._db.execute(
+                "DELETE FROM days WHERE day < ?", (start.toordinal(),)
+            ).rowcount
+            deleted += self._db.execute(
+                "DELETE FROM days"
+                " WHERE kind != 'group' AND (day < ? OR fetched_at < ?)",
+                (oldest_day, time.time() - self.max_age),
+            ).rowcount
+            self._db.execute(
+                "DELETE FROM lessons WHERE NOT EXISTS ("
+                " SELECT 1 FROM days d WHERE d.kind = lessons.kind"
+                " AND d.entity_id = lessons.entity_id AND d.day = lessons.day)"
+            )
+            self._db.execute(
+                "DELETE FROM chunks WHERE last < ?", (start.toordinal(),)
+            )
+            self._db.commit()
+        self._compacted_at = time.time()
+        if deleted:
+            logger.info(f'Из зеркала удалено дней: {deleted}')
+        return deleted
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    # отрезки и валидаторы для инкрементального sync
+
+    def chunk(
+        self, kind: str, entity_id: str, first: date, last: date
+    ) -> Optional[Tuple[Optional[Validator], bool]]:
+        """Валидатор отрезка и признак final"""
+
+        with self._lock:
+            row = self._db.execute(
+                "SELECT etag, last_modified, size, final FROM chunks"
+                " WHERE kind = ? AND entity_id = ? AND first = ? AND last = ?",
+                (kind, str(entity_id), first.toordinal(), last.toordinal()),
+            ).fetchone()
+        if row is None:
+            return None
+        etag, modified, size, final = row
+        validator = Validator(etag, modified, size) if etag or modified else None
+        return validator, bool(final)
+
+    def save_chunk(
+        self,
+        kind: str,
+        entity_id: str,
+        first: date,
+        last: date,
+        validator: Optional[Validator],
+        synced_at: float,
+    ):
+        etag, modified, size = validator if validator is not None else (None, None, 0)
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO chunks VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    kind,
+                    str(entity_id),
+                    first.toordinal(),
+                    last.toordinal(),
+                    etag,
+                    modified,
+                    size,
+                    synced_at,
+                    date.fromtimestamp(synced_at) > last,
+                ),
+            )
+            self._db.commit()
+
+    def save_groups(self, group_ids: Iterable[str], synced_at: float):
+        """Заменяет список групп, за которые зеркало отвечает в timetable"""
+
+        with self._lock:
+            self._db.execute("DELETE FROM groups")
+            self._db.executemany(
+                "INSERT OR REPLACE INTO groups VALUES (?, ?)",
+                [(str(group), synced_at) for group in group_ids],
+            )
+            self._db.commit()
+
+    # выборки по зеркалу
+
+    def timetable(
+        self,
+        kind: str,
+        entity_id: str,
+        date_begin,
+        date_end,
+        max_age: float = MAX_AGE,
+        stale_after: float = FaAPI.CACHE_TTL["schedule"],
+    ) -> Optional[Timetable]:
+        """Расписание преподавателя, аудитории или здания из дней всех групп
+
+        Учитываются группы последнего sync. None - если хоть одной из них нет
+        за какой-то день периода или ее день старше max_age: тогда нужно идти
+        в РУЗ. Дни отрезков с final не стареют - sync их больше не качает.
+        """
+
+        field = KEYS[kind]
+        first, last = to_ordinal(date_begin), to_ordinal(date_end)
+        with self._lock:
+            (groups,) = self._db.execute("SELECT COUNT(*) FROM groups").fetchone()
+            known, oldest, loaded = self._db.execute(
+                "SELECT COUNT(*), MIN(CASE WHEN EXISTS ("
+                "  SELECT 1 FROM chunks c WHERE c.kind = 'group'"
+                "  AND c.entity_id = d.entity_id AND c.final"
+                "  AND d.day BETWEEN c.first AND c.last"
+                " ) THEN NULL ELSE d.fetched_at END), MIN(d.fetched_at)"
+                " FROM days d JOIN groups g ON g.entity_id = d.entity_id"
+                " WHERE d.kind = 'group' AND d.day BETWEEN ? AND ?",
+                (first, last),
+            ).fetchone()
+            if not groups or known < groups * (last - first + 1):
+                return None
+            # oldest - самый старый день, который еще может измениться
+            if oldest is not None and time.time() - oldest >= max_age:
+                return None
+            rows = self._db.execute(
+                f"SELECT day, entity_id, payload FROM lessons"
+                f" WHERE {field} = ? AND kind = 'group' AND day BETWEEN ? AND ?"
+                f" AND entity_id IN (SELECT entity_id FROM groups)",
+                (str(entity_id), first, last),
+            ).fetchall()
+
+        by_day: Dict[int, Dict[str, List[Lesson]]] = {}
+        for day, group, payload in rows:
+            lesson = Lesson.from_dict(json.loads(payload))
+            by_day.setdefault(day, {}).setdefault(group, []).append(lesson)
+        lessons = [
+            lesson for day in sorted(by_day) for lesson in merge_day(by_day[day])
+        ]
+        if oldest is None:
+            return Timetable(lessons, loaded, stale=False)
+        return Timetable(
+            lessons, oldest, stale=time.time() - oldest >= stale_after
+        )
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            counts = {
+                table: self._db.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+                for table in ("days", "lessons", "chunks", "groups")
+            }
+            (counts["final_chunks"],) = self._db.execute(
+                "SELECT COUNT(*) FROM chunks WHERE final"
+            ).fetchone()
+        counts["changed_days"] = self.changed_days
+        counts["unchanged_days"] = self.unchanged_days
+        return counts
+
+
+def list_groups(api: FaAPI, concurrency: int = 4) -> List[Dict]:
+    """Все группы РУЗ: обход поиска по тем же затравкам, что у справочника"""
+
+    found: Dict[str, Dict] = {}
+
+    def fetch(term):
+        try:
+            return api.search("group", term, cache=False) or []
+        except Exception as e:
+            logger.warning(f'Зеркало: поиск групп "{term}": {e}')
+            return []
+
+    pending: List[str] = list(SEED_TERMS)
+    with ThreadPoolExecutor(concurrency) as pool:
+        while pending:
+            deeper = []
+            for term, results in zip(pending, pool.map(fetch, pending)):
+                for entry in results:
+                    if not is_junk("group", entry):
+                        found[str(entry["id"])] = entry
+                deeper.extend(refine(term, results))
+            pending = deeper
+    return list(found.values())
+
+
+def sync(
+    api: FaAPI,
+    mirror: ScheduleMirror,
+    group_ids: Iterable[str],
+    first: date,
+    last: date,
+    chunk_days: int = 28,
+    concurrency: int = 4,
+) -> Dict[str, int]:
+    """Выкачивает расписание групп за [first, last] в зеркало
+
+    api должен писать в это же зеркало: FaAPI(days=DayCache(store=mirror)).
+    В конце список групп зеркала заменяется группами этого запуска, кроме
+    тех, у которых не скачался хоть один отрезок.
+    """
+
+    group_ids = [str(g) for g in group_ids]
+    today = date.today()
+    counters = dict.fromkeys(("requests", "skipped", "failed"), 0)
+    failed = set()
+    for chunk_first, chunk_last in chunks(first, last, chunk_days):
+        date_range = api._date_range(chunk_first, chunk_last)
+        pending = []
+        for group in group_ids:
+            known = mirror.chunk("group", group, chunk_first, chunk_last)
+            if known is not None:
+                validator, final = known
+                # прошедший отрезок, скачанный после своего окончания, уже не изменится
+                if final:
+                    counters["skipped"] += 1
+                    continue
+                if validator is not None:
+                    api.validators.set(
+                        api._timetable_key("group", group, *date_range),
+                        validator,
+                        api.cache_ttl["max_stale"],
+                    )
+            pending.append(group)
+
+        # max_age=0: каждый отрезок идет в РУЗ, но условным запросом
+        started = time.time()
+        for result in api.timetable_many(
+            "group", pending, chunk_first, chunk_last,
+            concurrency=concurrency, max_age=0,
+        ):
+            counters["requests"] += 1
+            # РУЗ не ответил, и FaAPI отдал прошлую копию из зеркала
+            if result.error is None and result.lessons.fetched_at < started:
+                result = result._replace(error=RuntimeError("отдано из зеркала"))
+            if result.error is not None:
+                counters["failed"] += 1
+                failed.add(str(result.entity_id))
+                logger.warning(
+                    f'Зеркало: группа {result.entity_id} '
+                    f'{chunk_first}..{chunk_last}: {result.error}'
+                )
+                continue
+            validator = api.validators.get(
+                api._timetable_key("group", result.entity_id, *date_range)
+            )
+            mirror.save_chunk(
+                "group",
+                result.entity_id,
+                chunk_first,
+                chunk_last,
+                None if validator is MISSING else validator,
+                time.time(),
+            )
+        logger.info(
+            f'Зеркало: {chunk_first}..{chunk_last} готово, {counters}, '
+            f'{mirror.stats()}'
+        )
+        if chunk_last < today:
+            # прошлые дни не нужны в памяти, пока качаются следующие отрезки
+            api.days.clear()
+
+    mirror.save_groups([g for g in group_ids if g not in failed], time.time())
+    counters["groups_failed"] = len(failed)
+    counters["not_modified"] = api.traffic.get("schedule", {}).get("not_modified", 0)
+    return counters
+
+
+def _day(value: str) -> date:
+    return datetime.strptime(value, "%Y.%m.%d").date()
+
+
+def main():
+    logging.basicConfig(
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+        level=logging.INFO,
+    )
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    sync_cmd = commands.add_parser("sync", help="выкачать расписание всех групп")
+    sync_cmd.add_argument("--db", default=MIRROR_PATH)
+    sync_cmd.add_argument("--from", dest="first", type=_day, help="ГГГГ.ММ.ДД")
+    sync_cmd.add_argument("--to", dest="last", type=_day, help="ГГГГ.ММ.ДД")
+    sync_cmd.add_argument("--chunk-days", type=int, default=28)
+    sync_cmd.add_argument("--concurrency", type=int, default=4)
+    sync_cmd.add_argument("--groups", help="id групп через запятую вместо обхода")
+
+    stats_cmd = commands.add_parser("stats", help="что лежит в зеркале")
+    stats_cmd.add_argument("--db", default=MIRROR_PATH)
+
+    compact_cmd = commands.add_parser("compact", help="удалить дни вне семестра")
+    compact_cmd.add_argument("--db", default=MIRROR_PATH)
+
+    args = parser.parse_args()
+    mirror = ScheduleMirror(args.db)
+    try:
+        if args.command == "stats":
+            print(json.dumps(mirror.stats(), ensure_ascii=False))
+            return
+        if args.command == "compact":
+            deleted = mirror.compact()
+            print(json.dumps(dict(mirror.stats(), deleted=deleted), ensure_ascii=False))
+            return
+
+        default_first, default_last = semester()
+        first, last = args.first or default_first, args.last or default_last
+        api = FaAPI(days=DayCache(store=mirror))
+        try:
+            started = time.monotonic()
+            if args.groups:
+                group_ids = args.groups.split(",")
+            else:
+                group_ids = [g["id"] for g in list_groups(api, args.concurrency)]
+                logger.info(f'Зеркало: групп в РУЗ {len(group_ids)}')
+            counters = sync(
+                api, mirror, group_ids, first, last, args.chunk_days, args.concurrency
+            )
+            counters["seconds"] = round(time.monotonic() - started)
+            print(json.dumps(dict(counters, **mirror.stats()), ensure_ascii=False))
+        finally:
+            api.close()
+    finally:
+        mirror.close()
+
+
+if __name__ == "__main__":
+    main()
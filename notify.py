@@ -0,0 +1,496 @@
+import html
+import json
+import logging
+import sqlite3
+import threading
+import time
+from datetime import date
+from datetime import timedelta
+from typing import Awaitable
+from typing import Callable
+from typing import Dict
+from typing import Iterable
+from typing import List
+from typing import NamedTuple
+from typing import Optional
+from typing import Tuple
+
+from lessons import Lesson
+from lessons import by_day
+from lessons import day_label
+from lessons import fingerprint
+from periodic import PeriodicTask
+
+logger = logging.getLogger(__name__)
+
+# поля занятия, изменение которых показываем подписчикам
+WATCHED = (
+    "begin_lesson",
+    "end_lesson",
+    "discipline",
+    "kind_of_work",
+    "lecturer",
+    "auditorium",
+    "building",
+    "group",
+    "stream",
+    "sub_group",
+)
+
+FIELD_NAMES = {
+    "discipline": "дисциплина",
+    "kind_of_work": "вид занятия",
+    "lecturer": "преподаватель",
+    "auditorium": "аудитория",
+    "building": "здание",
+    "group": "группа",
+    "stream": "поток",
+    "sub_group": "подгруппа",
+}
+
+
+def lesson_key(lesson: Lesson):
+    """Чем занятие остается "тем же" после переноса: lessonOid РУЗ"""
+
+    if lesson.lesson_oid is not None:
+        return lesson.lesson_oid
+    return (lesson.begin_lesson, lesson.discipline, lesson.sub_group)
+
+
+def day_fingerprint(lessons: Iterable[Lesson]) -> str:
+    """Отпечаток дня, не зависящий от порядка занятий в ответе РУЗ"""
+
+    return fingerprint(
+        sorted(
+            [str(lesson_key(l))] + [str(getattr(l, f) or "") for f in WATCHED]
+            for l in lessons
+        )
+    )
+
+
+class Change(NamedTuple):
+    """Изменение одного занятия: added, removed или changed"""
+
+    action: str
+    before: Optional[Lesson]
+    after: Optional[Lesson]
+    fields: Tuple[str, ...]
+
+
+def diff_day(old: List[Lesson], new: List[Lesson]) -> List[Change]:
+    """Что изменилось в дне: занятия сопоставляются по lesson_key"""
+
+    before = {lesson_key(l): l for l in old}
+    after = {lesson_key(l): l for l in new}
+    changes = []
+    for key, lesson in after.items():
+        prev = before.get(key)
+        if prev is None:
+            changes.append(Change("added", None, lesson, ()))
+            continue
+        fields = tuple(f for f in WATCHED if getattr(prev, f) != getattr(lesson, f))
+        if fields:
+            changes.append(Change("changed", prev, lesson, fields))
+    for key, lesson in before.items():
+        if key not in after:
+            changes.append(Change("removed", lesson, None, ()))
+    changes.sort(key=lambda c: (c.after or c.before).begin or 0)
+    return changes
+
+
+def _time(lesson: Lesson) -> str:
+    return f"{lesson.begin_lesson or ''}-{lesson.end_lesson or ''}"
+
+
+def _title(lesson: Lesson) -> str:
+    title = html.escape(lesson.discipline or "Без названия")
+    if lesson.kind_of_work:
+        title += f" ({html.escape(lesson.kind_of_work)})"
+    return title
+
+
+def format_changes(name: str, changes: Dict[int, List[Change]]) -> str:
+    """Текст уведомления; один на сущность, общий для всех ее подписчиков"""
+
+    lines = [f"🔔 <b>Изменения в расписании: {html.escape(name)}</b>", ""]
+    for day in sorted(changes):
+        lines.append(f"<b>📆 {day_label(day)}</b>")
+        for change in changes[day]:
+            if change.action == "added":
+                lines.append(f"➕ {_time(change.after)} {_title(change.after)}")
+            elif change.action == "removed":
+                lines.append(
+                    f"❌ Отменено: {_time(change.before)} {_title(change.before)}"
+                )
+            else:
+                parts = []
+                if {"begin_lesson", "end_lesson"} & set(change.fields):
+                    moved = f"{_time(change.before)} → {_time(change.after)}"
+                    parts.append(f"время {moved}")
+                for field in change.fields:
+                    if field in FIELD_NAMES:
+                        old = html.escape(str(getattr(change.before, field) or "—"))
+                        new = html.escape(str(getattr(change.after, field) or "—"))
+                        parts.append(f"{FIELD_NAMES[field]} {old} → {new}")
+                lines.append(
+                    f"✏️ {_time(change.before)} {_title(change.before)}: "
+                    + "; ".join(parts)
+                )
+        lines.append("")
+    return "\n".join(lines)
+
+
+class SubscriptionStore:
+    """Подписки чатов на изменения расписаний и последние снимки дней в SQLite
+
+    Снимок - занятия дня и их fingerprint на момент последней проверки;
+    с ним сравнивается свежий ответ РУЗ, в том числе после перезапуска.
+    Здесь же хранится вечерняя рассылка: у чата не больше одной.
+    """
+
+    def __init__(self, path: str = "subscriptions.db"):
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS subscriptions ("
+            " chat_id INTEGER NOT NULL,"
+            " kind TEXT NOT NULL,"
+            " entity_id TEXT NOT NULL,"
+            " label TEXT NOT NULL,"
+            " created_at REAL NOT NULL,"
+            " PRIMARY KEY (chat_id, kind, entity_id))"
+        )
+        self._db.execute(
+            "CREATE INDEX IF NOT EXISTS subscriptions_entity"
+            " ON subscriptions (kind, entity_id)"
+        )
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS snapshots ("
+            " kind TEXT NOT NULL,"
+            " entity_id TEXT NOT NULL,"
+            " day INTEGER NOT NULL,"
+            " hash TEXT NOT NULL,"
+            " payload TEXT NOT NULL,"
+            " PRIMARY KEY (kind, entity_id, day))"
+        )
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS digests ("
+            " chat_id INTEGER PRIMARY KEY,"
+            " kind TEXT NOT NULL,"
+            " entity_id TEXT NOT NULL,"
+            " label TEXT NOT NULL)"
+        )
+        self._db.execute(
+            "CREATE INDEX IF NOT EXISTS digests_entity ON digests (kind, entity_id)"
+        )
+        self._db.commit()
+
+    def add(self, chat_id: int, kind: str, entity_id: str, label: str) -> bool:
+        """Подписывает чат; False, если подписка уже была"""
+
+        with self._lock:
+            added = self._db.execute(
+                "INSERT OR IGNORE INTO subscriptions VALUES (?, ?, ?, ?, ?)",
+                (chat_id, kind, str(entity_id), label, time.time()),
+            ).rowcount
+            self._db.commit()
+        return added > 0
+
+    def remove(
+        self, chat_id: int, kind: Optional[str] = None, entity_id: Optional[str] = None
+    ) -> int:
+        """Отписывает чат от одной сущности или, без kind, от всех"""
+
+        with self._lock:
+            if kind is None:
+                removed = self._db.execute(
+                    "DELETE FROM subscriptions WHERE chat_id = ?", (chat_id,)
+                ).rowcount
+            else:
+                removed = self._db.execute(
+                    "DELETE FROM subscriptions"
+                    " WHERE chat_id = ? AND kind = ? AND entity_id = ?",
+                    (chat_id, kind, str(entity_id)),
+                ).rowcount
+            self._db.commit()
+        return removed
+
+    def of_chat(self, chat_id: int) -> List[Tuple[str, str, str]]:
+        """Подписки чата: (kind, entity_id, label)"""
+
+        with self._lock:
+            return self._db.execute(
+                "SELECT kind, entity_id, label FROM subscriptions"
+                " WHERE chat_id = ? ORDER BY created_at",
+                (chat_id,),
+            ).fetchall()
+
+    def entities(self) -> Dict[str, Dict[str, str]]:
+        """Различные сущности с подписчиками: kind -> {entity_id: label}"""
+
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT kind, entity_id, MAX(label) FROM subscriptions"
+                " GROUP BY kind, entity_id"
+            ).fetchall()
+        found: Dict[str, Dict[str, str]] = {}
+        for kind, entity_id, label in rows:
+            found.setdefault(kind, {})[entity_id] = label
+        return found
+
+    def chats(self, kind: str, entity_id: str) -> List[int]:
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT chat_id FROM subscriptions WHERE kind = ? AND entity_id = ?",
+                (kind, str(entity_id)),
+            ).fetchall()
+        return [chat_id for chat_id, in rows]
+
+    def set_digest(self, chat_id: int, kind: str, entity_id: str, label: str):
+        """Включает чату вечернюю рассылку по сущности (заменяет прежнюю)"""
+
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO digests VALUES (?, ?, ?, ?)",
+                (chat_id, kind, str(entity_id), label),
+            )
+            self._db.commit()
+
+    def remove_digest(self, chat_id: int) -> bool:
+        with self._lock:
+            removed = self._db.execute(
+                "DELETE FROM digests WHERE chat_id = ?", (chat_id,)
+            ).rowcount
+            self._db.commit()
+        return removed > 0
+
+    def digest_of(self, chat_id: int) -> Optional[Tuple[str, str, str]]:
+        """Рассылка чата: (kind, entity_id, label) или None"""
+
+        with self._lock:
+            return self._db.execute(
+                "SELECT kind, entity_id, label FROM digests WHERE chat_id = ?",
+                (chat_id,),
+            ).fetchone()
+
+    def digest_entities(self) -> Dict[str, Dict[str, str]]:
+        """Различные сущности вечерней рассылки: kind -> {entity_id: label}"""
+
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT kind, entity_id, MAX(label) FROM digests"
+                " GROUP BY kind, entity_id"
+            ).fetchall()
+        found: Dict[str, Dict[str, str]] = {}
+        for kind, entity_id, label in rows:
+            found.setdefault(kind, {})[entity_id] = label
+        return found
+
+    def digest_chats(self, kind: str, entity_id: str) -> List[int]:
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT chat_id FROM digests WHERE kind = ? AND entity_id = ?",
+                (kind, str(entity_id)),
+            ).fetchall()
+        return [chat_id for chat_id, in rows]
+
+    def hashes(self, kind: str, entity_id: str) -> Dict[int, str]:
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT day, hash FROM snapshots WHERE kind = ? AND entity_id = ?",
+                (kind, str(entity_id)),
+            ).fetchall()
+        return dict(rows)
+
+    def snapshot(self, kind: str, entity_id: str, day: int) -> List[Lesson]:
+        with self._lock:
+            row = self._db.execute(
+                "SELECT payload FROM snapshots"
+                " WHERE kind = ? AND entity_id = ? AND day = ?",
+                (kind, str(entity_id), day),
+            ).fetchone()
+        if row is None:
+            return []
+        return [Lesson.from_dict(raw) for raw in json.loads(row[0])]
+
+    def save_snapshots(
+        self, kind: str, entity_id: str, days: Dict[int, Tuple[str, List[Lesson]]]
+    ):
+        rows = [
+            (
+                kind,
+                str(entity_id),
+                day,
+                digest,
+                json.dumps([l.to_dict() for l in lessons], ensure_ascii=False),
+            )
+            for day, (digest, lessons) in days.items()
+        ]
+        with self._lock:
+            self._db.executemany(
+                "INSERT OR REPLACE INTO snapshots VALUES (?, ?, ?, ?, ?)", rows
+            )
+            self._db.commit()
+
+    def prune_snapshots(self, before_day: int) -> int:
+        """Удаляет снимки прошедших дней и сущностей без подписчиков"""
+
+        with self._lock:
+            deleted = self._db.execute(
+                "DELETE FROM snapshots WHERE day < ? OR NOT EXISTS ("
+                " SELECT 1 FROM subscriptions s"
+                " WHERE s.kind = snapshots.kind AND s.entity_id = snapshots.entity_id)",
+                (before_day,),
+            ).rowcount
+            self._db.commit()
+        return deleted
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+class ChangeNotifier:
+    """Фоновая проверка расписаний с подписчиками и рассылка изменений
+
+    Стоимость проверки зависит от числа различных сущностей, а не
+    подписчиков: каждая сущность загружается и сравнивается один раз,
+    текст уведомления рендерится один раз и уходит всем ее подписчикам.
+    """
+
+    def __init__(
+        self,
+        api,
+        subscriptions: SubscriptionStore,
+        send: Callable[[int, str], Awaitable],
+        days_ahead: int = 7,
+        interval: float = 15 * 60,
+        concurrency: int = 4,
+    ):
+        self.api = api
+        self.subscriptions = subscriptions
+        self.send = send
+        self.days_ahead = days_ahead
+        self.interval = interval
+        self.concurrency = concurrency
+        # (kind, id) -> {день: fingerprint}; сами занятия снимков - только на диске
+        self._hashes: Dict[Tuple[str, str], Dict[int, str]] = {}
+        self.polls = 0
+        self.checked = 0
+        self.changed = 0
+        self.notified = 0
+        self.failed = 0
+        self._periodic = PeriodicTask(
+            self._step,
+            lambda: self.interval,
+            'Ошибка проверки изменений расписания',
+            immediate=True,
+            log=logger,
+        )
+
+    def compare(
+        self, kind: str, entity_id: str, lessons: List[Lesson], first: date, last: date
+    ) -> Dict[int, List[Change]]:
+        """Сравнивает свежие занятия со снимками и обновляет снимки
+
+        День, для которого снимка еще нет (новая подписка, новый день в
+        горизонте), только запоминается.
+        """
+
+        key = (kind, str(entity_id))
+        known = self._hashes.get(key)
+        if known is None:
+            known = self._hashes[key] = self.subscriptions.hashes(kind, entity_id)
+
+        days = dict(by_day(lessons))
+        changes: Dict[int, List[Change]] = {}
+        updates: Dict[int, Tuple[str, List[Lesson]]] = {}
+        for day in range(first.toordinal(), last.toordinal() + 1):
+            new = days.get(day, [])
+            digest = day_fingerprint(new)
+            old_digest = known.get(day)
+            if old_digest == digest:
+                continue
+            if old_digest is not None:
+                day_changes = diff_day(
+                    self.subscriptions.snapshot(kind, entity_id, day), new
+                )
+                if day_changes:
+                    changes[day] = day_changes
+            updates[day] = (digest, new)
+
+        if updates:
+            self.subscriptions.save_snapshots(kind, entity_id, updates)
+            known.update((day, digest) for day, (digest, _) in updates.items())
+        return changes
+
+    async def notify(self, kind: str, entity_id: str, label: str, text: str):
+        for chat_id in self.subscriptions.chats(kind, entity_id):
+            try:
+                await self.send(chat_id, text)
+                self.notified += 1
+            except Exception as e:
+                logger.warning(f'Не удалось уведомить чат {chat_id} о {label}: {e}')
+
+    async def poll(self) -> int:
+        """Один проход по всем сущностям с подписчиками; сколько изменилось"""
+
+        first = date.today()
+        last = first + timedelta(days=self.days_ahead - 1)
+        self.subscriptions.prune_snapshots(first.toordinal())
+        self._hashes.clear()
+
+        changed = 0
+        for kind, labels in self.subscriptions.entities().items():
+            async for result in self.api.timetable_many(
+                kind,
+                list(labels),
+                first,
+                last,
+                concurrency=self.concurrency,
+                max_age=self.api.cache_ttl["schedule"],
+            ):
+                self.checked += 1
+                if result.error is not None:
+                    self.failed += 1
+                    logger.warning(
+                        f'Проверка изменений {kind} {result.entity_id}: {result.error}'
+                    )
+                    continue
+                # РУЗ недоступен и отдан кэш: сравнивать не с чем
+                if getattr(result.lessons, "stale", False):
+                    continue
+                changes = self.compare(
+                    kind, result.entity_id, result.lessons, first, last
+                )
+                if changes:
+                    changed += 1
+                    label = labels[result.entity_id]
+                    await self.notify(
+                        kind, result.entity_id, label, format_changes(label, changes)
+                    )
+        self.polls += 1
+        self.changed += changed
+        return changed
+
+    async def _step(self):
+        changed = await self.poll()
+        logger.info(f'Проверка изменений: изменилось {changed}, {self.stats()}')
+
+    def start(self):
+        self._periodic.start()
+
+    async def stop(self):
+        await self._periodic.stop()
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "polls": self.polls,
+            "checked": self.checked,
+            "changed": self.changed,
+            "notified": self.notified,
+            "failed": self.failed,
+        }
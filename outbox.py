@@ -0,0 +1,214 @@
+import asyncio
+import itertools
+import logging
+import random
+import time
+from collections import deque
+from typing import Any
+from typing import Awaitable
+from typing import Callable
+from typing import Deque
+from typing import Dict
+from typing import List
+from typing import Optional
+
+import aiohttp
+from aiomax import exceptions
+
+from limits import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+# полосы по убыванию приоритета
+LANES = {"interactive": 0, "notify": 1, "digest": 2}
+
+
+# код ошибки MAX API для 429; aiomax кладет его в UnknownErrorException.text
+RATE_LIMITED_CODE = "too.many.requests"
+
+
+def is_rate_limited(error: Exception) -> bool:
+    """MAX API ответил 429 (aiomax не сохраняет статус, только код из ответа)"""
+
+    if isinstance(error, aiohttp.ClientResponseError):
+        return error.status == 429
+    if isinstance(error, exceptions.UnknownErrorException):
+        return str(error.text).strip().lower() == RATE_LIMITED_CODE
+    return False
+
+
+class _Item:
+    __slots__ = ("chat_id", "text", "kwargs", "lane", "future", "attempts")
+
+    def __init__(self, chat_id, text, kwargs, lane, future):
+        self.chat_id = chat_id
+        self.text = text
+        self.kwargs = kwargs
+        self.lane = lane
+        self.future = future
+        self.attempts = 0
+
+
+class Outbox:
+    """Очередь исходящих сообщений бота
+
+    Все отправки идут через общий token bucket и ограниченное число
+    воркеров. Сообщения одного чата уходят строго по порядку: пока первое
+    не доставлено (или не отброшено), следующие ждут. Из готовых чатов
+    первым обслуживается тот, чье сообщение в более приоритетной полосе,
+    поэтому ответы пользователям не стоят за рассылкой. На 429 отправка
+    повторяется с экспоненциальной паузой, а весь поток притормаживает.
+    """
+
+    def __init__(
+        self,
+        send: Callable[..., Awaitable[Any]],
+        rate: float = 20.0,
+        burst: Optional[float] = None,
+        workers: int = 8,
+        retries: int = 5,
+        backoff_base: float = 1.0,
+        backoff_cap: float = 60.0,
+    ):
+        self.send_func = send
+        self.limiter = TokenBucket(rate, burst)
+        self.workers = workers
+        self.retries = retries
+        self.backoff_base = backoff_base
+        self.backoff_cap = backoff_cap
+        self._chats: Dict[Any, Deque[_Item]] = {}
+        self._ready: Optional[asyncio.PriorityQueue] = None
+        self._seq = itertools.count()
+        self._paused_until = 0.0
+        self._tasks: List[asyncio.Task] = []
+        self.queued = dict.fromkeys(LANES, 0)
+        self.sent = 0
+        self.failed = 0
+        self.retried = 0
+        self.throttled = 0
+
+    def __len__(self) -> int:
+        return sum(len(items) for items in self._chats.values())
+
+    def enqueue(self, chat_id, text: str, lane: str = "notify", **kwargs):
+        """Ставит сообщение в очередь, не дожидаясь отправки"""
+
+        self._put(_Item(chat_id, text, kwargs, lane, None))
+
+    async def send(self, chat_id, text: str, lane: str = "interactive", **kwargs):
+        """Ставит сообщение в очередь и ждет доставки; ошибка пробрасывается"""
+
+        future = asyncio.get_event_loop().create_future()
+        self._put(_Item(chat_id, text, kwargs, lane, future))
+        return await future
+
+    def _put(self, item: _Item):
+        if self._ready is None:
+            self._ready = asyncio.PriorityQueue()
+        self.queued[item.lane] += 1
+        items = self._chats.get(item.chat_id)
+        if items is None:
+            self._chats[item.chat_id] = deque([item])
+            self._schedule(item.chat_id)
+        else:
+            # чат уже в очереди или в отправке: встанет после своих сообщений
+            items.append(item)
+
+    def _schedule(self, chat_id):
+        """Делает чат готовым к отправке с приоритетом его первого сообщения"""
+
+        items = self._chats.get(chat_id)
+        if items:
+            self._ready.put_nowait((LANES[items[0].lane], next(self._seq), chat_id))
+
+    def _backoff(self, attempt: int) -> float:
+        ceiling = min(self.backoff_cap, self.backoff_base * 2 ** attempt)
+        return random.uniform(ceiling / 2, ceiling)
+
+    def _retryable(self, error: Exception) -> bool:
+        return is_rate_limited(error) or isinstance(
+            error, (exceptions.InternalError, aiohttp.ClientError, asyncio.TimeoutError)
+        )
+
+    async def _deliver(self, item: _Item) -> Optional[float]:
+        """Отправляет сообщение; пауза до повтора или None, если с ним покончено"""
+
+        try:
+            result = await self.send_func(item.chat_id, item.text, **item.kwargs)
+        except Exception as e:
+            item.attempts += 1
+            if self._retryable(e) and item.attempts <= self.retries:
+                delay = self._backoff(item.attempts - 1)
+                self.retried += 1
+                if is_rate_limited(e):
+                    self.throttled += 1
+                    resume = time.monotonic() + delay
+                    self._paused_until = max(self._paused_until, resume)
+                return delay
+            self.failed += 1
+            if item.future is not None:
+                if not item.future.done():
+                    item.future.set_exception(e)
+            else:
+                chat_id = item.chat_id
+                logger.warning(f'Не удалось отправить сообщение в чат {chat_id}: {e}')
+            return None
+
+        self.sent += 1
+        if item.future is not None and not item.future.done():
+            item.future.set_result(result)
+        return None
+
+    async def _worker(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            # токен берем уже под конкретный чат: иначе простаивающие воркеры
+            # копят токены и отправляют пачкой сверх rate
+            _, _, chat_id = await self._ready.get()
+            await self.limiter.acquire()
+            pause = self._paused_until - time.monotonic()
+            if pause > 0:
+                await asyncio.sleep(pause)
+
+            items = self._chats[chat_id]
+            item = items[0]
+            delay = await self._deliver(item)
+            if delay is not None:
+                # сообщение остается первым в чате, чтобы не нарушить порядок
+                loop.call_later(delay, self._schedule, chat_id)
+                continue
+            items.popleft()
+            self.queued[item.lane] -= 1
+            if items:
+                self._schedule(chat_id)
+            else:
+                del self._chats[chat_id]
+
+    def start(self):
+        if self._ready is None:
+            self._ready = asyncio.PriorityQueue()
+        self._tasks = [t for t in self._tasks if not t.done()]
+        while len(self._tasks) < self.workers:
+            self._tasks.append(asyncio.ensure_future(self._worker()))
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        if len(self):
+            logger.warning(f'Остановка: не отправлено сообщений: {len(self)}')
+        for items in self._chats.values():
+            for item in items:
+                if item.future is not None and not item.future.done():
+                    item.future.cancel()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "queued": dict(self.queued),
+            "chats": len(self._chats),
+            "sent": self.sent,
+            "failed": self.failed,
+            "retried": self.retried,
+            "throttled": self.throttled,
+        }
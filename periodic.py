@@ -0,0 +1,72 @@
+import asyncio
+import logging
+from typing import Any
+from typing import Awaitable
+from typing import Callable
+from typing import Optional
+from typing import Union
+
+logger = logging.getLogger(__name__)
+
+Delay = Union[float, Callable[[], float]]
+
+
+def _as_delay(value: Delay) -> Callable[[], float]:
+    if callable(value):
+        return value
+    return lambda: value
+
+
+class PeriodicTask:
+    """Фоновая задача, которая раз в interval секунд вызывает step
+
+    interval - число или функция, которая считает паузу перед следующим
+    вызовом (например, до ближайшего окна). Ошибка шага пишется в лог
+    с префиксом error, после нее пауза - retry, если он задан. immediate
+    запускает первый шаг сразу, а не после первой паузы.
+    """
+
+    def __init__(
+        self,
+        step: Callable[[], Awaitable[Any]],
+        interval: Delay,
+        error: str,
+        immediate: bool = False,
+        retry: Optional[Delay] = None,
+        log: logging.Logger = logger,
+    ):
+        self.step = step
+        self.interval = _as_delay(interval)
+        self.retry = _as_delay(retry) if retry is not None else self.interval
+        self.error = error
+        self.immediate = immediate
+        self.log = log
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    async def _run(self):
+        delay = 0.0 if self.immediate else self.interval()
+        while True:
+            await asyncio.sleep(max(0.0, delay))
+            try:
+                await self.step()
+                delay = self.interval()
+            except Exception as e:
+                self.log.error(f'{self.error}: {e}')
+                delay = self.retry()
+
+    def start(self):
+        if not self.running:
+            self._task = asyncio.ensure_future(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
@@ -0,0 +1,218 @@
+import random
+import threading
+import time
+from collections import deque
+from typing import Dict
+from typing import Optional
+from typing import Tuple
+
+
+class CircuitOpenError(Exception):
+    """РУЗ недавно много раз подряд не ответил, запросы временно не отправляются"""
+
+
+class CircuitBreaker:
+    """Предохранитель для запросов к РУЗ
+
+    После threshold ошибок подряд размыкается на cooldown секунд: запросы
+    сразу отклоняются, не копя таймауты. Затем пропускает пробный запрос раз
+    в cooldown; первый же успех замыкает цепь обратно.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, threshold: int = 5, cooldown: float = 30.0):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened = 0
+        self.rejected = 0
+        self._opened_at = None
+        self._probe_at = 0.0
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        if self._opened_at is None:
+            return self.CLOSED
+        if time.monotonic() - self._opened_at < self.cooldown:
+            return self.OPEN
+        return self.HALF_OPEN
+
+    @property
+    def is_open(self) -> bool:
+        return self.state == self.OPEN
+
+    def allow(self) -> bool:
+        """Можно ли сейчас отправить запрос"""
+
+        with self._lock:
+            state = self.state
+            if state == self.CLOSED:
+                return True
+            now = time.monotonic()
+            if state == self.HALF_OPEN and now - self._probe_at >= self.cooldown:
+                self._probe_at = now
+                return True
+            self.rejected += 1
+            return False
+
+    def success(self):
+        with self._lock:
+            self.failures = 0
+            self._opened_at = None
+
+    def failure(self):
+        with self._lock:
+            self.failures += 1
+            if self._opened_at is not None or self.failures >= self.threshold:
+                if self._opened_at is None:
+                    self.opened += 1
+                self._opened_at = time.monotonic()
+                self._probe_at = 0.0
+
+    def stats(self) -> dict:
+        return {
+            "state": self.state,
+            "failures": self.failures,
+            "opened": self.opened,
+            "rejected": self.rejected,
+        }
+
+
+class RetryBudget:
+    """Общий на клиент запас повторов и хеджей
+
+    Каждый исходный запрос добавляет ratio токена, каждый повтор или хедж
+    тратит один. Так повторов не больше ratio от трафика (плюс небольшой
+    запас reserve) и при отказе РУЗ они не умножают нагрузку на него.
+    """
+
+    def __init__(self, ratio: float = 0.1, reserve: float = 10.0):
+        self.ratio = ratio
+        self.reserve = reserve
+        self._tokens = reserve
+        self.exhausted = 0
+        self._lock = threading.Lock()
+
+    @property
+    def tokens(self) -> float:
+        return self._tokens
+
+    def deposit(self):
+        with self._lock:
+            self._tokens = min(self.reserve, self._tokens + self.ratio)
+
+    def withdraw(self) -> bool:
+        with self._lock:
+            if self._tokens >= 1.0:
+                self._tokens -= 1.0
+                return True
+            self.exhausted += 1
+            return False
+
+
+class LatencyWindow:
+    """Последние window задержек успешных ответов одного эндпоинта"""
+
+    def __init__(self, window: int = 200):
+        self._samples = deque(maxlen=window)
+
+    def __len__(self) -> int:
+        return len(self._samples)
+
+    def record(self, seconds: float):
+        self._samples.append(seconds)
+
+    def percentile(self, q: float) -> Optional[float]:
+        if not self._samples:
+            return None
+        ordered = sorted(self._samples)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+class RequestPolicy:
+    """Таймауты, повторы и хеджирование запросов к РУЗ
+
+    Сами циклы повторов живут в клиентах (синхронный и асинхронный),
+    здесь - только решения: сколько ждать, повторять ли, когда хеджировать.
+    """
+
+    # (connect, read) в секундах по классам эндпоинтов
+    TIMEOUTS = {"search": (3.0, 10.0), "schedule": (3.0, 10.0)}
+
+    def __init__(
+        self,
+        timeouts: Optional[Dict[str, Tuple[float, float]]] = None,
+        retries: int = 2,
+        backoff_base: float = 0.2,
+        backoff_cap: float = 2.0,
+        hedge: bool = True,
+        hedge_min_samples: int = 20,
+        hedge_min_delay: float = 0.05,
+        budget: Optional[RetryBudget] = None,
+    ):
+        self.timeouts = dict(self.TIMEOUTS, **(timeouts or {}))
+        self.retries = retries
+        self.backoff_base = backoff_base
+        self.backoff_cap = backoff_cap
+        self.hedge = hedge
+        self.hedge_min_samples = hedge_min_samples
+        self.hedge_min_delay = hedge_min_delay
+        self.budget = budget if budget is not None else RetryBudget()
+        self.latency: Dict[str, LatencyWindow] = {}
+        self.retried = 0
+        self.hedged = 0
+        self.hedge_wins = 0
+
+    def timeout(self, endpoint: str) -> Tuple[float, float]:
+        return self.timeouts.get(endpoint, self.TIMEOUTS["schedule"])
+
+    def backoff(self, attempt: int) -> float:
+        """Пауза перед повтором: экспонента с полным джиттером"""
+
+        ceiling = min(self.backoff_cap, self.backoff_base * 2 ** attempt)
+        return random.uniform(0, ceiling)
+
+    def should_retry(self, attempt: int) -> bool:
+        """Можно ли сделать еще одну попытку после attempt неудачных"""
+
+        if attempt > self.retries or not self.budget.withdraw():
+            return False
+        self.retried += 1
+        return True
+
+    def record(self, endpoint: str, seconds: float):
+        window = self.latency.get(endpoint)
+        if window is None:
+            window = self.latency[endpoint] = LatencyWindow()
+        window.record(seconds)
+
+    def hedge_delay(self, endpoint: str) -> Optional[float]:
+        """Через сколько слать второй запрос (наблюдаемый p95), None - не слать"""
+
+        window = self.latency.get(endpoint)
+        if not self.hedge or window is None or len(window) < self.hedge_min_samples:
+            return None
+        return max(self.hedge_min_delay, window.percentile(0.95))
+
+    def should_hedge(self) -> bool:
+        if not self.budget.withdraw():
+            return False
+        self.hedged += 1
+        return True
+
+    def stats(self) -> dict:
+        return {
+            "retried": self.retried,
+            "hedged": self.hedged,
+            "hedge_wins": self.hedge_wins,
+            "budget": round(self.budget.tokens, 2),
+            "budget_exhausted": self.budget.exhausted,
+            "p95": {
+                endpoint: window.percentile(0.95)
+                for endpoint, window in self.latency.items()
+            },
+        }
@@ -0,0 +1,253 @@
+import asyncio
+import logging
+import sqlite3
+import threading
+from collections import Counter
+from datetime import datetime
+from datetime import timedelta
+from typing import Dict
+from typing import List
+from typing import Optional
+from typing import Sequence
+from typing import Tuple
+
+from limits import TokenBucket
+from periodic import PeriodicTask
+
+logger = logging.getLogger(__name__)
+
+POPULARITY_PATH = "popularity.db"
+
+
+class PopularityStore:
+    """Счетчики запросов расписаний в SQLite, общие для процессов бота
+
+    Процессы-обработчики копят запросы в памяти и время от времени
+    прибавляют их к счетчикам; прогрев в фоновом процессе берет отсюда топ.
+    """
+
+    def __init__(self, path: str = POPULARITY_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute("PRAGMA busy_timeout=5000")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS popularity ("
+            " kind TEXT NOT NULL,"
+            " entity_id TEXT NOT NULL,"
+            " count INTEGER NOT NULL,"
+            " PRIMARY KEY (kind, entity_id))"
+        )
+        self._db.commit()
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM popularity").fetchone()[0]
+
+    def add(self, counts: Dict[Tuple[str, str], int]):
+        with self._lock:
+            with self._db:
+                self._db.executemany(
+                    "INSERT INTO popularity VALUES (?, ?, ?)"
+                    " ON CONFLICT (kind, entity_id)"
+                    " DO UPDATE SET count = count + excluded.count",
+                    [(kind, eid, count) for (kind, eid), count in counts.items()],
+                )
+
+    def decay(self):
+        """Делит счетчики пополам, чтобы в топе были актуальные сущности"""
+
+        with self._lock:
+            with self._db:
+                self._db.execute("UPDATE popularity SET count = count / 2")
+                self._db.execute("DELETE FROM popularity WHERE count = 0")
+
+    def top(self, n: int) -> List[Tuple[str, str]]:
+        with self._lock:
+            return [
+                (kind, eid)
+                for kind, eid in self._db.execute(
+                    "SELECT kind, entity_id FROM popularity"
+                    " ORDER BY count DESC LIMIT ?",
+                    (n,),
+                )
+            ]
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+class Prefetcher:
+    """Прогрев кэша расписаний популярных групп и преподавателей перед пиками
+
+    Бот сообщает о каждом запросе расписания через record(), а в заданные
+    окна времени (например, вечер накануне и утро) планировщик держит в кэше
+    текущую и следующую неделю для top_n самых запрашиваемых сущностей.
+    С store счетчики общие для процессов: каждый процесс раз в
+    flush_interval дописывает туда свои запросы, а прогревает тот, кого
+    запустили с warm=True.
+    """
+
+    # (начало окна, длительность в минутах)
+    WINDOWS = (("07:30", 90), ("19:00", 120))
+
+    def __init__(
+        self,
+        api,
+        windows: Sequence[Tuple[str, int]] = WINDOWS,
+        top_n: int = 300,
+        concurrency: int = 8,
+        rate: float = 10.0,
+        interval: Optional[float] = None,
+        store: Optional[PopularityStore] = None,
+        flush_interval: float = 30.0,
+    ):
+        self.api = api
+        self.store = store
+        self.windows = windows
+        self.top_n = top_n
+        self.concurrency = concurrency
+        self.limiter = TokenBucket(rate)
+        # перепрогрев чуть чаще, чем протухают дни в кэше
+        self.interval = interval or api.cache_ttl["schedule"] * 0.8
+        # без store - все счетчики, со store - еще не записанные в него
+        self.popularity: Counter = Counter()
+        self.warm = 0
+        self.cold = 0
+        self.prefetched = 0
+        self.failed = 0
+        # конец текущего окна прогрева, None - вне окна
+        self._window: Optional[datetime] = None
+        self._periodic = PeriodicTask(
+            self._step, self._delay, 'Ошибка прогрева кэша', log=logger
+        )
+        self._flusher = PeriodicTask(
+            self.flush, flush_interval, 'Ошибка записи популярности', log=logger
+        )
+
+    def record(self, kind: str, entity_id: str, warm: bool):
+        """Учитывает пользовательский запрос расписания"""
+
+        self.popularity[(kind, str(entity_id))] += 1
+        if warm:
+            self.warm += 1
+        else:
+            self.cold += 1
+
+    async def top(self) -> List[Tuple[str, str]]:
+        if self.store is None:
+            return [key for key, _ in self.popularity.most_common(self.top_n)]
+        return await asyncio.get_running_loop().run_in_executor(
+            None, self.store.top, self.top_n
+        )
+
+    async def flush(self):
+        """Дописывает накопленные запросы в store"""
+
+        if self.store is None or not self.popularity:
+            return
+        counts, self.popularity = self.popularity, Counter()
+        await asyncio.get_running_loop().run_in_executor(None, self.store.add, counts)
+
+    async def _decay(self):
+        if self.store is not None:
+            await asyncio.get_running_loop().run_in_executor(None, self.store.decay)
+            return
+        for key in list(self.popularity):
+            self.popularity[key] //= 2
+        self.popularity += Counter()
+
+    async def warm_up(self) -> int:
+        """Догружает текущую и следующую неделю для популярных сущностей"""
+
+        today = datetime.now().date()
+        first = today - timedelta(days=today.weekday())
+        last = first + timedelta(days=13)
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def fetch(kind, entity_id):
+            if self.api.is_cached(kind, entity_id, first, last):
+                return False
+            async with semaphore:
+                await self.limiter.acquire()
+                try:
+                    await self.api.timetable(kind, entity_id, first, last)
+                except Exception as e:
+                    self.failed += 1
+                    logger.warning(f'Не удалось прогреть {kind} {entity_id}: {e}')
+                    return False
+            return True
+
+        top = await self.top()
+        done = await asyncio.gather(*[fetch(kind, eid) for kind, eid in top])
+        fetched = sum(done)
+        self.prefetched += fetched
+        return fetched
+
+    def _next_window(self, now: datetime) -> Tuple[datetime, datetime]:
+        """Ближайшее (или текущее) окно прогрева"""
+
+        candidates = []
+        for start, minutes in self.windows:
+            hours, mins = map(int, start.split(':'))
+            for shift in (-1, 0, 1):
+                begin = (now + timedelta(days=shift)).replace(
+                    hour=hours, minute=mins, second=0, microsecond=0
+                )
+                end = begin + timedelta(minutes=minutes)
+                if end > now:
+                    candidates.append((max(begin, now), end))
+        return min(candidates)
+
+    def _delay(self) -> float:
+        """Внутри окна - interval, иначе пауза до начала следующего окна"""
+
+        now = datetime.now()
+        begin, end = self._next_window(now)
+        if end == self._window:
+            return self.interval
+        return (begin - now).total_seconds()
+
+    async def _step(self):
+        now = datetime.now()
+        begin, end = self._next_window(now)
+        if begin > now:
+            # пока спали, окно закончилось
+            return
+        if end != self._window:
+            self._window = end
+            # популярность постепенно забывается, чтобы в топе были актуальные группы
+            await self._decay()
+
+        fetched = await self.warm_up()
+        logger.info(
+            f'Прогрев кэша: загружено {fetched}, {self.stats()}, '
+            f'трафик РУЗ: {self.api.traffic}'
+        )
+
+    def start(self, warm: bool = True):
+        if self.store is not None:
+            self._flusher.start()
+        if warm:
+            self._periodic.start()
+
+    async def stop(self):
+        await self._periodic.stop()
+        await self._flusher.stop()
+        await self.flush()
+
+    def stats(self) -> Dict[str, float]:
+        """Сколько пользовательских запросов обслужено из прогретого кэша"""
+
+        total = self.warm + self.cold
+        return {
+            "tracked": len(self.popularity),
+            "prefetched": self.prefetched,
+            "failed": self.failed,
+            "warm": self.warm,
+            "cold": self.cold,
+            "warm_ratio": round(self.warm / total, 3) if total else 0.0,
+        }
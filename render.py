@@ -0,0 +1,262 @@
+import html
+import threading
+import time
+from collections import OrderedDict
+from functools import lru_cache
+from typing import Dict
+from typing import Iterable
+from typing import Iterator
+from typing import List
+from typing import NamedTuple
+from typing import Optional
+from typing import Tuple
+
+from lessons import Lesson
+from lessons import by_day
+from lessons import day_label
+from lessons import fingerprint
+
+SEPARATOR = "\n" + "─" * 36 + "\n\n"
+EMPTY = "Занятий не найдено"
+# MAX принимает до 4000 символов в сообщении
+PAGE_LIMIT = 4000
+
+# дисциплины, преподаватели и аудитории повторяются: экранируем каждую строку один раз
+escape = lru_cache(maxsize=16384)(html.escape)
+
+
+class Rendered(NamedTuple):
+    """Отрендеренное расписание: заголовок и по блоку на день
+
+    Блок дня - кортеж фрагментов: заголовок дня, затем по фрагменту на
+    занятие (разделитель дней приклеен к последнему). Каждый фрагмент -
+    законченный HTML, так что резать текст между ними безопасно.
+    """
+
+    header: str
+    blocks: Tuple[Tuple[str, ...], ...]
+
+    @property
+    def text(self) -> str:
+        if not self.blocks:
+            return self.header + EMPTY
+        return self.header + "".join("".join(block) for block in self.blocks)
+
+
+def _day_title(day: int, lessons: List[Lesson]) -> str:
+    return f"<b>📆 {day_label(day) if day > 0 else lessons[0].date}</b>\n"
+
+
+def _lesson_head(l: Lesson) -> str:
+    head = (
+        f"\n⏰ {l.begin_lesson or ''} - {l.end_lesson or ''}\n"
+        f"📚 <b>{escape(l.get('discipline', 'Без названия'))}</b>"
+    )
+    if l.kind_of_work:
+        head += f" ({escape(l.kind_of_work)})"
+    return head
+
+
+def _group_lesson(l: Lesson) -> str:
+    return "".join((
+        _lesson_head(l),
+        f"\n👨‍🏫 {escape(l.get('lecturer', 'Преподаватель не указан'))}\n",
+        f"🏢 {escape(l.get('auditorium', 'Аудитория не указана'))}\n",
+    ))
+
+
+def _teacher_lesson(l: Lesson) -> str:
+    group = l.stream or l.group
+    return "".join((
+        _lesson_head(l),
+        f"\n👥 Группа: {escape(group)}\n" if group else "\n",
+        f"🏢 {escape(l.get('auditorium', 'Аудитория не указана'))}\n",
+    ))
+
+
+def _blocks(lessons: Iterable[Lesson], fragment) -> Tuple[Tuple[str, ...], ...]:
+    blocks = []
+    for day, ls in by_day(lessons):
+        parts = [_day_title(day, ls)]
+        parts.extend(fragment(l) for l in ls)
+        parts[-1] += SEPARATOR
+        blocks.append(tuple(parts))
+    return tuple(blocks)
+
+
+def render_group(name: str, lessons: Iterable[Lesson]) -> Rendered:
+    header = f"<b>📅 Расписание группы {escape(name)}</b>\n\n"
+    return Rendered(header, _blocks(lessons, _group_lesson))
+
+
+def render_teacher(name: str, lessons: Iterable[Lesson]) -> Rendered:
+    lessons = list(lessons)
+    header = [f"<b>👨‍🏫 Расписание преподавателя {escape(name)}</b>\n"]
+    if lessons and lessons[0].lecturer_email:
+        header.append(f"📧 Email: {escape(lessons[0].lecturer_email)}\n")
+    header.append("\n")
+    return Rendered("".join(header), _blocks(lessons, _teacher_lesson))
+
+
+RENDERERS = {"group": render_group, "person": render_teacher}
+
+
+class Pages:
+    """Разбиение отрендеренного расписания на сообщения не длиннее limit
+
+    Дни упаковываются в страницу целиком; день, который не помещается и
+    на отдельную страницу, делится по границам занятий, а продолжение
+    начинается с повтора заголовка дня. Теги не разрываются, потому что
+    режется только между фрагментами. План страниц считается по длинам
+    фрагментов, а текст собирается лишь для запрошенной страницы.
+    """
+
+    def __init__(self, rendered: Rendered, limit: int = PAGE_LIMIT):
+        self.rendered = rendered
+        self.limit = limit
+        self._plan: Optional[List[List[str]]] = None
+
+    def _pack(self) -> List[List[str]]:
+        pages: List[List[str]] = []
+        page = [self.rendered.header]
+        size = len(self.rendered.header)
+        filled = False  # есть ли на странице что-то кроме заголовков
+        if not self.rendered.blocks:
+            return [page + [EMPTY]]
+
+        for block in self.rendered.blocks:
+            length = sum(map(len, block))
+            if size + length <= self.limit:
+                page.extend(block)
+                size += length
+                filled = True
+                continue
+            if filled and length <= self.limit:
+                pages.append(page)
+                page, size = list(block), length
+                continue
+            # день не помещается даже на свою страницу: режем по занятиям
+            title = pending = block[0]
+            for fragment in block[1:]:
+                if filled and size + len(pending) + len(fragment) > self.limit:
+                    pages.append(page)
+                    page, size, pending = [], 0, title
+                if pending:
+                    page.append(pending)
+                    size += len(pending)
+                    pending = ""
+                page.append(fragment)
+                size += len(fragment)
+                filled = True
+        pages.append(page)
+        return pages
+
+    @property
+    def plan(self) -> List[List[str]]:
+        if self._plan is None:
+            self._plan = self._pack()
+        return self._plan
+
+    def __len__(self) -> int:
+        return len(self.plan)
+
+    def __getitem__(self, number: int) -> str:
+        return "".join(self.plan[number])
+
+    def __iter__(self) -> Iterator[str]:
+        for number in range(len(self)):
+            yield self[number]
+
+
+def content_fingerprint(lessons: Iterable[Lesson]) -> str:
+    """Отпечаток всего, что попадает в текст; одинаков во всех процессах"""
+
+    return fingerprint(
+        (
+            (
+                l.day,
+                l.begin_lesson,
+                l.end_lesson,
+                l.discipline,
+                l.kind_of_work,
+                l.lecturer,
+                l.lecturer_email,
+                l.auditorium,
+                l.group,
+                l.stream,
+            )
+            for l in lessons
+        )
+    )
+
+
+class RenderCache:
+    """Готовые тексты расписаний по (сущность, период, отпечаток содержимого)
+
+    Популярная неделя рендерится один раз на изменение данных, а не на
+    каждое нажатие: все, кто смотрит ту же группу за тот же период,
+    получают один и тот же объект.
+    """
+
+    def __init__(self, maxsize: int = 2048):
+        self.maxsize = maxsize
+        self._data: "OrderedDict[tuple, Rendered]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.render_seconds = 0.0
+        self.render_max = 0.0
+        self.fingerprint_seconds = 0.0
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def render(
+        self,
+        kind: str,
+        entity_id: str,
+        name: str,
+        lessons: List[Lesson],
+        date_begin: Optional[str] = None,
+        date_end: Optional[str] = None,
+    ) -> Rendered:
+        started = time.perf_counter()
+        fingerprint = content_fingerprint(lessons)
+        key = (kind, str(entity_id), name, date_begin, date_end, fingerprint)
+        self.fingerprint_seconds += time.perf_counter() - started
+
+        with self._lock:
+            rendered = self._data.get(key)
+            if rendered is not None:
+                self._data.move_to_end(key)
+                self.hits += 1
+                return rendered
+
+        started = time.perf_counter()
+        rendered = RENDERERS[kind](name, lessons)
+        elapsed = time.perf_counter() - started
+        with self._lock:
+            self.misses += 1
+            self.render_seconds += elapsed
+            self.render_max = max(self.render_max, elapsed)
+            self._data[key] = rendered
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+        return rendered
+
+    def stats(self) -> Dict[str, float]:
+        """Попадания в кэш и время рендера в миллисекундах"""
+
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._data),
+            "hits": self.hits,
+            "misses": self.misses,
+            "render_ms_avg": round(1000 * self.render_seconds / self.misses, 3)
+            if self.misses
+            else 0.0,
+            "render_ms_max": round(1000 * self.render_max, 3),
+            "fingerprint_ms_avg": round(1000 * self.fingerprint_seconds / lookups, 3)
+            if lookups
+            else 0.0,
+        }
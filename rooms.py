@@ -0,0 +1,312 @@
+import asyncio
+import logging
+import re
+import time
+from bisect import bisect_right
+from datetime import date
+from datetime import timedelta
+from typing import Dict
+from typing import Iterable
+from typing import List
+from typing import Optional
+from typing import Tuple
+
+from directory import fold
+from lessons import Lesson
+from lessons import by_day
+from lessons import fingerprint
+from periodic import PeriodicTask
+
+logger = logging.getLogger(__name__)
+
+# расписание пар ФУ: (начало, конец) в минутах от начала суток
+PAIRS = (
+    (8 * 60 + 30, 10 * 60),
+    (10 * 60 + 10, 11 * 60 + 40),
+    (11 * 60 + 50, 13 * 60 + 20),
+    (14 * 60, 15 * 60 + 30),
+    (15 * 60 + 40, 17 * 60 + 10),
+    (17 * 60 + 20, 18 * 60 + 50),
+    (19 * 60, 20 * 60 + 30),
+)
+
+
+def room_key(lesson: Lesson) -> Optional[str]:
+    if lesson.auditorium_oid is not None:
+        return str(lesson.auditorium_oid)
+    return lesson.auditorium or None
+
+
+class DayOccupancy:
+    """Занятость аудиторий здания за один день
+
+    Для каждой аудитории - отсортированные непересекающиеся интервалы
+    занятий (массивы начал и концов), так что проверка "свободна ли
+    [start, end)" - один bisect.
+    """
+
+    __slots__ = ("busy", "fingerprint")
+
+    def __init__(self, lessons: Iterable[Lesson], fingerprint: str = ""):
+        intervals: Dict[str, List[Tuple[int, int]]] = {}
+        for lesson in lessons:
+            key = room_key(lesson)
+            if key is None or lesson.begin is None or lesson.end is None:
+                continue
+            intervals.setdefault(key, []).append((lesson.begin, lesson.end))
+
+        self.busy: Dict[str, Tuple[List[int], List[int]]] = {}
+        for key, items in intervals.items():
+            items.sort()
+            starts, ends = [], []
+            for begin, end in items:
+                if ends and begin <= ends[-1]:
+                    ends[-1] = max(ends[-1], end)
+                else:
+                    starts.append(begin)
+                    ends.append(end)
+            self.busy[key] = (starts, ends)
+        self.fingerprint = fingerprint
+
+    def is_free(self, room: str, start: int, end: int) -> bool:
+        busy = self.busy.get(room)
+        if busy is None:
+            return True
+        starts, ends = busy
+        # первый интервал, который заканчивается позже start
+        i = bisect_right(ends, start)
+        return i == len(starts) or starts[i] >= end
+
+
+def natural_key(label: str) -> Tuple:
+    """Ключ сортировки, при котором 'Ауд. 11' идет раньше 'Ауд. 100'"""
+
+    return tuple(
+        int(part) if i % 2 else part.lower()
+        for i, part in enumerate(re.split(r"(\d+)", label))
+    )
+
+
+def _fingerprint(lessons: List[Lesson]) -> str:
+    return fingerprint((room_key(l), l.begin, l.end) for l in lessons)
+
+
+class _Building:
+    __slots__ = ("rooms", "ordered", "days", "used_at")
+
+    def __init__(self):
+        # аудитория -> название; копится по всем загруженным дням
+        self.rooms: Dict[str, str] = {}
+        # те же аудитории по названию, чтобы не сортировать на каждый запрос
+        self.ordered: List[Tuple[str, str]] = []
+        self.days: Dict[int, DayOccupancy] = {}
+        self.used_at = 0.0
+
+
+class RoomIndex:
+    """Индекс занятости аудиторий по зданиям
+
+    Здание загружается одним запросом timetable_building на весь период
+    (days_ahead дней от сегодня) и раскладывается по дням и аудиториям.
+    Фоновое обновление перечитывает здания, о которых спрашивали за
+    последние keep секунд, и пересобирает только изменившиеся дни.
+
+    Список аудиторий здания берется из справочника (directory), если он
+    задан: аудитории, у которых в описании это здание. К ним добавляются
+    аудитории из занятий; аудитория без занятий за день свободна весь день.
+
+    Если задан lessons (LessonIndex) и в нем есть все группы за период,
+    здание собирается оттуда без запроса к РУЗ. Иначе, если задан mirror
+    (ScheduleMirror), - из индекса зданий зеркала, а РУЗ спрашивается,
+    только когда зеркало за период неполное или устарело.
+    """
+
+    def __init__(
+        self,
+        api,
+        lessons=None,
+        directory=None,
+        mirror=None,
+        days_ahead: int = 7,
+        interval: float = 15 * 60,
+        keep: float = 7 * 24 * 60 * 60,
+        concurrency: int = 4,
+    ):
+        self.api = api
+        self.lessons = lessons
+        self.directory = directory
+        self.mirror = mirror
+        self.days_ahead = days_ahead
+        self.interval = interval
+        self.keep = keep
+        self.concurrency = concurrency
+        self._buildings: Dict[str, _Building] = {}
+        self._locks: Dict[str, asyncio.Lock] = {}
+        self.rebuilt_days = 0
+        self.refreshes = 0
+        self._periodic = PeriodicTask(
+            self.refresh,
+            lambda: self.interval,
+            'Ошибка обновления индекса аудиторий',
+            log=logger,
+        )
+
+    def _period(self) -> Tuple[date, date]:
+        today = date.today()
+        return today, today + timedelta(days=self.days_ahead - 1)
+
+    def _directory_rooms(self, building_id: str) -> Dict[str, str]:
+        """Аудитории здания по справочнику: id -> название"""
+
+        if self.directory is None:
+            return {}
+        entry = self.directory.get("building", building_id)
+        if entry is None:
+            return {}
+        names = {fold(entry["label"]), fold(entry["description"])}
+        names.discard("")
+        return {
+            str(room["id"]): room["label"]
+            for room in self.directory.entries("auditorium")
+            if fold(room["description"]) in names
+        }
+
+    def _apply(self, building_id: str, lessons: List[Lesson], first: date, last: date):
+        building = self._buildings.setdefault(building_id, _Building())
+        known = len(building.rooms)
+        for key, label in self._directory_rooms(building_id).items():
+            building.rooms.setdefault(key, label)
+        for lesson in lessons:
+            key = room_key(lesson)
+            if key is not None and key not in building.rooms:
+                building.rooms[key] = lesson.auditorium or key
+        if len(building.rooms) != known:
+            building.ordered = sorted(
+                building.rooms.items(), key=lambda item: natural_key(item[1])
+            )
+
+        grouped = dict(by_day(lessons))
+        for day in range(first.toordinal(), last.toordinal() + 1):
+            day_lessons = grouped.get(day, [])
+            fingerprint = _fingerprint(day_lessons)
+            current = building.days.get(day)
+            if current is None or current.fingerprint != fingerprint:
+                building.days[day] = DayOccupancy(day_lessons, fingerprint)
+                self.rebuilt_days += 1
+
+        # прошедшие дни больше не нужны
+        oldest = date.today().toordinal()
+        for day in [d for d in building.days if d < oldest]:
+            del building.days[day]
+
+    async def _indexed(
+        self, building_id: str, first: date, last: date
+    ) -> Optional[List[Lesson]]:
+        """Занятия здания из индекса занятий или зеркала; None - нужен РУЗ"""
+
+        if self.lessons is not None:
+            lessons = self.lessons.timetable("building", building_id, first, last)
+            if lessons is not None:
+                return lessons
+        if self.mirror is None:
+            return None
+        # SQLite - не в цикле событий
+        return await asyncio.get_running_loop().run_in_executor(
+            None, self.mirror.timetable, "building", building_id, first, last
+        )
+
+    async def load(self, building_id: str, first: date, last: date):
+        """Загружает занятость здания за [first, last] одним запросом"""
+
+        building_id = str(building_id)
+        lock = self._locks.setdefault(building_id, asyncio.Lock())
+        async with lock:
+            lessons = await self._indexed(building_id, first, last)
+            if lessons is None:
+                lessons = await self.api.timetable_building(building_id, first, last)
+            self._apply(building_id, lessons, first, last)
+
+    async def free_rooms(
+        self, building_id: str, day: date, start: int, end: int
+    ) -> List[Tuple[str, str]]:
+        """Аудитории здания, свободные весь промежуток [start, end) в день day
+
+        Возвращает [(id, название), ...] по названию с учетом номеров; день,
+        которого нет в индексе, сначала загружается.
+        """
+
+        building_id = str(building_id)
+        building = self._buildings.get(building_id)
+        if building is None or day.toordinal() not in building.days:
+            first, last = self._period()
+            if not first <= day <= last:
+                first = last = day
+            await self.load(building_id, first, last)
+            building = self._buildings[building_id]
+
+        building.used_at = time.time()
+        occupancy = building.days[day.toordinal()]
+        return [
+            (room, label)
+            for room, label in building.ordered
+            if occupancy.is_free(room, start, end)
+        ]
+
+    async def refresh(self) -> int:
+        """Перечитывает занятость зданий, о которых недавно спрашивали"""
+
+        now = time.time()
+        stale = [
+            building_id
+            for building_id, building in self._buildings.items()
+            if now - building.used_at > self.keep
+        ]
+        for building_id in stale:
+            del self._buildings[building_id]
+            self._locks.pop(building_id, None)
+
+        first, last = self._period()
+        ids = list(self._buildings)
+        refreshed = 0
+        if self.lessons is not None or self.mirror is not None:
+            # здания, которые собрались из индекса занятий или зеркала, в РУЗ
+            # не запрашиваем
+            pending = []
+            for building_id in ids:
+                lessons = await self._indexed(building_id, first, last)
+                if lessons is None:
+                    pending.append(building_id)
+                    continue
+                self._apply(building_id, lessons, first, last)
+                refreshed += 1
+            ids = pending
+        if ids:
+            max_age = self.api.cache_ttl["schedule"]
+            async for result in self.api.timetable_many(
+                "building", ids, first, last,
+                concurrency=self.concurrency, max_age=max_age,
+            ):
+                if result.error is not None:
+                    logger.warning(
+                        f'Аудитории: не удалось обновить здание {result.entity_id}: '
+                        f'{result.error}'
+                    )
+                    continue
+                self._apply(result.entity_id, result.lessons, first, last)
+                refreshed += 1
+        self.refreshes += 1
+        return refreshed
+
+    def start(self):
+        self._periodic.start()
+
+    async def stop(self):
+        await self._periodic.stop()
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "buildings": len(self._buildings),
+            "rooms": sum(len(b.rooms) for b in self._buildings.values()),
+            "rebuilt_days": self.rebuilt_days,
+            "refreshes": self.refreshes,
+        }
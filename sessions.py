@@ -0,0 +1,470 @@
+import asyncio
+import json
+import logging
+import sqlite3
+import sys
+import threading
+import time
+from collections import OrderedDict
+from typing import Any
+from typing import Dict
+from typing import List
+from typing import Optional
+from typing import Set
+from typing import Tuple
+
+from aiomax.fsm import FSMStorage
+
+from periodic import PeriodicTask
+
+logger = logging.getLogger(__name__)
+
+
+def deep_size(obj: Any) -> int:
+    """Примерный размер объекта в памяти вместе со вложенными dict/list/str"""
+
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(deep_size(k) + deep_size(v) for k, v in obj.items())
+    elif isinstance(obj, (list, tuple, set)):
+        size += sum(deep_size(item) for item in obj)
+    return size
+
+
+class ExpiringFSMStorage(FSMStorage):
+    """Хранилище FSM aiomax, которое забывает неактивных пользователей
+
+    Каждое обращение к состоянию или данным пользователя продлевает его
+    сессию; сессии, к которым не обращались ttl секунд, удаляются при
+    следующем обращении или фоновой чисткой. Порядок последних обращений
+    хранится в OrderedDict, так что чистка не перебирает живые сессии.
+    """
+
+    def __init__(self, ttl: float = 2 * 60 * 60, sweep_interval: float = 5 * 60):
+        super().__init__()
+        self.ttl = ttl
+        self.sweep_interval = sweep_interval
+        self._touched: "OrderedDict[int, float]" = OrderedDict()
+        self.expired = 0
+        self._periodic = PeriodicTask(
+            self._step, lambda: self.sweep_interval, 'Ошибка чистки сессий', log=logger
+        )
+
+    def __len__(self) -> int:
+        return len(self._touched)
+
+    def _touch(self, user_id: int):
+        self._touched[user_id] = time.monotonic()
+        self._touched.move_to_end(user_id)
+
+    def _forget(self, user_id: int):
+        FSMStorage.clear(self, user_id)
+        self._touched.pop(user_id, None)
+        self.expired += 1
+
+    def _check(self, user_id: int):
+        touched = self._touched.get(user_id)
+        if touched is None:
+            return
+        if time.monotonic() - touched >= self.ttl:
+            self._forget(user_id)
+        else:
+            self._touch(user_id)
+
+    def _release(self, user_id: int):
+        if user_id not in self.states and user_id not in self.data:
+            self._touched.pop(user_id, None)
+
+    def get_state(self, user_id: int) -> Any:
+        self._check(user_id)
+        return super().get_state(user_id)
+
+    def get_data(self, user_id: int) -> Any:
+        self._check(user_id)
+        return super().get_data(user_id)
+
+    def change_state(self, user_id: int, new: Any):
+        super().change_state(user_id, new)
+        self._touch(user_id)
+
+    def change_data(self, user_id: int, new: Any):
+        super().change_data(user_id, new)
+        self._touch(user_id)
+
+    def clear_state(self, user_id: int) -> Any:
+        state = super().clear_state(user_id)
+        self._release(user_id)
+        return state
+
+    def clear_data(self, user_id: int) -> Any:
+        data = super().clear_data(user_id)
+        self._release(user_id)
+        return data
+
+    def clear(self, user_id: int):
+        super().clear(user_id)
+        self._touched.pop(user_id, None)
+
+    def sweep(self) -> int:
+        """Удаляет сессии, простоявшие дольше ttl; сколько удалено"""
+
+        deadline = time.monotonic() - self.ttl
+        removed = 0
+        while self._touched:
+            user_id, touched = next(iter(self._touched.items()))
+            if touched > deadline:
+                break
+            self._forget(user_id)
+            removed += 1
+        return removed
+
+    def memory(self) -> Dict[str, int]:
+        """Сколько памяти занимают данные сессий (обходит все, не для горячего пути)"""
+
+        total = sum(deep_size(data) for data in self.data.values())
+        return {
+            "data_bytes": total,
+            "data_bytes_per_user": total // len(self.data) if self.data else 0,
+        }
+
+    async def _step(self):
+        removed = self.sweep()
+        if removed:
+            logger.info(f'Сессии: удалено неактивных {removed}, {self.stats()}')
+
+    def start(self):
+        self._periodic.start()
+
+    async def stop(self):
+        await self._periodic.stop()
+
+    def close(self):
+        pass
+
+    def stats(self) -> Dict[str, int]:
+        return {"sessions": len(self._touched), "expired": self.expired}
+
+
+class SQLiteFSMStorage(ExpiringFSMStorage):
+    """Хранилище FSM в SQLite (WAL), общее для нескольких процессов бота
+
+    Состояния читаются сквозь память: первое обращение к пользователю
+    загружает его строку из базы, дальше ответы идут из памяти. Запись
+    сразу меняет память, а в базу попадает пачкой раз в flush_interval,
+    одной транзакцией, поэтому обработчики не ждут диска. Запись из памяти
+    перечитывается из базы не реже reload_after секунд. Вебхук раскладывает
+    обновления по процессам по пользователю, но при смене числа процессов
+    или сообщениях из разных чатов один пользователь может попасть в два
+    процесса. Поэтому у строки есть версия, и запись идет compare-and-set:
+    процесс, чья версия устарела, отбрасывает свое изменение и перечитывает
+    строку, а не затирает чужое. Срок жизни сессии отсчитывается от
+    последней записи.
+    """
+
+    def __init__(
+        self,
+        path: str = "sessions.db",
+        ttl: float = 2 * 60 * 60,
+        sweep_interval: float = 5 * 60,
+        flush_interval: float = 0.2,
+        reload_after: float = 30.0,
+        cache_size: int = 50000,
+    ):
+        super().__init__(ttl, sweep_interval)
+        self.path = path
+        self.flush_interval = flush_interval
+        self.reload_after = reload_after
+        self.cache_size = cache_size
+        # пользователь -> (когда загружен или записан в памяти, когда записан в базу)
+        self._loaded: "OrderedDict[int, Tuple[float, float]]" = OrderedDict()
+        self._dirty: Set[int] = set()
+        # версия строки в базе, на которой основана память; 0 - строки нет
+        self._versions: Dict[int, int] = {}
+        self.loads = 0
+        self.flushes = 0
+        self.written = 0
+        self.conflicts = 0
+        self._saving: Optional[asyncio.Future] = None
+        self._swept_at = time.monotonic()
+        self._periodic = PeriodicTask(
+            self._step,
+            lambda: self.flush_interval,
+            f'Ошибка записи сессий в {path}',
+            log=logger,
+        )
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute("PRAGMA busy_timeout=5000")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS sessions ("
+            " user_id INTEGER PRIMARY KEY,"
+            " state TEXT,"
+            " data TEXT,"
+            " updated_at REAL NOT NULL,"
+            " version INTEGER NOT NULL DEFAULT 0)"
+        )
+        columns = {row[1] for row in self._db.execute("PRAGMA table_info(sessions)")}
+        if "version" not in columns:
+            # база от версии без compare-and-set
+            self._db.execute(
+                "ALTER TABLE sessions ADD COLUMN version INTEGER NOT NULL DEFAULT 0"
+            )
+            self._db.execute("UPDATE sessions SET version = 1")
+        self._db.execute(
+            "CREATE INDEX IF NOT EXISTS sessions_updated ON sessions (updated_at)"
+        )
+        self._db.commit()
+
+    def __len__(self) -> int:
+        return len(self._loaded)
+
+    def _load(self, user_id: int):
+        now = time.time()
+        loaded = self._loaded.get(user_id)
+        if loaded is not None:
+            seen, updated_at = loaded
+            if now - updated_at >= self.ttl and user_id not in self._dirty:
+                if user_id in self.states or user_id in self.data:
+                    self.expired += 1
+                self._evict(user_id)
+                return
+            if user_id in self._dirty or now - seen < self.reload_after:
+                self._loaded.move_to_end(user_id)
+                return
+
+        with self._lock:
+            row = self._db.execute(
+                "SELECT state, data, updated_at, version FROM sessions"
+                " WHERE user_id = ?",
+                (user_id,),
+            ).fetchone()
+        self.loads += 1
+        self._evict(user_id)
+        if row is not None:
+            self._versions[user_id] = row[3]
+        if row is None or now - row[2] >= self.ttl:
+            # запоминаем и отсутствие сессии, чтобы не ходить в базу на каждое сообщение
+            self._remember(user_id, now, now)
+            return
+        state, data, updated_at, _ = row
+        if state is not None:
+            self.states[user_id] = json.loads(state)
+        if data is not None:
+            self.data[user_id] = json.loads(data)
+        self._remember(user_id, now, updated_at)
+
+    def _remember(self, user_id: int, seen: float, updated_at: float):
+        self._loaded[user_id] = (seen, updated_at)
+        self._loaded.move_to_end(user_id)
+        # из памяти вытесняются давно не нужные, но только уже записанные в базу
+        while len(self._loaded) > self.cache_size:
+            oldest = next(iter(self._loaded))
+            if oldest in self._dirty:
+                break
+            self._evict(oldest)
+
+    def _evict(self, user_id: int):
+        FSMStorage.clear(self, user_id)
+        self._loaded.pop(user_id, None)
+        self._versions.pop(user_id, None)
+
+    def _write(self, user_id: int):
+        now = time.time()
+        self._dirty.add(user_id)
+        self._remember(user_id, now, now)
+
+    def get_state(self, user_id: int) -> Any:
+        self._load(user_id)
+        return FSMStorage.get_state(self, user_id)
+
+    def get_data(self, user_id: int) -> Any:
+        self._load(user_id)
+        return FSMStorage.get_data(self, user_id)
+
+    def change_state(self, user_id: int, new: Any):
+        self._load(user_id)
+        FSMStorage.change_state(self, user_id, new)
+        self._write(user_id)
+
+    def change_data(self, user_id: int, new: Any):
+        self._load(user_id)
+        FSMStorage.change_data(self, user_id, new)
+        self._write(user_id)
+
+    def clear_state(self, user_id: int) -> Any:
+        self._load(user_id)
+        state = FSMStorage.clear_state(self, user_id)
+        self._write(user_id)
+        return state
+
+    def clear_data(self, user_id: int) -> Any:
+        self._load(user_id)
+        data = FSMStorage.clear_data(self, user_id)
+        self._write(user_id)
+        return data
+
+    def clear(self, user_id: int):
+        # без версии строки из базы запись ушла бы как новая и не очистила ее
+        self._load(user_id)
+        FSMStorage.clear(self, user_id)
+        self._write(user_id)
+
+    def _pending(self) -> List[Tuple]:
+        """Снимок несохраненных изменений: (user_id, state, data, updated_at, версия)"""
+
+        rows = []
+        for user_id in self._dirty:
+            state = self.states.get(user_id)
+            data = self.data.get(user_id)
+            rows.append((
+                user_id,
+                None if state is None else json.dumps(state, ensure_ascii=False),
+                None if data is None else json.dumps(data, ensure_ascii=False),
+                self._loaded.get(user_id, (0.0, time.time()))[1],
+                self._versions.get(user_id, 0),
+            ))
+        self._dirty.clear()
+        return rows
+
+    def _save(self, rows: List[Tuple]) -> List[Tuple[int, int]]:
+        """Пишет строки compare-and-set; новая версия каждой или -1 при конфликте
+
+        Очищенная сессия остается строкой с NULL, а не удаляется: иначе
+        версия начнется заново, и устаревшая запись другого процесса
+        совпадет с ней. Версия 0 - строки не было при загрузке; если ее
+        успели создать, запись все равно ее обновляет.
+        """
+
+        saved = []
+        with self._lock:
+            with self._db:
+                for user_id, state, data, updated_at, version in rows:
+                    if version == 0:
+                        if state is None and data is None:
+                            self._db.execute(
+                                "UPDATE sessions SET state = NULL, data = NULL,"
+                                " updated_at = ?, version = version + 1"
+                                " WHERE user_id = ?",
+                                (updated_at, user_id),
+                            )
+                        else:
+                            self._db.execute(
+                                "INSERT INTO sessions VALUES (?, ?, ?, ?, 1)"
+                                " ON CONFLICT (user_id) DO UPDATE SET"
+                                " state = excluded.state, data = excluded.data,"
+                                " updated_at = excluded.updated_at,"
+                                " version = version + 1",
+                                (user_id, state, data, updated_at),
+                            )
+                        row = self._db.execute(
+                            "SELECT version FROM sessions WHERE user_id = ?",
+                            (user_id,),
+                        ).fetchone()
+                        saved.append((user_id, 0 if row is None else row[0]))
+                        continue
+                    changed = self._db.execute(
+                        "UPDATE sessions"
+                        " SET state = ?, data = ?, updated_at = ?,"
+                        " version = version + 1"
+                        " WHERE user_id = ? AND version = ?",
+                        (state, data, updated_at, user_id, version),
+                    ).rowcount
+                    saved.append((user_id, version + 1 if changed else -1))
+        return saved
+
+    def _saved(self, saved: List[Tuple[int, int]]):
+        for user_id, version in saved:
+            if version >= 0:
+                if user_id in self._loaded:
+                    self._versions[user_id] = version
+                continue
+            # строку успел изменить другой процесс: его запись новее нашей памяти
+            self.conflicts += 1
+            logger.warning(f'Сессия {user_id} изменена другим процессом, перечитываем')
+            self._dirty.discard(user_id)
+            self._evict(user_id)
+
+    def flush(self) -> int:
+        """Синхронно записывает накопленные изменения; сколько пользователей"""
+
+        rows = self._pending()
+        if rows:
+            self._saved(self._save(rows))
+            self.flushes += 1
+            self.written += len(rows)
+        return len(rows)
+
+    async def flush_async(self) -> int:
+        """То же, что flush, но запись в базу - в пуле потоков"""
+
+        rows = self._pending()
+        if rows:
+            loop = asyncio.get_running_loop()
+            # версии применяются и тогда, когда ожидание отменил stop
+            self._saving = loop.run_in_executor(None, self._save, rows)
+            self._saving.add_done_callback(self._on_saved)
+            await asyncio.shield(self._saving)
+            self.flushes += 1
+            self.written += len(rows)
+        return len(rows)
+
+    def _on_saved(self, future: asyncio.Future):
+        if not future.cancelled() and future.exception() is None:
+            self._saved(future.result())
+
+    def sweep(self) -> int:
+        """Очищает в базе и удаляет из памяти сессии без записей дольше ttl
+
+        Строка остается с NULL и прежней версией, как после clear (см. _save).
+        """
+
+        deadline = time.time() - self.ttl
+        with self._lock:
+            with self._db:
+                removed = self._db.execute(
+                    "UPDATE sessions SET state = NULL, data = NULL"
+                    " WHERE updated_at < ?"
+                    " AND (state IS NOT NULL OR data IS NOT NULL)",
+                    (deadline,),
+                ).rowcount
+        stale = [
+            user_id
+            for user_id, (_, updated_at) in self._loaded.items()
+            if updated_at < deadline and user_id not in self._dirty
+        ]
+        for user_id in stale:
+            self._evict(user_id)
+        self.expired += removed
+        return removed
+
+    async def _step(self):
+        await self.flush_async()
+        if time.monotonic() - self._swept_at >= self.sweep_interval:
+            self._swept_at = time.monotonic()
+            removed = self.sweep()
+            if removed:
+                logger.info(f'Сессии: удалено {removed}, {self.stats()}')
+
+    async def stop(self):
+        await super().stop()
+        if self._saving is not None:
+            # иначе flush ниже пойдет со старыми версиями и получит конфликт
+            await asyncio.wait([self._saving])
+        self.flush()
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "sessions": len(self._loaded),
+            "expired": self.expired,
+            "loads": self.loads,
+            "pending": len(self._dirty),
+            "flushes": self.flushes,
+            "written": self.written,
+            "conflicts": self.conflicts,
+        }
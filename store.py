@@ -0,0 +1,133 @@
+import json
+import logging
+import sqlite3
+import threading
+import time
+from datetime import date
+from datetime import timedelta
+from typing import Dict
+from typing import Iterable
+from typing import List
+from typing import Tuple
+
+from lessons import Lesson
+
+logger = logging.getLogger(__name__)
+
+
+class TimetableStore:
+    """Расписания по дням в SQLite, чтобы кэш переживал перезапуск бота
+
+    Одна строка - один день одной сущности с временем загрузки из РУЗ.
+    Дни читаются лениво, по запросу DayCache, а старые строки периодически
+    удаляются (compact).
+    """
+
+    def __init__(
+        self,
+        path: str = "timetables.db",
+        keep_days: int = 14,
+        max_age: float = 7 * 24 * 60 * 60,
+        compact_every: float = 24 * 60 * 60,
+    ):
+        self.path = path
+        self.keep_days = keep_days
+        self.max_age = max_age
+        self.compact_every = compact_every
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS days ("
+            " kind TEXT NOT NULL,"
+            " entity_id TEXT NOT NULL,"
+            " day INTEGER NOT NULL,"
+            " fetched_at REAL NOT NULL,"
+            " payload TEXT NOT NULL,"
+            " PRIMARY KEY (kind, entity_id, day))"
+        )
+        self._db.commit()
+        self._compacted_at = 0.0
+
+    def load_days(
+        self, kind: str, entity_id: str, days: Iterable[date]
+    ) -> Dict[date, Tuple[float, List[Lesson]]]:
+        """Дни, которые есть на диске: день -> (время загрузки, занятия)"""
+
+        ordinals = [day.toordinal() for day in days]
+        if not ordinals:
+            return {}
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT day, fetched_at, payload FROM days"
+                " WHERE kind = ? AND entity_id = ? AND day BETWEEN ? AND ?",
+                (kind, entity_id, min(ordinals), max(ordinals)),
+            ).fetchall()
+
+        wanted = set(ordinals)
+        found = {}
+        for day, fetched_at, payload in rows:
+            if day in wanted:
+                lessons = [Lesson.from_dict(raw) for raw in json.loads(payload)]
+                found[date.fromordinal(day)] = (fetched_at, lessons)
+        return found
+
+    def save_days(
+        self,
+        kind: str,
+        entity_id: str,
+        by_day: Dict[date, List[Lesson]],
+        fetched_at: float,
+    ):
+        rows = [
+            (
+                kind,
+                entity_id,
+                day.toordinal(),
+                fetched_at,
+                json.dumps([l.to_dict() for l in lessons], ensure_ascii=False),
+            )
+            for day, lessons in by_day.items()
+        ]
+        with self._lock:
+            self._db.executemany(
+                "INSERT OR REPLACE INTO days VALUES (?, ?, ?, ?, ?)", rows
+            )
+            self._db.commit()
+
+        if time.time() - self._compacted_at > self.compact_every:
+            self.compact()
+
+    def touch_days(
+        self, kind: str, entity_id: str, days: Iterable[date], fetched_at: float
+    ):
+        """Обновляет время загрузки дней, не трогая занятия"""
+
+        rows = [(fetched_at, kind, entity_id, day.toordinal()) for day in days]
+        with self._lock:
+            self._db.executemany(
+                "UPDATE days SET fetched_at = ?"
+                " WHERE kind = ? AND entity_id = ? AND day = ?",
+                rows,
+            )
+            self._db.commit()
+
+    def compact(self) -> int:
+        """Удаляет прошедшие дни и давно не обновлявшиеся записи"""
+
+        oldest_day = (date.today() - timedelta(days=self.keep_days)).toordinal()
+        with self._lock:
+            deleted = self._db.execute(
+                "DELETE FROM days WHERE day < ? OR fetched_at < ?",
+                (oldest_day, time.time() - self.max_age),
+            ).rowcount
+            self._db.commit()
+        self._compacted_at = time.time()
+        if deleted:
+            logger.info(f'Из кэша расписаний на диске удалено дней: {deleted}')
+        return deleted
+
+    def close(self):
+        with self._lock:
+            self._db.close()
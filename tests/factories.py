@@ -0,0 +1,21 @@
+from lessons import Lesson
+
+
+def lesson(
+    day: str = "2026.10.12",
+    begin: str = "08:30",
+    end: str = "10:00",
+    discipline: str = "Математика",
+    **fields,
+) -> Lesson:
+    """Занятие РУЗ с разумными значениями по умолчанию"""
+
+    return Lesson.from_dict(
+        dict(
+            fields,
+            date=day,
+            beginLesson=begin,
+            endLesson=end,
+            discipline=discipline,
+        )
+    )
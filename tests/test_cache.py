@@ -0,0 +1,68 @@
+import time
+from datetime import date
+from datetime import timedelta
+
+from cache import DayCache
+from cache import day_runs
+
+MONDAY = date(2026, 10, 12)
+
+
+def week(first=MONDAY, count=7):
+    return [first + timedelta(days=i) for i in range(count)]
+
+
+def test_get_range_returns_only_cached_days():
+    cache = DayCache()
+    days = week()
+    cache.put_days("group", "1", {days[0]: ["пара"], days[1]: []})
+
+    found = cache.get_range("group", "1", days, ttl=60)
+
+    # пустой день - тоже известный день
+    assert found == {days[0]: ["пара"], days[1]: []}
+    assert cache.stats()["hits"] == 2
+    assert cache.stats()["misses"] == 5
+
+
+def test_get_range_drops_expired_days():
+    cache = DayCache()
+    days = week(count=2)
+    cache.put_days("group", "1", {days[0]: []}, fetched_at=time.time() - 120)
+    cache.put_days("group", "1", {days[1]: []})
+
+    assert list(cache.get_range("group", "1", days, ttl=60)) == [days[1]]
+    # entries отдает дни любой давности
+    assert set(cache.entries("group", "1", days)) == set(days)
+
+
+def test_entities_do_not_share_days():
+    cache = DayCache()
+    cache.put_days("group", "1", {MONDAY: ["пара"]})
+
+    assert cache.get_range("group", "2", [MONDAY], ttl=60) == {}
+    assert cache.get_range("person", "1", [MONDAY], ttl=60) == {}
+
+
+def test_least_recently_used_days_are_evicted():
+    cache = DayCache(maxsize=3)
+    days = week(count=4)
+    for day in days[:3]:
+        cache.put_days("group", "1", {day: []})
+    cache.entries("group", "1", [days[0]])
+    cache.put_days("group", "1", {days[3]: []})
+
+    assert set(cache.entries("group", "1", days)) == {days[0], days[2], days[3]}
+    assert cache.stats()["evictions"] == 1
+
+
+def test_day_runs_merge_small_gaps():
+    days = week(count=10)
+    wanted = [days[0], days[1], days[3], days[8]]
+
+    assert day_runs(wanted) == [
+        (days[0], days[1]),
+        (days[3], days[3]),
+        (days[8], days[8]),
+    ]
+    assert day_runs(wanted, max_gap=1) == [(days[0], days[3]), (days[8], days[8])]
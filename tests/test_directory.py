@@ -0,0 +1,109 @@
+import asyncio
+
+import pytest
+
+from directory import EntityDirectory
+from directory import MAX_TERM_LENGTH
+from directory import SEARCH_LIMIT
+from directory import edit_distance
+from directory import query_variants
+from directory import refine
+from directory import squash
+
+GROUPS = [
+    {"id": 1, "label": "ПИ22-1", "description": ""},
+    {"id": 2, "label": "ПИ22-2", "description": ""},
+    {"id": 3, "label": "ЭО23-4", "description": ""},
+    {"id": 4, "label": "БИ21-7", "description": ""},
+]
+PEOPLE = [
+    {"id": 10, "label": "Иванов Иван Иванович", "description": ""},
+    {"id": 11, "label": "Петрова Мария Сергеевна", "description": ""},
+]
+
+
+@pytest.fixture
+def directory(tmp_path):
+    directory = EntityDirectory(str(tmp_path / "directory.json"))
+    directory.build({"group": GROUPS, "person": PEOPLE})
+    return directory
+
+
+def ids(results):
+    return [entry["id"] for entry, _ in results]
+
+
+def test_edit_distance():
+    assert edit_distance("пи221", "пи221") == 0
+    assert edit_distance("пи221", "пи222") == 1
+    assert edit_distance("иванов", "иваонв") == 2
+    # partial - расстояние до лучшей подстроки
+    assert edit_distance("петрова", "петровамариясергеевна", partial=True) == 0
+
+
+def test_suggest_forgives_typos(directory):
+    assert ids(directory.suggest("person", "Иваонв"))[0] == 10
+    assert ids(directory.suggest("person", "Петрва"))[0] == 11
+
+
+def test_suggest_reads_translit(directory):
+    assert query_variants("PI22-1")[-1] == squash("пи22-1")
+    assert ids(directory.suggest("group", "PI22-1"))[0] == 1
+
+
+def test_suggest_reads_wrong_keyboard_layout(directory):
+    # "ПИ22-1", набранное в английской раскладке
+    assert ids(directory.suggest("group", "GB22-1"))[0] == 1
+
+
+def test_suggest_ignores_homoglyphs(directory):
+    # "O" - латинская буква
+    results = directory.suggest("group", "ЭO23-4")
+    assert results[0] == (GROUPS[2], 0)
+
+
+def test_suggest_rejects_unrelated_queries(directory):
+    assert directory.suggest("group", "xyzxyz") == []
+
+
+def test_lookup_prefers_exact_and_prefix_matches(directory):
+    assert [e["id"] for e in directory.lookup("group", "пи22-1")] == [1]
+    assert [e["id"] for e in directory.lookup("group", "пи22")] == [1, 2]
+    assert [e["id"] for e in directory.lookup("group", "22")] == [1, 2]
+
+
+def test_refine_skips_complete_responses():
+    assert refine("пи", GROUPS) == []
+
+
+def test_refine_extends_by_observed_next_characters():
+    labels = ["ПИ21", "ПИ-3", "ПИ 5", "БПИ22"]
+    results = [{"label": labels[i % 4]} for i in range(SEARCH_LIMIT)]
+
+    # только символы, которые в ответе идут после "пи"; пробел не считается
+    assert refine("пи", results) == ["пи-", "пи2"]
+
+
+def test_refine_stops_at_max_length(caplog):
+    results = [{"label": "ПИ22-1"}] * SEARCH_LIMIT
+
+    assert refine("п" * MAX_TERM_LENGTH, results) == []
+    assert "обрезан" in caplog.text
+
+
+def test_crawl_finds_entities_past_the_search_cap(tmp_path):
+    groups = [{"id": i, "label": f"ПИ{i}"} for i in range(200)]
+    cached = []
+
+    class Api:
+        async def search(self, kind, term, cache=True):
+            cached.append(cache)
+            found = [g for g in groups if term in g["label"].lower()]
+            return found[:SEARCH_LIMIT]
+
+    directory = EntityDirectory(str(tmp_path / "directory.json"), rate=1e6)
+    found = asyncio.run(directory.crawl(Api(), kinds=("group",)))
+
+    assert len(found["group"]) == len(groups)
+    # обход не засоряет кэш поиска
+    assert not any(cached)
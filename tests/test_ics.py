@@ -0,0 +1,66 @@
+import asyncio
+from datetime import date
+
+from ics import calendar
+from ics import fold
+from ics import uid
+from ics import weeks
+from tests.factories import lesson
+
+
+def test_short_line_is_not_folded():
+    assert fold("SUMMARY:Математика") == "SUMMARY:Математика\r\n"
+
+
+def test_long_line_is_folded_at_75_octets():
+    line = "DESCRIPTION:" + "Ж" * 100
+    lines = fold(line).split("\r\n")
+
+    assert lines[-1] == ""
+    assert all(len(l.encode()) <= 75 for l in lines)
+    assert all(l.startswith(" ") for l in lines[1:-1])
+    # кириллица занимает два октета и не режется посередине
+    assert "".join(l[1:] if i else l for i, l in enumerate(lines)) == line
+
+
+def test_uid_is_stable_across_exports():
+    first = lesson(group="ПИ22-1", lessonOid=123)
+    again = lesson(group="ПИ22-1", lessonOid=123)
+
+    assert uid("group", "1", first) == uid("group", "1", again)
+    assert uid("group", "1", first) != uid("group", "2", first)
+    assert uid("group", "1", first).endswith("@ruz.fa.ru")
+
+
+def test_uid_without_lesson_oid_depends_on_the_lesson():
+    monday = lesson(group="ПИ22-1")
+
+    assert uid("group", "1", monday) == uid("group", "1", lesson(group="ПИ22-1"))
+    assert uid("group", "1", monday) != uid(
+        "group", "1", lesson(begin="10:10", end="11:40", group="ПИ22-1")
+    )
+
+
+def test_weeks_split_on_mondays():
+    assert weeks(date(2026, 10, 14), date(2026, 10, 20)) == [
+        (date(2026, 10, 14), date(2026, 10, 18)),
+        (date(2026, 10, 19), date(2026, 10, 20)),
+    ]
+
+
+class Api:
+    async def timetable(self, kind, entity_id, first, last):
+        # поток приходит дважды - по разу на каждую группу
+        return [lesson(group="ПИ22-1", lessonOid=1)] * 2
+
+
+def test_stream_lesson_is_exported_once():
+    day = date(2026, 10, 12)
+
+    async def export():
+        chunks = calendar(Api(), "group", "1", "ПИ22-1", day, day)
+        return "".join([chunk async for chunk in chunks])
+
+    text = asyncio.run(export())
+    assert text.count("BEGIN:VEVENT") == 1
+    assert text.endswith("END:VCALENDAR\r\n")
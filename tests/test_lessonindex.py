@@ -0,0 +1,100 @@
+import asyncio
+import time
+from datetime import date
+from datetime import timedelta
+
+from api import BatchResult
+from lessonindex import LessonIndex
+from tests.factories import lesson
+
+TODAY = date.today()
+DAY = TODAY.strftime("%Y.%m.%d")
+GROUPS = ["1", "2", "3"]
+
+
+def group_day(group, lecturer, fetched_at=None):
+    lessons = [lesson(DAY, group=f"Группа {group}", lecturerOid=lecturer)]
+    return {TODAY: (time.time() if fetched_at is None else fetched_at, lessons)}
+
+
+def filled(groups=GROUPS, **options):
+    index = LessonIndex(lambda: GROUPS, **options)
+    for group in groups:
+        index.update("group", group, group_day(group, lecturer=int(group) % 2))
+    return index
+
+
+def test_teacher_is_served_when_every_group_is_known():
+    index = filled()
+
+    found = index.timetable("person", "1", TODAY, TODAY)
+    # одна и та же пара у двух групп - это поток, а не две пары
+    assert [l.group for l in found] == ["Группа 1, Группа 3"]
+    assert not found.stale
+    assert index.covers(TODAY, TODAY)
+
+
+def test_missing_group_sends_the_caller_to_ruz():
+    index = filled(groups=GROUPS[:2])
+
+    assert index.timetable("person", "1", TODAY, TODAY) is None
+    # следующий день неизвестен ни для одной группы
+    assert not filled().covers(TODAY, TODAY + timedelta(days=1))
+
+
+def test_old_days_do_not_count():
+    index = filled(groups=GROUPS[:2])
+    index.update("group", "3", group_day("3", 1, fetched_at=time.time() - 7 * 3600))
+
+    assert index.timetable("person", "1", TODAY, TODAY) is None
+
+
+def test_a_small_share_of_groups_may_be_missing():
+    index = filled(groups=GROUPS[:2], miss_ratio=0.5)
+
+    assert index.timetable("person", "1", TODAY, TODAY) is not None
+
+
+def test_changed_day_is_reindexed():
+    index = filled()
+    index.update("group", "1", group_day("1", lecturer=5))
+
+    assert [l.group for l in index.timetable("person", "1", TODAY, TODAY)] == [
+        "Группа 3"
+    ]
+    assert len(index.timetable("person", "5", TODAY, TODAY)) == 1
+
+
+class FailingApi:
+    """Группа 3 никогда не загружается, остальные - как обычно"""
+
+    def __init__(self, index):
+        self.index = index
+
+    async def timetable_many(self, kind, ids, first, last, **options):
+        for group in ids:
+            if group == "3":
+                yield BatchResult(group, None, RuntimeError("нет ответа"))
+                continue
+            self.index.update(kind, group, group_day(group, 1))
+            yield BatchResult(group, [], None)
+
+
+def test_group_that_keeps_failing_is_quarantined():
+    index = LessonIndex(lambda: GROUPS, quarantine_after=3)
+    api = FailingApi(index)
+
+    for attempt in range(3):
+        assert index.timetable("person", "1", TODAY, TODAY) is None
+        asyncio.run(index.warm(api, TODAY, TODAY))
+
+    assert index.stats()["quarantined"] == 1
+    assert index.timetable("person", "1", TODAY, TODAY) is not None
+
+
+def test_quarantine_expires():
+    index = LessonIndex(lambda: GROUPS, quarantine_after=1, quarantine=0)
+    asyncio.run(index.warm(FailingApi(index), TODAY, TODAY))
+
+    # карантин истек: группа снова нужна для покрытия
+    assert index.timetable("person", "1", TODAY, TODAY) is None
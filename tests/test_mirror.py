@@ -0,0 +1,95 @@
+import time
+from datetime import date
+from datetime import timedelta
+
+import pytest
+
+from api import FaAPI
+from mirror import MAX_AGE
+from mirror import ScheduleMirror
+from tests.factories import lesson
+
+TODAY = date.today()
+YESTERDAY = TODAY - timedelta(days=1)
+
+
+@pytest.fixture
+def mirror(tmp_path):
+    mirror = ScheduleMirror(str(tmp_path / "mirror.sqlite3"))
+    yield mirror
+    mirror.close()
+
+
+def fill(mirror, day, groups=("1", "2"), fetched_at=None):
+    fetched_at = time.time() if fetched_at is None else fetched_at
+    for group in groups:
+        lessons = [
+            lesson(
+                day.strftime("%Y.%m.%d"), group=f"Группа {group}", lecturerOid=7
+            )
+        ]
+        mirror.save_days("group", group, {day: lessons}, fetched_at)
+
+
+def test_teacher_is_built_from_the_synced_groups(mirror):
+    fill(mirror, TODAY)
+    mirror.save_groups(["1", "2"], time.time())
+
+    found = mirror.timetable("person", "7", TODAY, TODAY)
+    assert [l.group for l in found] == ["Группа 1, Группа 2"]
+    assert not found.stale
+    assert mirror.timetable("person", "8", TODAY, TODAY) == []
+
+
+def test_unknown_group_or_day_sends_the_caller_to_ruz(mirror):
+    assert mirror.timetable("person", "7", TODAY, TODAY) is None
+
+    fill(mirror, TODAY, groups=["1"])
+    mirror.save_groups(["1", "2"], time.time())
+    assert mirror.timetable("person", "7", TODAY, TODAY) is None
+
+    fill(mirror, TODAY, groups=["2"])
+    assert mirror.timetable("person", "7", TODAY, TODAY) is not None
+    assert mirror.timetable("person", "7", TODAY, TODAY + timedelta(days=1)) is None
+
+
+def test_group_dropped_by_sync_is_not_required(mirror):
+    fill(mirror, TODAY, groups=["1"])
+    mirror.save_groups(["1"], time.time())
+
+    assert [l.group for l in mirror.timetable("person", "7", TODAY, TODAY)] == [
+        "Группа 1"
+    ]
+
+
+def test_old_days_expire_unless_their_chunk_is_final(mirror):
+    synced_at = time.time() - MAX_AGE - 60
+    fill(mirror, YESTERDAY, fetched_at=synced_at)
+    mirror.save_groups(["1", "2"], synced_at)
+
+    assert mirror.timetable("person", "7", YESTERDAY, YESTERDAY) is None
+
+    # отрезок скачан после своего окончания: sync его больше не обновляет
+    for group in ("1", "2"):
+        mirror.save_chunk("group", group, YESTERDAY, YESTERDAY, None, time.time())
+    found = mirror.timetable("person", "7", YESTERDAY, YESTERDAY)
+    assert len(found) == 1
+    assert not found.stale
+
+
+def test_chunk_that_is_not_over_yet_is_not_final(mirror):
+    mirror.save_chunk("group", "1", YESTERDAY, TODAY, None, time.time())
+
+    assert mirror.chunk("group", "1", YESTERDAY, TODAY) == (None, False)
+
+
+def test_api_reads_the_mirror_before_ruz(mirror):
+    fill(mirror, TODAY)
+    mirror.save_groups(["1", "2"], time.time())
+    api = FaAPI(mirror=mirror)
+    try:
+        found = api.timetable("person", "7", TODAY, TODAY)
+    finally:
+        api.close()
+
+    assert [l.group for l in found] == ["Группа 1, Группа 2"]
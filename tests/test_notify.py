@@ -0,0 +1,39 @@
+from notify import day_fingerprint
+from notify import diff_day
+from tests.factories import lesson
+
+
+def test_fingerprint_ignores_the_order_of_lessons():
+    first = lesson(lessonOid=1)
+    second = lesson(begin="10:10", end="11:40", discipline="Физика", lessonOid=2)
+
+    assert day_fingerprint([first, second]) == day_fingerprint([second, first])
+    assert day_fingerprint([first]) != day_fingerprint([first, second])
+
+
+def test_fingerprint_sees_watched_fields():
+    before = lesson(lessonOid=1, auditorium="Ауд. 1")
+    after = lesson(lessonOid=1, auditorium="Ауд. 2")
+
+    assert day_fingerprint([before]) != day_fingerprint([after])
+
+
+def test_moved_lesson_is_one_change():
+    before = lesson(lessonOid=1)
+    after = lesson(begin="10:10", end="11:40", lessonOid=1)
+
+    (change,) = diff_day([before], [after])
+    assert change.action == "changed"
+    assert change.fields == ("begin_lesson", "end_lesson")
+
+
+def test_added_and_removed_lessons():
+    kept = lesson(lessonOid=1)
+    gone = lesson(begin="10:10", end="11:40", discipline="Физика", lessonOid=2)
+    new = lesson(begin="11:50", end="13:20", discipline="Химия", lessonOid=3)
+
+    changes = diff_day([kept, gone], [kept, new])
+    assert [(c.action, (c.after or c.before).discipline) for c in changes] == [
+        ("removed", "Физика"),
+        ("added", "Химия"),
+    ]
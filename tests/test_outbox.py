@@ -0,0 +1,80 @@
+import asyncio
+
+import aiohttp
+from aiomax import exceptions
+
+from outbox import Outbox
+from outbox import is_rate_limited
+
+
+def test_rate_limit_is_recognized():
+    assert is_rate_limited(exceptions.UnknownErrorException("too.many.requests"))
+    assert not is_rate_limited(exceptions.UnknownErrorException("chat.not.found"))
+    assert not is_rate_limited(RuntimeError("429"))
+
+
+def run(outbox, scenario):
+    async def main():
+        outbox.start()
+        try:
+            return await scenario()
+        finally:
+            await outbox.stop()
+
+    return asyncio.run(main())
+
+
+def test_chat_order_survives_a_retry():
+    sent = []
+    attempts = {}
+
+    async def send(chat_id, text):
+        attempts[text] = attempts.get(text, 0) + 1
+        if text == "первое" and attempts[text] == 1:
+            raise aiohttp.ClientConnectionError()
+        sent.append(text)
+
+    outbox = Outbox(send, rate=1000, workers=4, backoff_base=0.01)
+
+    async def scenario():
+        outbox.enqueue(1, "первое")
+        await outbox.send(1, "второе")
+
+    run(outbox, scenario)
+    assert sent == ["первое", "второе"]
+    assert outbox.retried == 1
+    assert len(outbox) == 0
+
+
+def test_interactive_lane_goes_before_notifications():
+    sent = []
+
+    async def send(chat_id, text):
+        sent.append(text)
+
+    outbox = Outbox(send, rate=1000, workers=1)
+
+    async def scenario():
+        for chat_id in range(3):
+            outbox.enqueue(chat_id, f"рассылка {chat_id}")
+        await outbox.send(10, "ответ")
+
+    run(outbox, scenario)
+    assert sent[0] == "ответ"
+
+
+def test_permanent_error_reaches_the_caller():
+    async def send(chat_id, text):
+        raise exceptions.UnknownErrorException("chat.not.found")
+
+    outbox = Outbox(send, rate=1000)
+
+    async def scenario():
+        try:
+            await outbox.send(1, "привет")
+        except exceptions.UnknownErrorException:
+            return True
+        return False
+
+    assert run(outbox, scenario)
+    assert outbox.failed == 1
@@ -0,0 +1,110 @@
+import time
+
+from policy import CircuitBreaker
+from policy import RequestPolicy
+from policy import RetryBudget
+
+COOLDOWN = 0.05
+
+
+def opened(threshold=3):
+    breaker = CircuitBreaker(threshold=threshold, cooldown=COOLDOWN)
+    for _ in range(threshold):
+        breaker.failure()
+    return breaker
+
+
+def test_breaker_opens_after_threshold_failures():
+    breaker = CircuitBreaker(threshold=3, cooldown=COOLDOWN)
+    breaker.failure()
+    breaker.failure()
+    assert breaker.state == CircuitBreaker.CLOSED
+    assert breaker.allow()
+
+    breaker.failure()
+    assert breaker.state == CircuitBreaker.OPEN
+    assert not breaker.allow()
+    assert breaker.stats()["opened"] == 1
+    assert breaker.stats()["rejected"] == 1
+
+
+def test_success_resets_failure_count():
+    breaker = CircuitBreaker(threshold=3, cooldown=COOLDOWN)
+    breaker.failure()
+    breaker.failure()
+    breaker.success()
+    breaker.failure()
+    assert breaker.state == CircuitBreaker.CLOSED
+
+
+def test_half_open_lets_one_probe_through():
+    breaker = opened()
+    time.sleep(COOLDOWN)
+
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    assert breaker.allow()
+    # пока пробный запрос в полете, остальные отклоняются
+    assert not breaker.allow()
+
+
+def test_successful_probe_closes_the_breaker():
+    breaker = opened()
+    time.sleep(COOLDOWN)
+    assert breaker.allow()
+
+    breaker.success()
+    assert breaker.state == CircuitBreaker.CLOSED
+    assert breaker.allow()
+
+
+def test_failed_probe_opens_the_breaker_again():
+    breaker = opened()
+    time.sleep(COOLDOWN)
+    assert breaker.allow()
+
+    breaker.failure()
+    assert breaker.state == CircuitBreaker.OPEN
+    assert not breaker.allow()
+    assert breaker.stats()["opened"] == 1
+
+
+def test_retry_budget_limits_retries_to_a_share_of_traffic():
+    budget = RetryBudget(ratio=0.1, reserve=2.0)
+    assert budget.withdraw()
+    assert budget.withdraw()
+    assert not budget.withdraw()
+
+    # 15 исходных запросов по 0.1 - полтора повтора
+    for _ in range(15):
+        budget.deposit()
+    assert budget.withdraw()
+    assert not budget.withdraw()
+    assert budget.exhausted == 2
+
+
+def test_retries_stop_at_limit_or_empty_budget():
+    policy = RequestPolicy(retries=2, budget=RetryBudget(reserve=10.0))
+    assert policy.should_retry(1)
+    assert policy.should_retry(2)
+    assert not policy.should_retry(3)
+
+    broke = RequestPolicy(retries=5, budget=RetryBudget(reserve=0.0))
+    assert not broke.should_retry(1)
+
+
+def test_backoff_is_jittered_under_a_cap():
+    policy = RequestPolicy(backoff_base=0.2, backoff_cap=1.0)
+    delays = [policy.backoff(attempt) for attempt in range(10) for _ in range(20)]
+    assert all(0 <= delay <= 1.0 for delay in delays)
+    assert len(set(delays)) > 1
+
+
+def test_hedge_waits_for_enough_samples():
+    policy = RequestPolicy(hedge_min_samples=20, hedge_min_delay=0.05)
+    for _ in range(19):
+        policy.record("schedule", 0.2)
+    assert policy.hedge_delay("schedule") is None
+
+    policy.record("schedule", 0.2)
+    assert policy.hedge_delay("schedule") == 0.2
+    assert policy.hedge_delay("search") is None
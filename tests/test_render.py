@@ -0,0 +1,60 @@
+from render import EMPTY
+from render import Pages
+from render import Rendered
+from render import render_group
+from tests.factories import lesson
+
+HEADER = "H" * 10
+
+
+def rendered(*blocks):
+    return Rendered(HEADER, tuple(tuple(block) for block in blocks))
+
+
+def test_empty_schedule_is_one_page():
+    pages = Pages(rendered(), limit=100)
+    assert list(pages) == [HEADER + EMPTY]
+
+
+def test_whole_days_are_packed_together():
+    days = [("D1", "a" * 20), ("D2", "b" * 20), ("D3", "c" * 20)]
+    pages = Pages(rendered(*days), limit=60)
+
+    # заголовок + два дня = 54, третий день уходит на следующую страницу
+    assert list(pages) == [HEADER + "D1" + "a" * 20 + "D2" + "b" * 20, "D3" + "c" * 20]
+
+
+def test_long_day_is_split_between_lessons_with_repeated_title():
+    day = ("TITLE", "x" * 30, "y" * 30, "z" * 30)
+    pages = Pages(rendered(("D1", "a" * 10), day), limit=60)
+
+    assert list(pages) == [
+        HEADER + "D1" + "a" * 10 + "TITLE" + "x" * 30,
+        "TITLE" + "y" * 30,
+        "TITLE" + "z" * 30,
+    ]
+    assert all(len(page) <= 60 for page in pages)
+
+
+def test_rendered_schedule_pages_fit_the_limit():
+    schedule = render_group(
+        "ПИ22-1",
+        [
+            lesson(day=f"2026.10.{12 + i // 4}", discipline=f"Предмет {i}")
+            for i in range(40)
+        ],
+    )
+    pages = Pages(schedule, limit=500)
+
+    assert len(pages) > 1
+    assert all(len(page) <= 500 for page in pages)
+    # каждая страница начинается с заголовка дня или расписания
+    assert all(page.startswith("<b>") for page in pages)
+    assert "Предмет 39" in pages[len(pages) - 1]
+
+
+def test_page_text_is_html_escaped():
+    schedule = render_group("<ПИ>", [lesson(discipline="A & B")])
+    text = Pages(schedule)[0]
+    assert "&lt;ПИ&gt;" in text
+    assert "A &amp; B" in text
@@ -0,0 +1,75 @@
+import asyncio
+from datetime import date
+
+from lessons import minutes
+from rooms import DayOccupancy
+from rooms import RoomIndex
+from rooms import natural_key
+from tests.factories import lesson
+
+
+def occupancy(*lessons):
+    return DayOccupancy(lessons)
+
+
+def is_free(day, room, start, end):
+    return day.is_free(room, minutes(start), minutes(end))
+
+
+def test_room_is_busy_during_lessons_and_free_between():
+    day = occupancy(
+        lesson(begin="08:30", end="10:00", auditoriumOid=1),
+        lesson(begin="11:50", end="13:20", auditoriumOid=1),
+    )
+
+    assert not is_free(day, "1", "08:30", "10:00")
+    assert not is_free(day, "1", "09:00", "09:30")
+    assert is_free(day, "1", "10:00", "11:50")
+    assert not is_free(day, "1", "11:00", "12:00")
+    assert is_free(day, "1", "13:20", "15:00")
+
+
+def test_overlapping_lessons_are_merged():
+    day = occupancy(
+        lesson(begin="08:30", end="10:00", auditoriumOid=1),
+        lesson(begin="09:30", end="11:00", auditoriumOid=1),
+    )
+
+    assert day.busy["1"] == ([minutes("08:30")], [minutes("11:00")])
+    assert not is_free(day, "1", "10:30", "10:45")
+
+
+def test_room_without_lessons_is_free_all_day():
+    day = occupancy(lesson(auditoriumOid=1))
+    assert is_free(day, "2", "08:30", "20:00")
+
+
+def test_rooms_sort_by_number():
+    labels = ["Ауд. 100", "Ауд. 11", "Ауд. 2"]
+    assert sorted(labels, key=natural_key) == ["Ауд. 2", "Ауд. 11", "Ауд. 100"]
+
+
+def test_free_rooms_loads_the_building_once():
+    today = date.today()
+    day = today.strftime("%Y.%m.%d")
+
+    class Api:
+        calls = 0
+
+        async def timetable_building(self, building_id, first, last):
+            Api.calls += 1
+            return [
+                lesson(day, "08:30", "10:00", auditorium="Ауд. 10", auditoriumOid=10),
+                lesson(day, "10:10", "11:40", auditorium="Ауд. 9", auditoriumOid=9),
+            ]
+
+    async def main():
+        index = RoomIndex(Api())
+        first = await index.free_rooms("1", today, minutes("08:30"), minutes("10:00"))
+        second = await index.free_rooms("1", today, minutes("10:10"), minutes("11:40"))
+        return first, second
+
+    first, second = asyncio.run(main())
+    assert first == [("9", "Ауд. 9")]
+    assert second == [("10", "Ауд. 10")]
+    assert Api.calls == 1
@@ -0,0 +1,87 @@
+import pytest
+
+from sessions import SQLiteFSMStorage
+
+
+@pytest.fixture
+def path(tmp_path):
+    return str(tmp_path / "sessions.db")
+
+
+def reopen(path):
+    return SQLiteFSMStorage(path)
+
+
+def test_state_survives_restart(path):
+    storage = reopen(path)
+    storage.change_state(1, "entering_group")
+    storage.change_data(1, {"type": "group"})
+    storage.flush()
+    storage.close()
+
+    storage = reopen(path)
+    assert storage.get_state(1) == "entering_group"
+    assert storage.get_data(1) == {"type": "group"}
+
+
+def test_clear_after_restart_resets_the_session(path):
+    storage = reopen(path)
+    storage.change_state(1, "entering_group")
+    storage.change_data(1, {"type": "group"})
+    storage.flush()
+    storage.close()
+
+    # /start после перезапуска: строка есть только в базе
+    storage = reopen(path)
+    storage.clear(1)
+    storage.change_state(1, "choosing_action")
+    storage.flush()
+    assert storage.stats()["conflicts"] == 0
+    storage.close()
+
+    storage = reopen(path)
+    assert storage.get_state(1) == "choosing_action"
+    assert storage.get_data(1) is None
+
+
+def test_stale_writer_loses_to_newer_version(path):
+    first, second = reopen(path), reopen(path)
+    first.change_state(1, "a")
+    first.flush()
+
+    second.get_state(1)
+    first.change_state(1, "b")
+    first.flush()
+    # second основан на версии до "b": его запись отбрасывается
+    second.change_state(1, "c")
+    second.flush()
+
+    assert second.stats()["conflicts"] == 1
+    assert second.get_state(1) == "b"
+    assert reopen(path).get_state(1) == "b"
+
+
+def test_new_row_race_updates_instead_of_conflicting(path):
+    first, second = reopen(path), reopen(path)
+    first.get_state(1)
+    second.get_state(1)
+
+    first.change_state(1, "a")
+    first.flush()
+    second.change_state(1, "b")
+    second.flush()
+
+    assert first.stats()["conflicts"] == second.stats()["conflicts"] == 0
+    assert reopen(path).get_state(1) == "b"
+
+
+def test_sweep_keeps_the_row_version(path):
+    storage = reopen(path)
+    storage.change_state(1, "a")
+    storage.flush()
+    storage._db.execute("UPDATE sessions SET updated_at = 0")
+    storage._db.commit()
+
+    assert storage.sweep() == 1
+    row = storage._db.execute("SELECT state, data, version FROM sessions").fetchone()
+    assert row == (None, None, 1)
@@ -0,0 +1,112 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+from singleflight import SingleFlight
+from singleflight import ThreadSingleFlight
+
+
+def test_concurrent_calls_share_one_request():
+    calls = []
+
+    async def fetch():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return "ответ"
+
+    async def main():
+        flight = SingleFlight()
+        results = await asyncio.gather(*[flight.do("key", fetch) for _ in range(5)])
+        return flight, results
+
+    flight, results = asyncio.run(main())
+    assert results == ["ответ"] * 5
+    assert len(calls) == 1
+    assert flight.stats() == {"in_flight": 0, "started": 1, "shared": 4}
+
+
+def test_different_keys_are_not_merged():
+    async def main():
+        flight = SingleFlight()
+
+        async def fetch(value):
+            await asyncio.sleep(0.01)
+            return value
+
+        return await asyncio.gather(
+            flight.do("a", lambda: fetch(1)), flight.do("b", lambda: fetch(2))
+        )
+
+    assert asyncio.run(main()) == [1, 2]
+
+
+def test_error_reaches_every_waiter():
+    async def fetch():
+        await asyncio.sleep(0.01)
+        raise RuntimeError("РУЗ упал")
+
+    async def main():
+        flight = SingleFlight()
+        return await asyncio.gather(
+            *[flight.do("key", fetch) for _ in range(3)], return_exceptions=True
+        )
+
+    results = asyncio.run(main())
+    assert all(isinstance(r, RuntimeError) for r in results)
+
+
+def test_cancelled_waiter_does_not_cancel_request():
+    async def fetch():
+        await asyncio.sleep(0.02)
+        return "ответ"
+
+    async def main():
+        flight = SingleFlight()
+        first = asyncio.ensure_future(flight.do("key", fetch))
+        second = asyncio.ensure_future(flight.do("key", fetch))
+        await asyncio.sleep(0)
+        first.cancel()
+        return await second
+
+    assert asyncio.run(main()) == "ответ"
+
+
+def test_thread_single_flight_dedups_threads():
+    flight = ThreadSingleFlight()
+    calls = []
+    started = threading.Event()
+
+    def fetch():
+        calls.append(1)
+        started.set()
+        time.sleep(0.05)
+        return "ответ"
+
+    results = []
+    leader = threading.Thread(target=lambda: results.append(flight.do("key", fetch)))
+    leader.start()
+    started.wait()
+    followers = [
+        threading.Thread(target=lambda: results.append(flight.do("key", fetch)))
+        for _ in range(4)
+    ]
+    for thread in followers:
+        thread.start()
+    for thread in [leader] + followers:
+        thread.join()
+    assert results == ["ответ"] * 5
+    assert len(calls) == 1
+    assert len(flight) == 0
+
+
+def test_thread_single_flight_reraises_and_forgets_key():
+    flight = ThreadSingleFlight()
+
+    def fetch():
+        raise ValueError("ошибка")
+
+    with pytest.raises(ValueError):
+        flight.do("key", fetch)
+    assert len(flight) == 0
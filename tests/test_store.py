@@ -0,0 +1,46 @@
+import time
+from datetime import date
+from datetime import timedelta
+
+from cache import DayCache
+from store import TimetableStore
+
+MONDAY = date(2026, 10, 12)
+
+
+def test_missing_days_are_loaded_from_store(tmp_path):
+    store = TimetableStore(str(tmp_path / "timetables.db"))
+    fetched_at = time.time() - 30
+    DayCache(store=store).put_days("group", "1", {MONDAY: []}, fetched_at)
+
+    # новый кэш, как после перезапуска: день поднимается с исходным временем
+    cache = DayCache(store=store)
+    found = cache.entries("group", "1", [MONDAY, MONDAY + timedelta(days=1)])
+
+    assert found == {MONDAY: (fetched_at, [])}
+    assert cache.stats()["loaded"] == 1
+    store.close()
+
+
+def test_write_behind_reaches_disk_on_close(tmp_path):
+    store = TimetableStore(str(tmp_path / "timetables.db"))
+    cache = DayCache(store=store, write_behind=True)
+    cache.put_days("group", "1", {MONDAY: []})
+    cache.close()
+
+    assert list(store.load_days("group", "1", [MONDAY])) == [MONDAY]
+    store.close()
+
+
+def test_compact_drops_past_and_stale_days(tmp_path):
+    store = TimetableStore(str(tmp_path / "timetables.db"), keep_days=14)
+    today = date.today()
+    old_day = today - timedelta(days=30)
+    store.save_days("group", "1", {today: [], old_day: []}, time.time())
+    store.save_days("group", "2", {today: []}, time.time() - store.max_age - 1)
+
+    # первая запись уже запускает compact, так что считаем по базе
+    store.compact()
+    assert list(store.load_days("group", "1", [today, old_day])) == [today]
+    assert store.load_days("group", "2", [today]) == {}
+    store.close()
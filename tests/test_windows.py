@@ -0,0 +1,109 @@
+import asyncio
+from datetime import date
+
+import pytest
+
+from api import BatchResult
+from lessons import minutes
+from tests.factories import lesson
+from windows import DAY_END
+from windows import DAY_START
+from windows import Slot
+from windows import busy_masks
+from windows import common_free
+from windows import find_common_free
+from windows import free_slots
+from windows import runs
+from windows import span
+
+MONDAY = date(2026, 10, 12)
+SUNDAY = date(2026, 10, 18)
+M = MONDAY.toordinal()
+
+
+def slot(day, start, end):
+    return Slot(day, minutes(start), minutes(end))
+
+
+def test_runs_finds_every_stretch_of_set_bits():
+    mask = span(3, 5) | span(10, 11) | span(20, 40)
+    assert runs(mask) == [(3, 5), (10, 11), (20, 40)]
+    assert runs(0) == []
+
+
+def test_free_slots_around_lessons():
+    busy = busy_masks([
+        lesson(begin="08:30", end="10:00"),
+        lesson(begin="11:50", end="13:20"),
+    ])
+
+    assert free_slots(busy, MONDAY, MONDAY) == [
+        slot(M, "10:00", "11:50"),
+        slot(M, "13:20", "20:00"),
+    ]
+
+
+def test_short_gaps_and_sundays_are_skipped():
+    busy = busy_masks([
+        lesson(begin="08:30", end="10:00"),
+        lesson(begin="10:10", end="11:40"),
+    ])
+    slots = free_slots(busy, MONDAY, SUNDAY, min_minutes=45)
+
+    # перемена в 10 минут - не окно; воскресенье не рабочий день
+    assert slots[0] == slot(M, "11:40", "20:00")
+    assert {s.day for s in slots} == {M + i for i in range(6)}
+    assert slots[1] == Slot(M + 1, DAY_START, DAY_END)
+
+
+def test_between_lessons_only_counts_windows_inside_the_day():
+    busy = busy_masks([
+        lesson(begin="08:30", end="10:00"),
+        lesson(begin="13:50", end="15:20"),
+    ])
+
+    assert free_slots(busy, MONDAY, SUNDAY, between_lessons=True) == [
+        slot(M, "10:00", "13:50"),
+    ]
+
+
+def test_common_free_is_free_for_everyone():
+    first = [lesson(begin="08:30", end="10:00")]
+    second = [lesson(begin="10:10", end="11:40"), lesson(begin="15:30", end="17:00")]
+
+    assert common_free([first, second], MONDAY, MONDAY) == [
+        slot(M, "11:40", "15:30"),
+        slot(M, "17:00", "20:00"),
+    ]
+
+
+class Api:
+    def __init__(self, timetables):
+        self.timetables = timetables
+
+    async def timetable_many(self, kind, ids, date_begin, date_end, concurrency=None):
+        for entity_id in ids:
+            found = self.timetables[entity_id]
+            if isinstance(found, Exception):
+                yield BatchResult(entity_id, None, found)
+            else:
+                yield BatchResult(entity_id, found, None)
+
+
+def test_find_common_free_skips_entities_that_failed():
+    api = Api({
+        "1": [lesson(begin="08:30", end="19:00")],
+        "2": RuntimeError("РУЗ не ответил"),
+    })
+    result = asyncio.run(
+        find_common_free(api, [("group", "1"), ("group", "2")], MONDAY, MONDAY)
+    )
+
+    assert result.slots == [slot(M, "19:00", "20:00")]
+    assert result.failed == [("group", "2")]
+
+
+def test_find_common_free_raises_when_nothing_loaded():
+    api = Api({"1": RuntimeError("РУЗ не ответил")})
+    with pytest.raises(RuntimeError):
+        asyncio.run(find_common_free(api, [("group", "1")], MONDAY, MONDAY))
@@ -0,0 +1,484 @@
+"""Прием обновлений MAX через вебхук с несколькими процессами-обработчиками
+
+    python webhook.py serve --workers 4 --port 8080
+    python webhook.py bench --url http://127.0.0.1:8080/webhook --updates 20000
+
+Фронт (aiohttp) принимает обновления и раскладывает их по процессам по
+пользователю: все обновления одного пользователя попадают в один процесс, и
+его сессия FSM остается в памяти этого процесса. aiomax запускает каждый
+обработчик отдельной задачей, поэтому процесс сам выстраивает обновления
+одного пользователя в очередь: следующее начинается, когда завершились все
+обработчики предыдущего, а обновления разных пользователей идут параллельно. Процессы
+делят кэш расписаний, сессии, популярность расписаний и справочник через
+локальные SQLite-файлы и directory.json. Фоновые задачи (прогрев, уведомления,
+рассылка, обход справочника и РУЗ для индекса занятий) ведет отдельный
+процесс без обновлений; ему достается доля --background-share лимита отправки,
+обработчики делят остаток поровну.
+"""
+
+import argparse
+import asyncio
+import contextvars
+import functools
+import json
+import logging
+import multiprocessing
+import os
+import queue
+import random
+import time
+from typing import Dict
+from typing import List
+from typing import Optional
+
+import aiohttp
+from aiohttp import web
+
+logger = logging.getLogger(__name__)
+
+MAX_API = "https://platform-api.max.ru"
+SECRET_HEADER = "X-Max-Bot-Api-Secret"
+# обновлений в обработке на процесс, включая ждущие своей очереди
+IN_FLIGHT = 1024
+
+# задачи, которые создает aiomax во время handle_update текущего обновления
+_collected: contextvars.ContextVar = contextvars.ContextVar("collected", default=None)
+
+
+def update_key(update: Dict) -> int:
+    """По какому ключу шардировать обновление: пользователь, а если его нет - чат
+
+    Состояние FSM хранится по пользователю, так что все его обновления,
+    из какого бы чата они ни пришли, должны попадать в один процесс.
+    """
+
+    message = update.get("message") or {}
+    user = (
+        (update.get("callback") or {}).get("user")
+        or message.get("sender")
+        or update.get("user")
+        or {}
+    )
+    key = user.get("user_id")
+    if key is None:
+        key = (message.get("recipient") or {}).get("chat_id")
+    if key is None:
+        key = update.get("chat_id", 0)
+    return int(key)
+
+
+def run_worker(
+    token: str,
+    updates: multiprocessing.Queue,
+    processed,
+    send_rate: float,
+    sessions_path: str,
+):
+    """Точка входа процесса-обработчика"""
+
+    # импорт здесь: модуль бота настраивает логирование и не нужен фронту
+    from botmax import ScheduleBot
+    from sessions import SQLiteFSMStorage
+
+    bot = ScheduleBot(
+        token,
+        storage=SQLiteFSMStorage(sessions_path),
+        background=False,
+        send_rate=send_rate,
+    )
+    try:
+        asyncio.run(_consume(bot, updates, processed))
+    except KeyboardInterrupt:
+        pass
+
+
+def run_background(token: str, stop: multiprocessing.Queue, send_rate: float):
+    """Точка входа фонового процесса: обновлений он не получает"""
+
+    from botmax import ScheduleBot
+
+    bot = ScheduleBot(token, background=True, send_rate=send_rate)
+    try:
+        asyncio.run(_background(bot, stop))
+    except KeyboardInterrupt:
+        pass
+
+
+async def _connect(bot, session: aiohttp.ClientSession):
+    bot.bot.session = session
+    try:
+        await bot.bot.get_me()
+    except Exception as e:
+        logger.error(f'Не удалось получить данные бота: {e}')
+    await bot.on_startup()
+
+
+async def _background(bot, stop: multiprocessing.Queue):
+    async with aiohttp.ClientSession() as session:
+        await _connect(bot, session)
+        try:
+            await asyncio.get_running_loop().run_in_executor(None, stop.get)
+        finally:
+            await bot.on_shutdown()
+
+
+def _collecting_factory(loop, coro, **kwargs):
+    """Фабрика задач: запоминает задачи, созданные внутри handle_update
+
+    Вне _dispatch задачи создаются как обычно. Собранные задачи получают
+    контекст без списка, поэтому то, что запустят уже сами обработчики
+    (фоновые обновления, отложенная запись), в очередь пользователя не
+    попадает и его следующее обновление не ждет.
+    """
+
+    tasks = _collected.get()
+    if tasks is None:
+        return asyncio.Task(coro, loop=loop, **kwargs)
+    context = kwargs.pop("context", None) or contextvars.copy_context()
+    context.run(_collected.set, None)
+    task = asyncio.Task(coro, loop=loop, context=context, **kwargs)
+    tasks.append(task)
+    return task
+
+
+async def _dispatch(bot, update: Dict, previous: Optional[asyncio.Task]):
+    """Обрабатывает обновление, когда закончено предыдущее того же пользователя"""
+
+    if previous is not None:
+        await asyncio.wait([previous])
+    tasks: List[asyncio.Task] = []
+    token = _collected.set(tasks)
+    try:
+        await bot.bot.handle_update(update)
+    except Exception as e:
+        logger.error(f'Ошибка обработки обновления: {e}')
+    finally:
+        _collected.reset(token)
+    for result in await asyncio.gather(*tasks, return_exceptions=True):
+        if isinstance(result, Exception):
+            logger.error(f'Ошибка обработки обновления: {result}')
+
+
+async def _consume(bot, updates: multiprocessing.Queue, processed):
+    loop = asyncio.get_running_loop()
+    loop.set_task_factory(_collecting_factory)
+    # ключ обновления -> задача его последнего обновления
+    tails: Dict[int, asyncio.Task] = {}
+    slots = asyncio.Semaphore(IN_FLIGHT)
+
+    def done(key: int, task: asyncio.Task):
+        slots.release()
+        processed.value += 1
+        if tails.get(key) is task:
+            del tails[key]
+
+    async with aiohttp.ClientSession() as session:
+        await _connect(bot, session)
+        follower = asyncio.ensure_future(_follow_directory(bot.directory))
+        try:
+            while True:
+                batch = [await loop.run_in_executor(None, updates.get)]
+                # забираем все, что уже накопилось, без лишних переходов в пул потоков
+                while len(batch) < 256:
+                    try:
+                        batch.append(updates.get_nowait())
+                    except queue.Empty:
+                        break
+                for update in batch:
+                    if update is None:
+                        if tails:
+                            await asyncio.wait(list(tails.values()))
+                        return
+                    await slots.acquire()
+                    key = update_key(update)
+                    task = asyncio.ensure_future(
+                        _dispatch(bot, update, tails.get(key))
+                    )
+                    tails[key] = task
+                    task.add_done_callback(functools.partial(done, key))
+        finally:
+            follower.cancel()
+            await bot.on_shutdown()
+
+
+async def _follow_directory(directory, interval: float = 60.0):
+    """Перечитывает directory.json, когда фоновый процесс его обновит"""
+
+    loaded_at = time.time()
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            changed = os.path.getmtime(directory.path) > loaded_at
+        except OSError:
+            continue
+        if changed:
+            loaded_at = time.time()
+            await directory.load()
+
+
+class WebhookServer:
+    """Фронт вебхука: проверяет секрет и раскладывает обновления по процессам"""
+
+    def __init__(
+        self,
+        token: str,
+        workers: int = 4,
+        path: str = "/webhook",
+        secret: Optional[str] = None,
+        queue_size: int = 10000,
+        send_rate: float = 20.0,
+        sessions_path: str = "sessions.db",
+        background_share: float = 0.5,
+    ):
+        self.token = token
+        self.workers = workers
+        self.path = path
+        self.secret = secret
+        self.queue_size = queue_size
+        self.send_rate = send_rate
+        self.sessions_path = sessions_path
+        self.background_share = background_share
+        self.accepted = 0
+        self.rejected = 0
+        self._context = multiprocessing.get_context("spawn")
+        self._queues: List[multiprocessing.Queue] = []
+        self._processed = []
+        self._processes = []
+        self._stop: Optional[multiprocessing.Queue] = None
+
+    def start_workers(self):
+        self._stop = self._context.Queue(1)
+        background = self._context.Process(
+            target=run_background,
+            args=(self.token, self._stop, self.send_rate * self.background_share),
+            name="bot-background",
+        )
+        background.start()
+        self._processes.append(background)
+
+        send_rate = self.send_rate * (1 - self.background_share) / self.workers
+        for index in range(self.workers):
+            updates = self._context.Queue(self.queue_size)
+            processed = self._context.Value("q", 0, lock=False)
+            process = self._context.Process(
+                target=run_worker,
+                args=(
+                    self.token,
+                    updates,
+                    processed,
+                    send_rate,
+                    self.sessions_path,
+                ),
+                name=f"bot-worker-{index}",
+            )
+            process.start()
+            self._queues.append(updates)
+            self._processed.append(processed)
+            self._processes.append(process)
+
+    def stop_workers(self, timeout: float = 30.0):
+        if self._stop is not None:
+            self._stop.put(None)
+        for updates in self._queues:
+            updates.put(None)
+        for process in self._processes:
+            process.join(timeout)
+            if process.is_alive():
+                process.terminate()
+
+    async def handle(self, request: web.Request) -> web.Response:
+        secret = request.headers.get(SECRET_HEADER)
+        if self.secret is not None and secret != self.secret:
+            return web.Response(status=403)
+        try:
+            update = await request.json()
+            shard = update_key(update) % self.workers
+        except (ValueError, TypeError, AttributeError):
+            return web.Response(status=400)
+        try:
+            self._queues[shard].put_nowait(update)
+        except queue.Full:
+            # MAX повторит доставку позже
+            self.rejected += 1
+            return web.Response(status=503)
+        self.accepted += 1
+        return web.Response(status=200)
+
+    async def handle_stats(self, request: web.Request) -> web.Response:
+        return web.json_response(self.stats())
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post(self.path, self.handle)
+        app.router.add_get("/stats", self.handle_stats)
+        return app
+
+    def stats(self) -> Dict:
+        return {
+            "accepted": self.accepted,
+            "rejected": self.rejected,
+            "processed": [value.value for value in self._processed],
+        }
+
+
+async def subscribe(token: str, url: str, secret: Optional[str] = None):
+    """Регистрирует вебхук в MAX (заменяет long polling)"""
+
+    body = {"url": url}
+    if secret is not None:
+        body["secret"] = secret
+    async with aiohttp.ClientSession() as session:
+        async with session.post(
+            f"{MAX_API}/subscriptions", params={"access_token": token}, json=body
+        ) as response:
+            response.raise_for_status()
+            logger.info(f'Вебхук {url} зарегистрирован: {await response.text()}')
+
+
+async def serve(args):
+    server = WebhookServer(
+        args.token,
+        workers=args.workers,
+        path=args.path,
+        secret=args.secret,
+        send_rate=args.send_rate,
+        background_share=args.background_share,
+    )
+    server.start_workers()
+    # журнал доступа на каждое обновление стоит дороже самой раскладки
+    runner = web.AppRunner(server.app(), access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, args.host, args.port).start()
+    logger.info(
+        f'Вебхук слушает {args.host}:{args.port}{args.path}, процессов: {args.workers}'
+    )
+    if args.public_url:
+        await subscribe(args.token, args.public_url, args.secret)
+    try:
+        while True:
+            await asyncio.sleep(60)
+            logger.info(f'Вебхук: {server.stats()}')
+    finally:
+        await runner.cleanup()
+        await asyncio.get_event_loop().run_in_executor(None, server.stop_workers)
+        logger.info(f'Вебхук остановлен: {server.stats()}')
+
+
+def fake_update(chat_id: int, seq: int) -> Dict:
+    """Обновление message_created, как его присылает MAX
+
+    Обычный текст вне диалога: бот проверяет состояние FSM и ничего не
+    отвечает, так что замер не упирается в исходящие запросы к MAX.
+    """
+
+    return {
+        "update_type": "message_created",
+        "timestamp": int(time.time() * 1000),
+        "message": {
+            "recipient": {"chat_id": chat_id, "chat_type": "dialog", "user_id": 1},
+            "sender": {
+                "user_id": chat_id,
+                "first_name": "Bench",
+                "name": "Bench",
+                "is_bot": False,
+                "last_activity_time": 0,
+            },
+            "timestamp": int(time.time() * 1000),
+            "body": {"mid": f"mid.{chat_id}.{seq}", "seq": seq, "text": f"ping {seq}"},
+        },
+    }
+
+
+async def bench(args):
+    """Локальный "MAX": шлет обновления в вебхук и меряет пропускную способность"""
+
+    stats_url = args.url.rsplit("/", 1)[0] + "/stats"
+    headers = {SECRET_HEADER: args.secret} if args.secret else {}
+    latencies: List[float] = []
+    statuses: Dict[int, int] = {}
+    counter = iter(range(args.updates))
+
+    async with aiohttp.ClientSession() as session:
+        async with session.get(stats_url) as response:
+            before = sum((await response.json())["processed"])
+
+        async def sender():
+            for seq in counter:
+                update = fake_update(random.randrange(args.chats) + 1, seq)
+                started = time.perf_counter()
+                async with session.post(args.url, json=update, headers=headers) as r:
+                    statuses[r.status] = statuses.get(r.status, 0) + 1
+                latencies.append(time.perf_counter() - started)
+
+        started = time.perf_counter()
+        await asyncio.gather(*[sender() for _ in range(args.concurrency)])
+        accepted_in = time.perf_counter() - started
+
+        processed = 0
+        while time.perf_counter() - started < accepted_in + 60:
+            async with session.get(stats_url) as response:
+                processed = sum((await response.json())["processed"]) - before
+            if processed >= statuses.get(200, 0):
+                break
+            await asyncio.sleep(0.05)
+        processed_in = time.perf_counter() - started
+
+    latencies.sort()
+    print(json.dumps({
+        "updates": args.updates,
+        "statuses": statuses,
+        "accept_rps": round(args.updates / accepted_in),
+        "processed": processed,
+        "process_rps": round(processed / processed_in),
+        "p50_ms": round(1000 * latencies[len(latencies) // 2], 2),
+        "p99_ms": round(1000 * latencies[int(len(latencies) * 0.99)], 2),
+    }, ensure_ascii=False))
+
+
+def main():
+    logging.basicConfig(
+        format='%(asctime)s - %(processName)s - %(name)s - %(levelname)s - %(message)s',
+        level=logging.INFO,
+    )
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    serve_cmd = commands.add_parser("serve", help="принимать обновления вебхуком")
+    serve_cmd.add_argument("--token", default=os.environ.get("MAX_BOT_TOKEN"))
+    serve_cmd.add_argument("--host", default="0.0.0.0")
+    serve_cmd.add_argument("--port", type=int, default=8080)
+    serve_cmd.add_argument("--path", default="/webhook")
+    serve_cmd.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    serve_cmd.add_argument("--secret", default=os.environ.get("MAX_WEBHOOK_SECRET"))
+    serve_cmd.add_argument("--send-rate", type=float, default=20.0)
+    serve_cmd.add_argument(
+        "--background-share",
+        type=float,
+        default=0.5,
+        help="доля лимита отправки для уведомлений и рассылки фонового процесса",
+    )
+    serve_cmd.add_argument("--public-url", help="зарегистрировать вебхук в MAX")
+
+    bench_cmd = commands.add_parser(
+        "bench", help="нагрузить вебхук фейковыми обновлениями"
+    )
+    bench_cmd.add_argument("--url", default="http://127.0.0.1:8080/webhook")
+    bench_cmd.add_argument("--updates", type=int, default=20000)
+    bench_cmd.add_argument("--chats", type=int, default=5000)
+    bench_cmd.add_argument("--concurrency", type=int, default=64)
+    bench_cmd.add_argument("--secret", default=os.environ.get("MAX_WEBHOOK_SECRET"))
+
+    args = parser.parse_args()
+    if args.command == "serve":
+        if not args.token:
+            parser.error("нужен токен бота: --token или MAX_BOT_TOKEN")
+        try:
+            asyncio.run(serve(args))
+        except KeyboardInterrupt:
+            pass
+    else:
+        asyncio.run(bench(args))
+
+
+if __name__ == "__main__":
+    main()
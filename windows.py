@@ -0,0 +1,181 @@
+import asyncio
+from datetime import date
+from typing import Dict
+from typing import Iterable
+from typing import List
+from typing import NamedTuple
+from typing import Optional
+from typing import Sequence
+from typing import Tuple
+
+from lessons import Lesson
+from lessons import hhmm
+
+DAY_MINUTES = 24 * 60
+
+# пары в ФУ идут с 08:30; вечером после 20:00 общие встречи не назначают
+DAY_START = 8 * 60 + 30
+DAY_END = 20 * 60
+WORKDAYS = (0, 1, 2, 3, 4, 5)
+
+
+class Slot(NamedTuple):
+    """Свободный промежуток: день (date.toordinal()) и минуты от начала суток"""
+
+    day: int
+    start: int
+    end: int
+
+    @property
+    def minutes(self) -> int:
+        return self.end - self.start
+
+    @property
+    def label(self) -> str:
+        return f"{hhmm(self.start)} - {hhmm(self.end)}"
+
+
+class CommonFree(NamedTuple):
+    """Общее свободное время и сущности (kind, id), чьи расписания не загрузились"""
+
+    slots: List[Slot]
+    failed: List[Tuple[str, str]]
+
+
+def span(start: int, end: int) -> int:
+    """Битовая маска минут [start, end)"""
+
+    if end <= start:
+        return 0
+    return ((1 << (end - start)) - 1) << start
+
+
+def busy_masks(lessons: Iterable[Lesson]) -> Dict[int, int]:
+    """Занятость по дням: день -> маска минут, занятых хотя бы одним занятием"""
+
+    masks: Dict[int, int] = {}
+    for lesson in lessons:
+        if lesson.day is None or lesson.begin is None or lesson.end is None:
+            continue
+        masks[lesson.day] = masks.get(lesson.day, 0) | span(lesson.begin, lesson.end)
+    return masks
+
+
+def merge(many: Iterable[Dict[int, int]]) -> Dict[int, int]:
+    """Объединяет занятость нескольких сущностей: занят, если занят хоть кто-то"""
+
+    merged: Dict[int, int] = {}
+    for masks in many:
+        for day, mask in masks.items():
+            merged[day] = merged.get(day, 0) | mask
+    return merged
+
+
+def runs(mask: int) -> List[Tuple[int, int]]:
+    """Непрерывные участки единичных битов маски: [(start, end), ...]"""
+
+    found = []
+    while mask:
+        start = (mask & -mask).bit_length() - 1
+        shifted = mask >> start
+        length = ((shifted ^ (shifted + 1)) >> 1).bit_length()
+        found.append((start, start + length))
+        mask &= ~span(start, start + length)
+    return found
+
+
+def free_slots(
+    busy: Dict[int, int],
+    date_begin: date,
+    date_end: date,
+    min_minutes: int = 45,
+    day_start: int = DAY_START,
+    day_end: int = DAY_END,
+    weekdays: Optional[Sequence[int]] = WORKDAYS,
+    between_lessons: bool = False,
+) -> List[Slot]:
+    """Свободные промежутки не короче min_minutes по маскам занятости
+
+    between_lessons=True ищет только окна между занятиями дня (от начала
+    первого до конца последнего), как "окна" в расписании одной группы;
+    дни без занятий тогда пропускаются. Иначе свободным считается все в
+    пределах [day_start, day_end), включая дни без занятий.
+    """
+
+    slots = []
+    for day in range(date_begin.toordinal(), date_end.toordinal() + 1):
+        if weekdays is not None and date.fromordinal(day).weekday() not in weekdays:
+            continue
+        mask = busy.get(day, 0)
+        if between_lessons:
+            if not mask:
+                continue
+            bounds = span((mask & -mask).bit_length() - 1, mask.bit_length())
+        else:
+            bounds = span(day_start, day_end)
+        for start, end in runs(bounds & ~mask):
+            if end - start >= min_minutes:
+                slots.append(Slot(day, start, end))
+    return slots
+
+
+def common_free(
+    timetables: Iterable[Iterable[Lesson]],
+    date_begin: date,
+    date_end: date,
+    **options,
+) -> List[Slot]:
+    """Когда свободны все: общие свободные промежутки нескольких расписаний"""
+
+    return free_slots(
+        merge(busy_masks(lessons) for lessons in timetables),
+        date_begin,
+        date_end,
+        **options,
+    )
+
+
+async def find_common_free(
+    api,
+    entities: Iterable[Tuple[str, str]],
+    date_begin: date,
+    date_end: date,
+    concurrency: int = 4,
+    **options,
+) -> CommonFree:
+    """Загружает расписания сущностей [(kind, id), ...] и ищет общее время
+
+    Время считается по тем, чьи расписания загрузились, а остальные
+    возвращаются в failed, чтобы вызывающий их назвал. Если не загрузилось
+    ни одно, пробрасывается первая ошибка.
+    """
+
+    by_kind: Dict[str, List[str]] = {}
+    for kind, entity_id in entities:
+        by_kind.setdefault(kind, []).append(str(entity_id))
+
+    failed: List[Tuple[str, str]] = []
+    errors: List[BaseException] = []
+
+    async def fetch(kind, ids):
+        timetables = []
+        async for result in api.timetable_many(
+            kind, ids, date_begin, date_end, concurrency=concurrency
+        ):
+            if result.error is not None:
+                failed.append((kind, str(result.entity_id)))
+                errors.append(result.error)
+                continue
+            timetables.append(result.lessons)
+        return timetables
+
+    fetched = await asyncio.gather(*[fetch(k, ids) for k, ids in by_kind.items()])
+    if errors and not any(fetched):
+        raise errors[0]
+    slots = common_free(
+        (lessons for timetables in fetched for lessons in timetables),
+        date_begin,
+        date_end,
+        **options,
+    )
+    return CommonFree(slots, failed)